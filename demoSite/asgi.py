@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for the DocCode server (SERVER_MODE=asgi)
+
+POST /api/ai-assist is relayed natively on the event loop with an async HTTP
+client, so an SSE stream waiting on the model costs one coroutine instead of
+one gunicorn thread. Every other route is the unchanged Flask app from
+server.py, run on a small thread pool through a WSGI adapter.
+
+The relay reuses server.py's gates and mappings (check_ai_access,
+prepare_ai_relay, upstream_error_body, STREAM_INTERRUPTED_FRAME), so the
+origin/mode/session checks, 429/402 quota copy and mid-stream error frame are
+identical in both modes, as are the completion cache, single-flight
+coalescing of identical in-flight requests and admission control. Requests
+for index.html get a 103 Early Hints response first where the server
+implements the ASGI early-hint extension.
+"""
+
+import asyncio
+import json
+import os
+import time
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from limits import parse, parse_many
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_cookie
+
+import server
+from server import logger
+
+# Threads serving the Flask routes (static files, config endpoints). The relay
+# itself never occupies one of these.
+WSGI_THREADS = int(os.environ.get('GUNICORN_THREADS') or 8)
+
+AI_ASSIST_PATH = '/api/ai-assist'
+INDEX_PATHS = ('/', '/index.html')
+EARLY_HINT_EXTENSION = 'http.response.early_hint'
+
+flask_app = WSGIMiddleware(server.app, workers=WSGI_THREADS)
+
+# Created lazily inside the worker's event loop, i.e. after the gunicorn fork.
+_upstream_client = None
+
+
+def upstream_client():
+    """Return this worker's keep-alive AsyncClient for the AI proxy."""
+    global _upstream_client
+    if _upstream_client is None:
+        _upstream_client = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=None,
+            max_keepalive_connections=server.AI_POOL_SIZE,
+            keepalive_expiry=server.AI_POOL_IDLE_TIMEOUT,
+        ))
+    return _upstream_client
+
+
+class AsgiRequest:
+    """The slice of flask.Request read by server.check_ai_access()."""
+
+    def __init__(self, scope):
+        self.headers = Headers([(k.decode('latin-1'), v.decode('latin-1'))
+                                for k, v in scope.get('headers', [])])
+        self.cookies = parse_cookie(self.headers.get('Cookie', ''))
+        self.remote_addr = client_ip(scope, self.headers)
+
+    @property
+    def content_length(self):
+        try:
+            return int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            return None
+
+
+def client_ip(scope, headers):
+    """Client address as ProxyFix(x_for=1) sees it: the last X-Forwarded-For hop."""
+    forwarded = headers.get('X-Forwarded-For', '')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    client = scope.get('client')
+    return client[0] if client else None
+
+
+def check_rate_limits(remote_addr):
+    """Apply the Flask route's limits (10/minute + AI_DAILY_LIMIT_PER_IP).
+
+    Uses flask-limiter's own strategy and storage, so the limits behave the
+    same as on the WSGI route. Returns None or an (error body, status) tuple.
+    """
+    if not server.limiter.enabled:
+        return None
+    strategy = server.limiter.limiter
+    if not strategy.hit(parse('10/minute'), AI_ASSIST_PATH, remote_addr):
+        server.rejections.inc(('rate_limit',))
+        return {'error': 'Rate limit exceeded. Please wait before sending another request.'}, 429
+    if server.AI_DAILY_LIMIT_PER_IP:
+        for item in parse_many(server.AI_DAILY_LIMIT_PER_IP):
+            if not strategy.hit(item, AI_ASSIST_PATH, 'per_ip_quota', remote_addr):
+                server.rejections.inc(('per_ip_quota',))
+                return {'error': server.PER_IP_COPY, 'code': 'per_ip_quota'}, 429
+    return None
+
+
+def cors_headers(request):
+    """Mirror Flask-CORS for allowed origins on the natively served route."""
+    origin = request.headers.get('Origin', '')
+    if origin in server.ALLOWED_ORIGINS:
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+    return []
+
+
+async def send_json(send, body, status, extra_headers=()):
+    await send_json_bytes(send, json.dumps(body).encode(), status, extra_headers)
+
+
+async def send_json_bytes(send, payload, status, extra_headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(payload)).encode()),
+                    *extra_headers],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def read_body(receive, limit):
+    """Read the request body; None once it exceeds `limit` bytes or the client left."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > limit:
+            return None
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+def upstream_error(resp):
+    try:
+        error_data = resp.json()
+    except Exception:
+        error_data = None
+    return server.upstream_error_body(resp.status_code, error_data, resp.text, resp.headers)
+
+
+def raw_headers(headers):
+    return [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in (headers or {}).items()]
+
+
+def json_result(body, status, headers=None):
+    """A finished reply as published to a flight: (payload bytes, status, headers)."""
+    return json.dumps(body).encode(), status, raw_headers(headers)
+
+
+def failure_result(error):
+    """Map an exception from the upstream call to a finished reply."""
+    if isinstance(error, httpx.TimeoutException):
+        logger.error("AI API request timeout")
+        return json_result({'error': 'Request timeout'}, 504)
+    if isinstance(error, httpx.TransportError):
+        logger.error("Failed to connect to AI API")
+        return json_result({'error': 'Failed to connect to AI service'}, 503)
+    logger.error(f"Unexpected error in AI assist: {error}")
+    return json_result({'error': 'Internal server error'}, 500)
+
+
+class AsyncFlight:
+    """asyncio twin of server.Flight.
+
+    The upstream call runs in its own task, so a subscriber disconnecting
+    (including the one that started it) only cancels its own replay. Stream
+    lines are buffered and every subscriber replays them from the beginning;
+    the upstream task is cancelled once the last subscriber has gone.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.result = None       # finished reply, see json_result()
+        self.chunks = []
+        self.done = False
+        self.subscribers = 1
+        self.ready = asyncio.Event()
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def set_result(self, result):
+        self.result = result
+        self.ready.set()
+        self.finish()
+
+    def push(self, chunk):
+        self.chunks.append(chunk)
+        self._pulse()
+
+    def finish(self):
+        self.done = True
+        self._pulse()
+        land_flight(self)
+
+    def _pulse(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def serve(self, send, cors, timeout, follower=False):
+        extra = [*cors, (b'x-ai-coalesced', b'follower')] if follower else list(cors)
+        try:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                await send_json(send, {'error': 'Request timeout'}, 504, cors)
+                return
+            if self.result is not None:
+                payload, status, headers = self.result
+                await send_json_bytes(send, payload, status, [*extra, *headers])
+                return
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), *extra],
+            })
+            index = 0
+            while True:
+                while index < len(self.chunks):
+                    await send({'type': 'http.response.body', 'body': self.chunks[index], 'more_body': True})
+                    index += 1
+                if self.done:
+                    break
+                await self.changed.wait()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+                land_flight(self)
+
+
+_inflight = {}
+
+
+def join_flight(key, work):
+    """Return (flight, is_leader); a leader's flight starts `work(flight)` as a task."""
+    flight = _inflight.get(key) if key else None
+    if flight is not None and not (flight.done and flight.result is None):
+        flight.subscribers += 1
+        server.count_coalesce('followers')
+        return flight, False
+    flight = AsyncFlight(key)
+    if key:
+        _inflight[key] = flight
+        server.count_coalesce('leaders')
+    flight.task = asyncio.ensure_future(work(flight))
+    return flight, True
+
+
+def land_flight(flight):
+    if flight.key and _inflight.get(flight.key) is flight:
+        del _inflight[flight.key]
+
+
+async def admit(relay, flight):
+    """Take an upstream slot; on a 503 the flight is resolved and None returned."""
+    slot, retry_after = await server.ai_admission.admit_async(
+        relay['client'], relay['model'], relay['timeout'], relay['weight'])
+    if slot is None:
+        flight.set_result(json_result(*server.busy_reply(relay['model'], retry_after)))
+        return None
+    retry_after = server.claim_model(relay['model'])  # see server.admit_relay
+    if retry_after is not None:
+        slot.release()
+        flight.set_result(json_result(*server.unavailable_reply(retry_after)))
+        return None
+    return slot
+
+
+def connect_trace(timing):
+    """httpcore trace hook: TCP + TLS setup time of a new connection -> timing['connect']."""
+    async def trace(event, info):
+        if event == 'connection.connect_tcp.started':
+            timing['started'] = time.perf_counter()
+        elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            timing['connect'] = time.perf_counter() - timing['started']
+    return trace
+
+
+def stream_work(relay):
+    async def work(flight):
+        """Open the upstream SSE stream and feed its lines into the flight."""
+        timer = server.StreamTimer(relay['model'])
+        slot = await admit(relay, flight)
+        if slot is None:
+            return
+        client = upstream_client()
+        start_time = time.time()
+        timing = {}
+        request = client.build_request('POST', relay['endpoint'], headers=relay['headers'],
+                                       json=relay['payload'], timeout=relay['timeout'],
+                                       extensions={'trace': connect_trace(timing)})
+        timer.request_sent()
+        try:
+            resp = await client.send(request, stream=True)
+        except Exception as e:
+            slot.release()
+            server.record_model_result(relay['model'], False, time.time() - start_time)
+            flight.set_result(failure_result(e))
+            return
+        except asyncio.CancelledError:
+            slot.release()
+            raise
+        timer.response_started(timing.get('connect'))
+        server.record_model_result(relay['model'], server.breaker_outcome(resp.status_code),
+                                   time.time() - start_time, resp.status_code)
+        try:
+            if resp.status_code != 200:
+                await resp.aread()
+                flight.set_result(json_result(*upstream_error(resp)))
+                return
+            flight.ready.set()
+            usage = None
+            relayed = 0
+            server.ai_active_streams.inc()
+            try:
+                async for line in resp.aiter_lines():
+                    if line:
+                        usage = server.usage_from_sse_line(line) or usage
+                        chunk = (line + '\n').encode()
+                        relayed += len(chunk)
+                        timer.line(line)
+                        flight.push(chunk)
+                timer.outcome = 'complete'
+            except Exception as stream_err:
+                # Same terminal SSE error frame as the WSGI relay.
+                logger.error(f"AI API stream interrupted: {stream_err}")
+                timer.outcome = 'interrupted'
+                flight.push(server.STREAM_INTERRUPTED_FRAME.encode())
+            finally:
+                await asyncio.to_thread(server.record_usage, relay, usage)
+                server.ai_relay_bytes.inc(('stream',), relayed)
+                server.ai_active_streams.inc(amount=-1)
+                timer.finish(usage, relayed)
+        finally:
+            # Also runs on cancellation (every client gone), releasing the
+            # upstream connection immediately.
+            await resp.aclose()
+            slot.release()
+            if not flight.done:
+                flight.finish()
+    return work
+
+
+def once_work(relay, cache_key):
+    async def work(flight):
+        """Run a non-streaming completion and publish the reply."""
+        slot = await admit(relay, flight)
+        if slot is None:
+            return
+        try:
+            start_time = time.time()
+            resp = await upstream_client().post(relay['endpoint'], headers=relay['headers'],
+                                                json=relay['payload'], timeout=relay['timeout'])
+            logger.info(f"AI API response received in {time.time() - start_time:.2f}s, status: {resp.status_code}")
+            server.record_model_result(relay['model'], server.breaker_outcome(resp.status_code),
+                                       time.time() - start_time, resp.status_code)
+            if resp.status_code == 200:
+                ai_response = resp.json()
+                await asyncio.to_thread(server.record_usage, relay,
+                                        ai_response.get('usage') if isinstance(ai_response, dict) else None)
+                payload = json.dumps(ai_response).encode()
+                server.ai_relay_bytes.inc(('once',), len(payload))
+                headers = []
+                if server.AI_CACHE_ENABLED:
+                    headers.append((b'x-ai-cache', b'MISS' if cache_key else b'BYPASS'))
+                    if cache_key:
+                        await asyncio.to_thread(server.ai_cache_put, cache_key, payload)
+                result = (payload, 200, headers)
+            else:
+                result = json_result(*upstream_error(resp))
+        except Exception as e:
+            if isinstance(e, httpx.TransportError):
+                server.record_model_result(relay['model'], False, time.time() - start_time)
+            result = failure_result(e)
+        finally:
+            slot.release()
+        flight.set_result(result)
+    return work
+
+
+async def ai_assist(scope, receive, send):
+    """Async twin of server.ai_assist()."""
+    request = AsgiRequest(scope)
+    cors = cors_headers(request)
+
+    # Limits, budgets, the completion cache and usage recording all touch
+    # shared storage (SQLite, disk) that may block under contention, so they
+    # run on worker threads; one slow write must not stall every stream.
+    limited = await asyncio.to_thread(check_rate_limits, request.remote_addr)
+    if limited:
+        await send_json(send, *limited, cors)
+        return
+
+    denied = server.check_ai_access(request)
+    if denied:
+        await send_json(send, *denied, cors)
+        return
+
+    if request.content_length and request.content_length > server.MAX_REQUEST_SIZE:
+        await send_json(send, {'error': 'Request too large'}, 413, cors)
+        return
+    raw = await read_body(receive, server.MAX_REQUEST_SIZE)
+    if raw is None:
+        await send_json(send, {'error': 'Request too large'}, 413, cors)
+        return
+    try:
+        data = json.loads(raw)
+    except ValueError as e:
+        logger.error(f"Invalid JSON in request: {e}")
+        await send_json(send, {'error': 'Invalid JSON'}, 400, cors)
+        return
+
+    relay, error = server.prepare_ai_relay(data, request.remote_addr)
+    if error:
+        body, status, *headers = error
+        await send_json(send, body, status, [*cors, *raw_headers(*headers)])
+        return
+    relay['client'], relay['weight'] = server.admission_client(request)
+    relay['budget_keys'] = server.token_budget_keys(request)
+    over_budget = await asyncio.to_thread(server.check_token_budgets, relay)
+    if over_budget:
+        body, status, headers = over_budget
+        await send_json(send, body, status, [*cors, *raw_headers(headers)])
+        return
+    # Same X-AI-Model header as the WSGI relay: the model that answered.
+    reply_headers = [*cors, (b'x-ai-model', relay['model'].encode('latin-1'))] if relay['model'] else cors
+
+    if relay['repair']:
+        # The render-validate-repair loop chains upstream calls with blocking
+        # gateway renders; it runs on a worker thread with the WSGI relay code.
+        body, status, headers = await asyncio.to_thread(server.run_repair_loop, relay)
+        await send_json(send, body, status, [*reply_headers, *raw_headers(headers)])
+        return
+
+    if relay['stream']:
+        work = stream_work(relay)
+    else:
+        cache_key = server.ai_cache_key(relay['payload'])
+        if cache_key:
+            cached = await asyncio.to_thread(server.ai_cache_get, cache_key)
+            if cached is not None:
+                logger.info(f"AI completion for model {relay['model']} served from cache")
+                await send_json_bytes(send, cached, 200, [*reply_headers, (b'x-ai-cache', b'HIT')])
+                return
+        work = once_work(relay, cache_key)
+
+    flight, leader = join_flight(server.coalesce_key(relay['payload']), work)
+    if not leader:
+        logger.info(f"Joined in-flight AI request for model {relay['model']}")
+
+    serve_task = asyncio.ensure_future(flight.serve(send, reply_headers, relay['timeout'], follower=not leader))
+    disconnect_task = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({serve_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect_task.cancel()
+        if not serve_task.done():
+            serve_task.cancel()
+            await asyncio.gather(serve_task, return_exceptions=True)
+            logger.info("AI API client disconnected")
+    if not serve_task.cancelled() and serve_task.exception() is not None:
+        logger.error(f"AI API relay failed while responding: {serve_task.exception()}")
+
+
+async def send_early_hints(scope, send):
+    """103 Early Hints with index.html's preload links, if the server supports
+    the ASGI early-hint extension (WSGI has no way to send a 1xx)."""
+    preload = server.INDEX_PRELOAD
+    if preload is None or not preload.links or EARLY_HINT_EXTENSION not in scope.get('extensions', {}):
+        return
+    await send({'type': EARLY_HINT_EXTENSION, 'links': [link.encode() for link in preload.links]})
+
+
+async def observed(handler, scope, receive, send):
+    """Count a natively served route in the same /metrics series as the
+    Flask routes (RequestMetrics never sees it)."""
+    started = time.perf_counter()
+    status = ['500']
+
+    async def observing_send(message):
+        if message['type'] == 'http.response.start':
+            status[0] = str(message['status'])
+        await send(message)
+
+    try:
+        await handler(scope, receive, observing_send)
+    finally:
+        server.http_requests.inc((scope['path'], scope['method'], status[0]))
+        server.http_duration.observe(time.perf_counter() - started, (scope['path'],))
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _upstream_client is not None:
+                await _upstream_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == AI_ASSIST_PATH and scope['method'] == 'POST':
+        await observed(ai_assist, scope, receive, send)
+    else:
+        if scope['type'] == 'http' and scope['path'] in INDEX_PATHS and scope['method'] == 'GET':
+            await send_early_hints(scope, send)
+        await flask_app(scope, receive, send)
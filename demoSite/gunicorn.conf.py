@@ -2,7 +2,11 @@
 
 Tunables (set in .env; compose forwards it via env_file):
   GUNICORN_WORKERS, GUNICORN_THREADS, GUNICORN_TIMEOUT,
-  GUNICORN_GRACEFUL_TIMEOUT, GUNICORN_KEEPALIVE, GUNICORN_LOG_LEVEL
+  GUNICORN_GRACEFUL_TIMEOUT, GUNICORN_KEEPALIVE, GUNICORN_LOG_LEVEL, SERVER_MODE
+AI proxy connection pool (read by server.py): AI_POOL_SIZE, AI_POOL_WARM,
+  AI_POOL_IDLE_TIMEOUT
+Model catalog refresher (read by server.py): AI_MODELS_SNAPSHOT,
+  AI_MODELS_REFRESH_INTERVAL
 """
 import os
 
@@ -19,11 +23,22 @@ def _env(name, default):
 
 bind = f"0.0.0.0:{_env('PORT', '8006')}"
 
-worker_class = "gthread"
 workers = int(_env("GUNICORN_WORKERS", "2"))
 threads = int(_env("GUNICORN_THREADS", "8"))
 
-# Liveness heartbeat, NOT a per-request limit: gthread workers keep notifying
+# SERVER_MODE=wsgi (default): gthread workers; every AI stream holds one of the
+# GUNICORN_WORKERS x GUNICORN_THREADS threads for its whole lifetime.
+# SERVER_MODE=asgi: uvicorn workers running asgi.py; /api/ai-assist streams are
+# coroutines (thousands per worker), and the remaining Flask routes run on a
+# GUNICORN_THREADS-sized thread pool inside each worker.
+if _env("SERVER_MODE", "wsgi").lower() == "asgi":
+    worker_class = "uvicorn_worker.UvicornWorker"
+    wsgi_app = "asgi:app"
+else:
+    worker_class = "gthread"
+    wsgi_app = "server:app"
+
+# Liveness heartbeat, NOT a per-request limit: workers keep notifying
 # the master while threads stream SSE, so 300s AI streams survive this.
 timeout = int(_env("GUNICORN_TIMEOUT", "30"))
 
@@ -42,6 +57,38 @@ keepalive = int(_env("GUNICORN_KEEPALIVE", "5"))
 # served 2 different secrets; with preload, both workers shared one secret.
 preload_app = True
 
+
+def on_starting(arbiter):
+    """Empty the metrics snapshot directory once per boot, in the master only.
+
+    Snapshots of earlier workers are summed into /metrics counters, so a stale
+    set from the last boot must go; doing it here rather than at import keeps
+    scripts that import server from wiping the live workers' snapshots.
+    """
+    import server
+
+    server.metrics.reset_directory()
+
+
+def post_worker_init(worker):
+    """Build and warm this worker's AI proxy keep-alive pool after the fork,
+    then start its background model-catalog refresher (and, when
+    STATIC_CACHE_WATCH_INTERVAL is set, its static file watcher) and its
+    metrics snapshot writer. One worker also warms the shared render cache.
+
+    The app module was imported once in the master (preload_app), so any socket
+    it opened would be shared by every child; each worker needs its own pool.
+    Threads do not survive a fork either, hence the refresher starts here too.
+    """
+    import server
+
+    server.init_upstream_pool()
+    server.start_model_refresh()
+    server.start_static_watcher()
+    server.start_render_warmer()
+    server.metrics.start()
+
+
 # Heartbeat tempfiles on tmpfs so a slow disk can never stall a worker.
 worker_tmp_dir = "/dev/shm"
 
@@ -99,7 +99,9 @@ window.AIAssistantAPI = {
                     model: config.model === 'custom' ? config.customModel : config.model,
                     maxRetryAttempts: config.maxRetryAttempts,
                     max_tokens: AI_API_MAX_TOKENS,
-                    stream: true,
+                    // Server-side repair replies with one checked answer, not a stream
+                    stream: !config.repair,
+                    ...(config.repair ? { repair: config.repair } : {}),
                     // H1: never send endpoint or api_key to the DocCode origin —
                     // only the timeout is a valid server-side config parameter.
                     config: {
@@ -121,6 +123,13 @@ window.AIAssistantAPI = {
                 throw new Error(errorData.error || this._getHttpErrorMessage(response.status));
             }
 
+            // The relay fails over to a fallback model while the selected one is unhealthy
+            const servedModel = response.headers.get('X-AI-Model');
+            const requestedModel = config.model === 'custom' ? config.customModel : config.model;
+            if (servedModel && requestedModel && servedModel !== requestedModel && callbacks.onModelFallback) {
+                callbacks.onModelFallback(servedModel, requestedModel);
+            }
+
             const contentType = response.headers.get('content-type') || '';
             if (contentType.includes('text/event-stream')) {
                 const streamingEl = callbacks.addStreamingMessage();
@@ -50,6 +50,8 @@ class AIAssistant {
         // Server-advertised AI mode ('relay' | 'byok' | 'off'); set by applyServerMode()
         this.serverAIMode = null;
         this.byokOnboardingNeeded = false;
+        // Relay renders and repairs answers server-side (AI_REPAIR_ENABLED)
+        this.serverRepair = false;
 
         // Event listener references for cleanup
         this._boundListeners = [];
@@ -622,13 +624,21 @@ class AIAssistant {
                     return this.addStreamingMessage();
                 },
                 updateStreamingMessage: (el, text) => this.updateStreamingMessage(el, text),
-                scrollToBottom: () => this.scrollToBottom()
+                scrollToBottom: () => this.scrollToBottom(),
+                onModelFallback: (served, requested) => this.addMessage('system',
+                    `Model "${requested}" is temporarily unavailable; answered by "${served}" instead.`)
             };
 
             if (aiConfig.useCustomAPI && aiConfig.endpoint && aiConfig.apiKey) {
                 rawResponseContent = await window.AIAssistantAPI.callCustomAPI(messages, aiConfig, this.currentAbortController, callbacks);
             } else {
-                rawResponseContent = await window.AIAssistantAPI.callProxyAPI(messages, aiConfig, this.currentAbortController, callbacks);
+                // First attempt only: the relay render-checks the answer and
+                // re-prompts on failure itself, saving a round trip per retry.
+                const repair = aiConfig.autoValidate && this.serverRepair && this.retryAttempts === 0
+                    ? { diagramType, userPrompt: originalUserPrompt, currentCode: originalCode }
+                    : null;
+                rawResponseContent = await window.AIAssistantAPI.callProxyAPI(
+                    messages, repair ? { ...aiConfig, repair } : aiConfig, this.currentAbortController, callbacks);
             }
 
             // Empty streamed response → clear message instead of a confusing JSON-parse error.
@@ -642,9 +652,24 @@ class AIAssistant {
 
             const aiParsedResponse = this.parseAIResponse(rawResponseContent);
             const { diagramCode, explanation } = aiParsedResponse;
+            // Verdict of the server-side repair loop; absent or unchecked → validate here
+            const repaired = rawResponseContent && typeof rawResponseContent.repair?.valid === 'boolean'
+                ? rawResponseContent.repair : null;
 
             if (diagramCode && diagramCode.trim() && diagramCode !== "No diagram generated") {
-                if (aiConfig.autoValidate) {
+                if (repaired) {
+                    this.updateDiagramCode(diagramCode);
+                    if (window.codeHistory && typeof window.codeHistory.addToHistory === 'function') {
+                        window.codeHistory.addToHistory(diagramCode);
+                    }
+                    if (repaired.valid) {
+                        const msg = repaired.attempts > 1
+                            ? this.makeRetryExplanationUserFriendly(explanation, originalUserPrompt) : explanation;
+                        this.displayMessage(`${msg}`, 'ai success');
+                    } else {
+                        this.displayMessage(`${explanation} (Note: Diagram may have rendering issues)`, 'ai warning');
+                    }
+                } else if (aiConfig.autoValidate) {
                     const validationResult = await this.validateAndApplyDiagramCode(diagramCode, diagramType);
 
                     if (validationResult.success) {
@@ -1026,9 +1051,11 @@ class AIAssistant {
      * Apply the server-advertised AI mode with all critique fixes.
      * Called from main.js after /api/config resolves.
      * @param {'relay'|'byok'|'off'} mode
+     * @param {{repair?: boolean}} [options] - repair: relay runs the render-validate-repair loop
      */
-    applyServerMode(mode) {
+    applyServerMode(mode, options = {}) {
         this.serverAIMode = mode;
+        this.serverRepair = mode === 'relay' && !!options.repair;
 
         if (mode === 'off') {
             // closeChat() re-shows the button; call it BEFORE hiding so the guard
@@ -296,7 +296,7 @@ document.addEventListener('DOMContentLoaded', function () {
                 // Deliver server AI mode to the assistant so the UI reflects relay/byok/off
                 if (config.ai && window.aiAssistant && typeof window.aiAssistant.applyServerMode === 'function') {
                     const mode = config.ai.mode || (config.ai.enabled ? 'relay' : 'off');
-                    window.aiAssistant.applyServerMode(mode);
+                    window.aiAssistant.applyServerMode(mode, { repair: !!config.ai.repair });
                 }
             })
             .catch(() => { /* server config unavailable, use default */ })
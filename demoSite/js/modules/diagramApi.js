@@ -9,7 +9,7 @@
 import { api } from './api.js';
 import { createTrackedBlobUrl } from './dom.js';
 import { DEFAULT_POST_REQUEST_TIMEOUT } from './constants.js';
-import { encodeKrokiDiagram } from './diagramOperations.js';
+import { encodeKrokiDiagram, canonicalDiagramSource } from './diagramOperations.js';
 import { diagramOptionsQuery, diagramOptionsObject } from './diagramOptions.js';
 
 /**
@@ -23,6 +23,16 @@ function getBaseUrl() {
     return `${protocol}//${hostname}${port}`;
 }
 
+/**
+ * Build the base URL for POST renders. The full server renders POST bodies
+ * through its /api/render gateway (shared render cache); the lite build talks
+ * to Kroki directly.
+ * @returns {string} Base URL (e.g., "https://localhost:8443/api/render")
+ */
+function getRenderBaseUrl() {
+    return window.__DOCCODE_LITE__ ? getBaseUrl() : `${getBaseUrl()}/api/render`;
+}
+
 /**
  * Get the configured POST request timeout
  * @returns {number} Timeout in milliseconds
@@ -44,7 +54,7 @@ function getTimeout() {
  * @returns {Promise<string>} Blob URL for the diagram
  */
 export async function generateDiagramWithPost(diagramType, outputFormat, diagramCode) {
-    const postUrl = `${getBaseUrl()}/${diagramType}/${outputFormat}${diagramOptionsQuery(diagramType)}`;
+    const postUrl = `${getRenderBaseUrl()}/${diagramType}/${outputFormat}${diagramOptionsQuery(diagramType)}`;
     const blob = await api.postBlob(postUrl, diagramCode, { timeout: getTimeout() });
     return createTrackedBlobUrl(blob);
 }
@@ -59,7 +69,7 @@ export async function generateDiagramWithPost(diagramType, outputFormat, diagram
  * @returns {Promise<string>} Blob URL for the diagram
  */
 export async function generateDiagramWithJsonPost(diagramType, outputFormat, diagramCode) {
-    const postUrl = `${getBaseUrl()}/`;
+    const postUrl = `${getRenderBaseUrl()}/`;
     const body = {
         diagram_source: diagramCode,
         diagram_type: diagramType,
@@ -85,7 +95,7 @@ export function shouldUsePostForCurrentDiagram() {
     const alwaysUsePost = window.configManager ? window.configManager.get('kroki.alwaysUsePost') : false;
     const urlLengthThreshold = window.configManager ? window.configManager.get('kroki.urlLengthThreshold') : 4096;
 
-    const encodedDiagram = encodeKrokiDiagram(code);
+    const encodedDiagram = encodeKrokiDiagram(canonicalDiagramSource(code, diagramType));
     const url = `${getBaseUrl()}/${diagramType}/${outputFormat}/${encodedDiagram}`;
 
     return alwaysUsePost || url.length > urlLengthThreshold;
@@ -98,25 +108,29 @@ export function shouldUsePostForCurrentDiagram() {
  * @param {string} outputFormat - Output format
  * @param {string} code - Diagram source code
  * @param {'text'|'blob'} parseAs - How to parse the response
+ * @param {'interactive'|'bulk'} [priority='interactive'] - Render gateway lane;
+ *     exports use 'bulk' so they queue behind editor previews
  * @returns {Promise<string|Blob>} Response content
  */
-export async function fetchDiagramViaPost(diagramType, outputFormat, code, parseAs = 'text') {
+export async function fetchDiagramViaPost(diagramType, outputFormat, code, parseAs = 'text', priority = 'interactive') {
     const postFormat = window.configManager ? window.configManager.get('kroki.postFormat') : 'plain';
     const timeout = getTimeout();
+    // Only the gateway understands the header; the lite build posts to Kroki.
+    const headers = priority === 'bulk' && !window.__DOCCODE_LITE__ ? { 'X-Render-Priority': 'bulk' } : {};
 
     if (postFormat === 'json') {
-        const postUrl = `${getBaseUrl()}/`;
+        const postUrl = `${getRenderBaseUrl()}/`;
         const body = {
             diagram_source: code,
             diagram_type: diagramType,
             output_format: outputFormat
         };
-        return api.postJSON(postUrl, body, { parseAs, timeout });
+        return api.postJSON(postUrl, body, { parseAs, timeout, headers });
     } else {
-        const postUrl = `${getBaseUrl()}/${diagramType}/${outputFormat}`;
+        const postUrl = `${getRenderBaseUrl()}/${diagramType}/${outputFormat}`;
         if (parseAs === 'blob') {
-            return api.postBlob(postUrl, code, { timeout });
+            return api.postBlob(postUrl, code, { timeout, headers });
         }
-        return api.postText(postUrl, code, { timeout });
+        return api.postText(postUrl, code, { timeout, headers });
     }
 }
@@ -35,7 +35,7 @@ export function downloadDiagram() {
         const [diagramType, outputFormat] = diagramPath.split('/');
         const code = document.getElementById('code').value;
 
-        fetchDiagramViaPost(diagramType, outputFormat, code, 'blob')
+        fetchDiagramViaPost(diagramType, outputFormat, code, 'blob', 'bulk')
             .then(blob => {
                 const downloadUrl = createTrackedBlobUrl(blob);
                 a.href = downloadUrl;
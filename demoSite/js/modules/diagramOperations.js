@@ -80,6 +80,30 @@ export function updateFormatDropdown() {
     updateCurrentOutputFormat(formatDropdown.value);
 }
 
+let examplesPrefetch = null;
+
+/**
+ * Fetch every example source in one request (/api/examples) and seed the
+ * example cache. Runs once; the lite build has no API, so a failure just
+ * leaves the per-file fetch in loadExampleForDiagramType to do the work.
+ * @returns {Promise<void>}
+ */
+export function prefetchExamples() {
+    if (!examplesPrefetch) {
+        examplesPrefetch = (window.__DOCCODE_LITE__ ? Promise.resolve() : fetch('/api/examples')
+            .then(response => (response.ok ? response.json() : { examples: {} }))
+            .then(data => {
+                for (const [type, text] of Object.entries(data.examples || {})) {
+                    if (!getExampleCache()[type]) {
+                        setExampleCache(type, text);
+                    }
+                }
+            }))
+            .catch(error => console.warn('Could not prefetch examples:', error));
+    }
+    return examplesPrefetch;
+}
+
 /**
  * Load example content for specific diagram type
  * @param {string} type - Diagram type identifier
@@ -93,6 +117,11 @@ export async function loadExampleForDiagramType(type) {
     document.getElementById('loadingMessage').style.display = 'block';
 
     try {
+        await prefetchExamples();
+        if (getExampleCache()[type]) {
+            return getExampleCache()[type];
+        }
+
         const response = await fetch(`/examples/${type}.txt`);
 
         if (response.ok) {
@@ -110,6 +139,8 @@ export async function loadExampleForDiagramType(type) {
     }
 }
 
+export { canonicalDiagramSource } from './diagramSource.js';
+
 /**
  * Encode diagram text for Kroki API
  * @param {string} text - Diagram source code
@@ -19,7 +19,7 @@ import {
 import { formatDisplayTypes, BLOB_CLEANUP_DELAY_MS } from './constants.js';
 import { createTrackedBlobUrl, revokeBlobUrl } from './dom.js';
 import { showBanner, hideBanner } from './errors.js';
-import { encodeKrokiDiagram } from './diagramOperations.js';
+import { encodeKrokiDiagram, canonicalDiagramSource } from './diagramOperations.js';
 import { generateDiagramWithPost, generateDiagramWithJsonPost, fetchDiagramViaPost } from './diagramApi.js';
 import { diagramOptionsQuery } from './diagramOptions.js';
 import { updateUrl, clearUrlParameters } from './urlHandler.js';
@@ -69,7 +69,7 @@ export async function updateDiagram() {
         const alwaysUsePost = window.configManager ? window.configManager.get('kroki.alwaysUsePost') : false;
         const urlLengthThreshold = window.configManager ? window.configManager.get('kroki.urlLengthThreshold') : 4096;
 
-        const encodedDiagram = encodeKrokiDiagram(code);
+        const encodedDiagram = encodeKrokiDiagram(canonicalDiagramSource(code, diagramType));
 
         const protocol = window.location.protocol;
         const hostname = window.location.hostname;
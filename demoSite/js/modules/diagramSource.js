@@ -0,0 +1,38 @@
+/**
+ * Canonical diagram sources for GET render URLs.
+ *
+ * nginx keys its GET render cache on the raw request URI, so sources that only
+ * differ in BOM, line endings or trailing whitespace would each get their own
+ * entry. For types whose renderers ignore those differences the editor encodes
+ * a canonical form instead. ASCII-art types (ditaa, svgbob, goat) and YAML or
+ * LaTeX based ones draw with whitespace, so their sources are encoded verbatim.
+ * The type list and the normalization mirror WHITESPACE_INSENSITIVE_TYPES and
+ * canonical_diagram_source() in server.py, so the URL matches /api/encode.
+ *
+ * This module has no browser or third-party dependencies so it stays unit-testable.
+ *
+ * @module diagramSource
+ */
+
+/** @type {Set<string>} */
+export const WHITESPACE_INSENSITIVE_TYPES = new Set([
+    'actdiag', 'blockdiag', 'bpmn', 'bytefield', 'c4plantuml', 'd2', 'dbml', 'diagramsnet', 'erd',
+    'excalidraw', 'graphviz', 'mermaid', 'nomnoml', 'nwdiag', 'packetdiag', 'pikchr', 'plantuml',
+    'rackdiag', 'seqdiag', 'structurizr', 'symbolator', 'vega', 'vegalite', 'wavedrom',
+]);
+
+/**
+ * Canonical form of a diagram source: for whitespace-insensitive types no BOM,
+ * LF line endings, no trailing whitespace and exactly one final newline; any
+ * other type is returned unchanged.
+ * @param {string} text - Diagram source code
+ * @param {string} diagramType - Kroki diagram type
+ * @returns {string} Canonical source
+ */
+export function canonicalDiagramSource(text, diagramType) {
+    if (!WHITESPACE_INSENSITIVE_TYPES.has(diagramType)) {
+        return text;
+    }
+    const lines = text.replace(/^\uFEFF+/, '').replace(/\r\n?/g, '\n').split('\n');
+    return lines.map(line => line.replace(/\s+$/, '')).join('\n').replace(/^\n+|\n+$/g, '') + '\n';
+}
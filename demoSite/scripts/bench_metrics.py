@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Per-update cost of the /metrics counters and histograms.
+
+Usage:  python demoSite/scripts/bench_metrics.py [updates] [threads]
+
+Times Metric.inc() and Metric.observe() (the calls on every request and every
+relayed stream line) first in one thread and then with several threads
+updating the same metric, the way gunicorn's request threads do. Also reports
+the cost of one snapshot and one full exposition of the live registry.
+"""
+
+import os
+import sys
+import threading
+import time
+
+DEMO_SITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DEMO_SITE_DIR)
+os.environ.setdefault('STATIC_ROOT', DEMO_SITE_DIR)
+os.environ.setdefault('AI_MODELS_SNAPSHOT', '')
+os.environ.setdefault('METRICS_DIR', '')
+
+import server  # noqa: E402
+
+LABELS = ('/api/ai-assist',)
+
+
+def run(update, updates):
+    started = time.perf_counter()
+    for _ in range(updates):
+        update()
+    return time.perf_counter() - started
+
+
+def threaded(update, updates, threads):
+    workers = [threading.Thread(target=run, args=(update, updates)) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started
+
+
+def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    counter = server.Metric('bench_total', 'counter', 'x', ('route',))
+    histogram = server.Metric('bench_seconds', 'histogram', 'x', ('route',))
+    cases = {
+        'counter.inc': lambda: counter.inc(LABELS),
+        'histogram.observe': lambda: histogram.observe(0.042, LABELS),
+    }
+    print(f"{'update':<20}{'1 thread':>14}{f'{threads} threads':>16}")
+    for name, update in cases.items():
+        single = min(run(update, updates) for _ in range(5)) / updates
+        parallel = threaded(update, updates, threads) / (updates * threads)
+        print(f"{name:<20}{single * 1e9:>11.0f} ns{parallel * 1e9:>13.0f} ns")
+
+    started = time.perf_counter()
+    server.metrics.snapshot()
+    snapshot = time.perf_counter() - started
+    started = time.perf_counter()
+    text = server.metrics.exposition()
+    exposition = time.perf_counter() - started
+    print(f"\nsnapshot {snapshot * 1000:.2f} ms, exposition {exposition * 1000:.2f} ms "
+          f"({len(text)} bytes, {len(server.metrics.metrics)} families)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Per-check overhead of the rate-limit storage backends.
+
+Usage:  python demoSite/scripts/bench_ratelimit.py [checks] [processes]
+
+Times `hit()` with the strategy the app uses (RATELIMIT_STRATEGY) against
+memory:// (the old per-worker store) and the shared sqlite:// store, first in
+one process and then with several processes hitting the same database the way
+gunicorn workers do. Any other URI in BENCH_STORAGE_URIS (comma-separated,
+e.g. redis://localhost:6379) is measured too.
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+DEMO_SITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DEMO_SITE_DIR)
+os.environ.setdefault('STATIC_ROOT', DEMO_SITE_DIR)
+os.environ.setdefault('AI_MODELS_SNAPSHOT', '')
+
+import server  # noqa: E402  (registers the sqlite:// storage)
+from limits import parse  # noqa: E402
+from limits.storage import storage_from_string  # noqa: E402
+from limits.strategies import STRATEGIES  # noqa: E402
+
+
+def run(uri, checks, results=None):
+    limiter = STRATEGIES[server.RATELIMIT_STRATEGY](storage_from_string(uri))
+    limit = parse('1000000/minute')
+    started = time.perf_counter()
+    for i in range(checks):
+        limiter.hit(limit, '/api/ai-assist', f'10.0.{i % 256}.{os.getpid() % 256}')
+    elapsed = time.perf_counter() - started
+    if results is not None:
+        results.put(elapsed)
+    return elapsed
+
+
+def parallel(uri, checks, processes):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=run, args=(uri, checks, results)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    elapsed = max(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return elapsed
+
+
+def main():
+    checks = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    with tempfile.TemporaryDirectory() as tmp:
+        uris = ['memory://', f'sqlite:///{tmp}/ratelimit.db']
+        uris += [u for u in os.environ.get('BENCH_STORAGE_URIS', '').split(',') if u]
+        print(f"strategy={server.RATELIMIT_STRATEGY} checks={checks} processes={processes}")
+        for uri in uris:
+            single = run(uri, checks) / checks * 1e6
+            line = f"{uri.split(':')[0]:>8}: {single:8.1f} us/check (1 process)"
+            if not uri.startswith('memory'):
+                shared = parallel(uri, checks, processes)
+                line += f", {shared / checks * 1e6:8.1f} us/check ({processes} processes, same store)"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
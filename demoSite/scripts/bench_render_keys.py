@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Render-cache hit ratio of raw vs canonical GET URLs on a recorded workload.
+
+Usage:  python demoSite/scripts/bench_render_keys.py access.log [more.log ...]
+            [--capacity 10000] [--json]
+        python demoSite/scripts/bench_render_keys.py --synthetic 2000
+
+Replays the GET /<type>/<format>/<encoded> requests found in nginx access logs
+(or one URI per line; "-" reads stdin) through an LRU of --capacity entries
+(0 = unbounded), keyed once on the raw request URI, as nginx's proxy_cache_key
+does today, and once on canonical_render_uri(): decoded, normalized and
+re-encoded the way the editor and /api/encode do. --synthetic builds a
+workload from the bundled examples with the variations editors and scripts
+produce (CRLF, trailing spaces, BOM, other deflate levels).
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import sys
+import zlib
+from collections import OrderedDict
+
+DEMO_SITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DEMO_SITE_DIR)
+os.environ.setdefault('STATIC_ROOT', DEMO_SITE_DIR)
+os.environ.setdefault('AI_MODELS_SNAPSHOT', '')
+
+import server  # noqa: E402
+
+REQUEST_RE = re.compile(r'"GET (\S+) HTTP/[\d.]+"|^(/\S+)')
+
+
+def recorded_uris(paths):
+    for path in paths:
+        f = sys.stdin if path == '-' else open(path, encoding='utf-8', errors='replace')
+        with f:
+            for line in f:
+                match = REQUEST_RE.search(line.strip())
+                if match:
+                    yield match.group(1) or match.group(2)
+
+
+def synthetic_uris(count, seed=1):
+    """Example renders as a mix of editors, OSes and encoders would request them."""
+    rng = random.Random(seed)
+    sources = [(diagram_type, source) for _, diagram_type, source in server.render_warm_sources('')]
+    variants = [
+        lambda s: s,
+        lambda s: s.replace('\n', '\r\n'),
+        lambda s: s.replace('\n', '  \n'),
+        lambda s: '\ufeff' + s,
+        lambda s: s.rstrip('\n'),
+        lambda s: s + '\n\n',
+    ]
+    for _ in range(count):
+        diagram_type, source = rng.choice(sources)
+        text = rng.choice(variants)(source).encode('utf-8')
+        encoded = base64.urlsafe_b64encode(zlib.compress(text, rng.choice((6, 6, 9, 1)))).decode()
+        yield f"/{diagram_type}/{rng.choice(('svg', 'svg', 'png'))}/{encoded.rstrip('=') if rng.random() < 0.2 else encoded}"
+
+
+def replay(keys, capacity):
+    cache = OrderedDict()
+    hits = 0
+    for key in keys:
+        if key in cache:
+            hits += 1
+            cache.move_to_end(key)
+            continue
+        cache[key] = True
+        if capacity and len(cache) > capacity:
+            cache.popitem(last=False)
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('logs', nargs='*', help='nginx access logs or URI lists ("-" = stdin)')
+    parser.add_argument('--synthetic', type=int, default=0, help='replay N synthetic requests instead')
+    parser.add_argument('--capacity', type=int, default=0, help='cache entries (0 = unbounded)')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    if not args.logs and not args.synthetic:
+        parser.error('give access logs to replay or --synthetic N')
+
+    uris = list(synthetic_uris(args.synthetic) if args.synthetic else recorded_uris(args.logs))
+    pairs = [(uri, server.canonical_render_uri(uri)) for uri in uris]
+    pairs = [(raw, canonical) for raw, canonical in pairs if canonical]
+    if not pairs:
+        print('No GET render requests in the workload', file=sys.stderr)
+        return 2
+    raw_hits = replay((raw for raw, _ in pairs), args.capacity)
+    canonical_hits = replay((canonical for _, canonical in pairs), args.capacity)
+    report = {
+        'requests': len(pairs),
+        'skipped': len(uris) - len(pairs),
+        'capacity': args.capacity or None,
+        'raw': {'keys': len({raw for raw, _ in pairs}), 'hits': raw_hits,
+                'hit_ratio': round(raw_hits / len(pairs), 4)},
+        'canonical': {'keys': len({canonical for _, canonical in pairs}), 'hits': canonical_hits,
+                      'hit_ratio': round(canonical_hits / len(pairs), 4)},
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    print(f"{report['requests']} GET render requests ({report['skipped']} other lines skipped), "
+          f"capacity {args.capacity or 'unbounded'}")
+    for name in ('raw', 'canonical'):
+        row = report[name]
+        print(f"{name:>10}: {row['keys']:>7} distinct keys, {row['hits']:>7} hits, hit ratio {row['hit_ratio']:.1%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
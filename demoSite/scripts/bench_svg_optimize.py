@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Size reduction and CPU cost of the gateway's SVG optimizer on the examples.
+
+Usage:  python demoSite/scripts/bench_svg_optimize.py [--repeat 20]
+            [--svg-dir renders/] [--save renders/] [--json]
+
+Renders every bundled example (demoSite/examples) to SVG on KROKI_CORE_URL,
+bypassing the render cache, then runs optimize_svg() with each type's rule set
+(SVG_OPTIMIZE_RULES + SVG_OPTIMIZE_TYPE_RULES) and reports raw and gzip sizes
+before and after, plus the median optimize time. --save keeps the raw renders
+as <type>.svg; --svg-dir benchmarks such a directory without a Kroki core.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+
+DEMO_SITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DEMO_SITE_DIR)
+os.environ.setdefault('STATIC_ROOT', DEMO_SITE_DIR)
+os.environ.setdefault('AI_MODELS_SNAPSHOT', '')
+
+import server  # noqa: E402
+
+
+def raw_renders(svg_dir=None):
+    """{diagram type: raw svg text}, from Kroki core or a saved directory."""
+    if svg_dir:
+        return {name[:-4]: open(os.path.join(svg_dir, name), encoding='utf-8').read()
+                for name in sorted(os.listdir(svg_dir)) if name.endswith('.svg')}
+    renders = {}
+    for _, diagram_type, source in server.render_warm_sources(''):
+        try:
+            resp = server.kroki_session().post(f"{server.KROKI_CORE_URL}/{diagram_type}/svg",
+                                               data=source.encode('utf-8'), timeout=server.KROKI_TIMEOUT)
+        except server.requests.RequestException as e:
+            print(f"  SKIPPED {diagram_type}: {e}", file=sys.stderr)
+            continue
+        if resp.status_code != 200 or not resp.headers.get('Content-Type', '').startswith('image/svg+xml'):
+            print(f"  SKIPPED {diagram_type}: HTTP {resp.status_code}", file=sys.stderr)
+            continue
+        renders[diagram_type] = resp.content.decode('utf-8')
+    return renders
+
+
+def measure(diagram_type, svg, repeat):
+    rules = {**server.SVG_OPTIMIZE_RULES, **server.SVG_OPTIMIZE_TYPE_RULES.get(diagram_type, {})}
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        optimized = server.optimize_svg(svg, rules)
+        timings.append(time.perf_counter() - started)
+    raw, out = svg.encode('utf-8'), optimized.encode('utf-8')
+    return {
+        'bytes': len(raw),
+        'optimized': len(out),
+        'gzip': len(gzip.compress(raw)),
+        'optimized_gzip': len(gzip.compress(out)),
+        'ms': round(statistics.median(timings) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=20, help='optimize runs per render (median is reported)')
+    parser.add_argument('--svg-dir', default=None, help='benchmark saved <type>.svg files instead of rendering')
+    parser.add_argument('--save', default=None, help='write the raw renders here as <type>.svg')
+    parser.add_argument('--json', action='store_true', help='print the full report as JSON')
+    args = parser.parse_args()
+
+    renders = raw_renders(args.svg_dir)
+    if not renders:
+        print(f'No SVG renders (is Kroki core reachable at {server.KROKI_CORE_URL}?)', file=sys.stderr)
+        return 2
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        for diagram_type, svg in renders.items():
+            with open(os.path.join(args.save, f'{diagram_type}.svg'), 'w', encoding='utf-8') as f:
+                f.write(svg)
+    report = {diagram_type: measure(diagram_type, svg, args.repeat) for diagram_type, svg in renders.items()}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    print(f"{'type':<16}{'bytes':>10}{'optimized':>11}{'saved':>8}{'gzip':>9}{'gz opt':>9}{'saved':>8}{'ms':>8}")
+    for diagram_type, row in report.items():
+        print(f"{diagram_type:<16}{row['bytes']:>10}{row['optimized']:>11}"
+              f"{1 - row['optimized'] / row['bytes']:>8.1%}{row['gzip']:>9}{row['optimized_gzip']:>9}"
+              f"{1 - row['optimized_gzip'] / row['gzip']:>8.1%}{row['ms']:>8.2f}")
+    total = {k: sum(row[k] for row in report.values()) for k in ('bytes', 'optimized', 'gzip', 'optimized_gzip', 'ms')}
+    print(f"\n{len(report)} renders: {total['bytes']} -> {total['optimized']} bytes "
+          f"({1 - total['optimized'] / total['bytes']:.1%} smaller, "
+          f"{1 - total['optimized_gzip'] / total['gzip']:.1%} after gzip), "
+          f"{total['ms']:.1f} ms of CPU per pass")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
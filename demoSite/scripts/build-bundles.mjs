@@ -0,0 +1,100 @@
+#!/usr/bin/env bun
+/**
+ * Production module bundles for the DocCode editor.
+ *
+ * Usage:  bun demoSite/scripts/build-bundles.mjs
+ * Output: demoSite/js/bundles/  (gitignored; built in the image, see Dockerfile)
+ *
+ * What it does:
+ *  1. Reads the <script type="module"> entries and the importmap from
+ *     index.html.
+ *  2. Bundles all entries, in document order, through one synthetic entry, so
+ *     modules evaluate in the same order as the separate script tags. Bare
+ *     specifiers resolve through the importmap to the vendored js/vendor/
+ *     files, so each vendor package is still included exactly once
+ *     (the @codemirror/state singleton). Dynamic import() targets become
+ *     lazily loaded chunks.
+ *  3. Writes content-hashed app-<hash>.js / chunk-<hash>.js files and a
+ *     manifest.json that server.py (JS_BUNDLES_ENABLED) uses to swap the
+ *     entry script tags for the single bundle.
+ *
+ * The importmap itself is left untouched: its CSP hash is pinned in
+ * setup-kroki-server.sh, and nothing in the bundles needs it.
+ */
+
+import { build } from "bun";
+import { mkdir, writeFile, rm } from "fs/promises";
+import { join, dirname, resolve, relative } from "path";
+import { fileURLToPath } from "url";
+
+const SCRIPT_DIR = dirname(fileURLToPath(import.meta.url));
+const SITE = process.env.BUNDLE_SITE ?? resolve(SCRIPT_DIR, "..");
+const OUT = join(SITE, "js", "bundles");
+const TMP = process.env.BUNDLE_TMP ?? "/tmp/doccode-bundle-build";
+
+const html = await Bun.file(join(SITE, "index.html")).text();
+
+const mapMatch = html.match(/<script type="importmap">([\s\S]*?)<\/script>/);
+if (!mapMatch) {
+  console.error("ERROR: importmap not found in index.html");
+  process.exit(1);
+}
+const imports = JSON.parse(mapMatch[1]).imports ?? {};
+
+// Same pattern server.py (_MODULE_SCRIPT_RE) uses to find the entries again.
+const entries = [...html.matchAll(/<script type="module" src="\/?([^"?#]+)"/g)].map((m) => m[1]);
+if (entries.length === 0) {
+  console.error("ERROR: no <script type=\"module\"> entries in index.html");
+  process.exit(1);
+}
+
+await rm(OUT, { recursive: true, force: true });
+await mkdir(OUT, { recursive: true });
+await mkdir(TMP, { recursive: true });
+
+const entryFile = join(TMP, "app.js");
+await writeFile(
+  entryFile,
+  entries.map((path) => `import ${JSON.stringify(join(SITE, path))};\n`).join(""),
+);
+
+const escape = (s) => s.replace(/[.*+?^${}()|[\]\\\/]/g, "\\$&");
+const importmapPlugin = {
+  name: "importmap",
+  setup(builder) {
+    const filter = new RegExp(`^(${Object.keys(imports).map(escape).join("|")})$`);
+    builder.onResolve({ filter }, (args) => ({ path: join(SITE, imports[args.path]) }));
+  },
+};
+
+console.log(`Bundling ${entries.length} entry scripts...`);
+const result = await build({
+  entrypoints: [entryFile],
+  outdir: OUT,
+  format: "esm",
+  target: "browser",
+  splitting: true,
+  minify: true,
+  sourcemap: "none",
+  naming: { entry: "app-[hash].[ext]", chunk: "chunk-[hash].[ext]" },
+  plugins: [importmapPlugin],
+});
+await rm(TMP, { recursive: true, force: true });
+if (!result.success) {
+  console.error("Failed: module bundle");
+  for (const log of result.logs) console.error(log);
+  process.exit(1);
+}
+
+const files = result.outputs.map((output) => relative(SITE, output.path));
+const manifest = {
+  entry: relative(SITE, result.outputs.find((output) => output.kind === "entry-point").path),
+  replaces: entries,
+  files,
+};
+await writeFile(join(OUT, "manifest.json"), JSON.stringify(manifest, null, 2) + "\n");
+
+for (const output of result.outputs) {
+  console.log(`  OK → ${relative(SITE, output.path)} (${output.size} bytes)`);
+}
+console.log(`\nBundled ${entries.length} entries into ${files.length} files.`);
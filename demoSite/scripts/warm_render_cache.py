@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Pre-render the bundled examples (and RENDER_WARM_DIR) into the render cache.
+
+Usage:  python demoSite/scripts/warm_render_cache.py [--formats svg,png]
+            [--dir extra-sources/] [--concurrency 4] [--json]
+
+Run it inside the demosite container (or anywhere with the same
+RENDER_GATEWAY_CACHE_DIR and KROKI_CORE_URL) before switching traffic to a new
+deploy, so the first visitors never wait on a cold PlantUML JVM or Chromium
+companion. Prints cold- and warm-cache median latency per diagram type and
+exits non-zero when any render failed.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+DEMO_SITE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DEMO_SITE_DIR)
+os.environ.setdefault('STATIC_ROOT', DEMO_SITE_DIR)
+os.environ.setdefault('AI_MODELS_SNAPSHOT', '')
+
+import server  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--formats', default=','.join(server.RENDER_WARM_FORMATS))
+    parser.add_argument('--dir', default=None, help='extra sources (default: RENDER_WARM_DIR)')
+    parser.add_argument('--concurrency', type=int, default=server.RENDER_WARM_CONCURRENCY)
+    parser.add_argument('--json', action='store_true', help='print the full report as JSON')
+    args = parser.parse_args()
+
+    if server._render_cache is None:
+        print('RENDER_GATEWAY_CACHE_DIR is empty: nothing to warm', file=sys.stderr)
+        return 2
+    report = server.warm_render_cache([f for f in args.formats.split(',') if f], args.dir, args.concurrency)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'type':<16}{'renders':>8}{'cached':>8}{'cold ms':>10}{'warm ms':>10}{'errors':>8}")
+        for diagram_type, entry in report['types'].items():
+            cold = '-' if entry['cold_ms'] is None else f"{entry['cold_ms']:.1f}"
+            warm = '-' if entry['warm_ms'] is None else f"{entry['warm_ms']:.1f}"
+            print(f"{diagram_type:<16}{entry['renders']:>8}{entry['already_cached']:>8}"
+                  f"{cold:>10}{warm:>10}{len(entry['errors']):>8}")
+        for entry in report['types'].values():
+            for error in entry['errors']:
+                print(f"  FAILED {error}", file=sys.stderr)
+        print(f"\n{report['renders']} renders in {report['seconds']}s, {report['errors']} errors")
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
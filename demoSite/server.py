@@ -4,21 +4,51 @@ Kroki Demo Site Server with AI Assistant API Proxy
 Provides static file serving and AI API proxy functionality
 """
 
+import asyncio
+import atexit
+import base64
+import bisect
+import fcntl
 import fnmatch
+import functools
+import gzip
 import os
+import posixpath
 import hashlib
 import hmac
 import json
 import logging
+import math
+import mimetypes
+import re
 import secrets
+import sqlite3
 import requests
+import threading
 import time
+import zlib
 from flask import Flask, request, jsonify, send_from_directory, send_file, Response, stream_with_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits import parse_many
+from limits.storage import storage_from_string
+from limits.storage.base import Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
+from collections import OrderedDict, deque
+from concurrent import futures
 from datetime import datetime
+from urllib.parse import parse_qsl, quote, urlencode, urlparse
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it only gzip variants are precomputed.
+    brotli = None
 
 # Load environment variables from .env file
 try:
@@ -66,11 +96,135 @@ ALLOWED_ORIGINS = {
     f"https://127.0.0.1:{HTTPS_PORT}",
 }
 
+# ---------------------------------------------------------------------------
+# Shared rate-limit storage (every worker on the host counts against one store)
+# ---------------------------------------------------------------------------
+
+# Any `limits` storage URI: the default sqlite:// store below is shared by all
+# gunicorn workers on the host and survives restarts; use redis://... (needs
+# the redis package) when several replicas must share one limit, or memory://
+# for the old per-worker counters.
+RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', 'sqlite:////tmp/doccode-ratelimit.db')
+# fixed-window | sliding-window-counter | moving-window (not on sqlite://)
+RATELIMIT_STRATEGY = os.environ.get('RATELIMIT_STRATEGY', 'sliding-window-counter')
+
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """`limits` storage on a SQLite database in WAL mode, for sqlite:///<path>.
+
+    Each counter update is a single statement or one IMMEDIATE transaction, so
+    concurrent workers never over-admit; the sliding-window check and the
+    increment happen under the same write lock. Connections are per thread
+    and opened lazily, hence never shared across the gunicorn fork.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+    # Expired rows are deleted at most this often (seconds) per process.
+    PURGE_INTERVAL = 60
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        self.path = urlparse(uri).path if uri else ':memory:'
+        self._local = threading.local()
+        self._purged = 0.0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    @property
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS counters ('
+                       'key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL NOT NULL) WITHOUT ROWID')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def _incr(self, db, key, expiry, amount, now):
+        self._purge(db, now)
+        return db.execute(
+            'INSERT INTO counters (key, value, expires) VALUES (:key, :amount, :now + :expiry) '
+            'ON CONFLICT (key) DO UPDATE SET '
+            'value = CASE WHEN expires <= :now THEN :amount ELSE value + :amount END, '
+            'expires = CASE WHEN expires <= :now THEN :now + :expiry ELSE expires END '
+            'RETURNING value',
+            {'key': key, 'amount': amount, 'now': now, 'expiry': expiry}).fetchone()[0]
+
+    def _get(self, db, key, now):
+        row = db.execute('SELECT value FROM counters WHERE key = ? AND expires > ?', (key, now)).fetchone()
+        return row[0] if row else 0
+
+    def _purge(self, db, now):
+        if now - self._purged >= self.PURGE_INTERVAL:
+            self._purged = now
+            db.execute('DELETE FROM counters WHERE expires <= ?', (now,))
+
+    def incr(self, key, expiry, amount=1):
+        return self._incr(self._db, key, expiry, amount, time.time())
+
+    def decr(self, key, amount=1):
+        row = self._db.execute(
+            'UPDATE counters SET value = MAX(value - ?, 0) WHERE key = ? AND expires > ? RETURNING value',
+            (amount, key, time.time())).fetchone()
+        return row[0] if row else 0
+
+    def get(self, key):
+        return self._get(self._db, key, time.time())
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._db.execute('SELECT expires FROM counters WHERE key = ? AND expires > ?', (key, now)).fetchone()
+        return row[0] if row else now
+
+    def clear(self, key):
+        self._db.execute('DELETE FROM counters WHERE key = ?', (key,))
+
+    def check(self):
+        return self._db.execute('SELECT 1').fetchone() == (1,)
+
+    def reset(self):
+        return self._db.execute('DELETE FROM counters').rowcount
+
+    def _window(self, db, key, expiry, now):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_count = self._get(db, previous_key, now)
+        previous_ttl = 0.0 if previous_count == 0 else (1 - (((now - expiry) / expiry) % 1)) * expiry
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, self._get(db, current_key, now), current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            previous_count, previous_ttl, current_count, _ = self._window(db, key, expiry, now)
+            if math.floor(previous_count * previous_ttl / expiry + current_count) + amount > limit:
+                return False
+            self._incr(db, self.sliding_window_keys(key, expiry, now)[1], 2 * expiry, amount, now)
+            return True
+        finally:
+            db.execute('COMMIT')
+
+    def get_sliding_window(self, key, expiry):
+        return self._window(self._db, key, expiry, time.time())
+
+    def clear_sliding_window(self, key, expiry):
+        for window_key in self.sliding_window_keys(key, expiry, time.time()):
+            self.clear(window_key)
+
+
 # Restrict CORS to the allowlist (was wildcard); trust one proxy hop so the rate
 # limiter keys on the real client IP (nginx sets X-Forwarded-For).
 CORS(app, resources={r"/api/*": {"origins": list(ALLOWED_ORIGINS)}})
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
-limiter = Limiter(get_remote_address, app=app, default_limits=[])
+limiter = Limiter(get_remote_address, app=app, default_limits=[],
+                  storage_uri=RATELIMIT_STORAGE_URI, strategy=RATELIMIT_STRATEGY)
 
 AI_TIMEOUT = 60  # Default timeout for AI API requests
 AI_TIMEOUT_MAX = int(os.environ.get('AI_TIMEOUT_MAX', 300))  # Hard ceiling for client-requested timeouts
@@ -100,6 +254,11 @@ SESSION_COOKIE_NAME = 'doccode_session'
 # header and the session cookie alone is no longer sufficient.
 AI_ACCESS_TOKEN = os.environ.get('AI_ACCESS_TOKEN', '')
 
+# Bearer token for the operator endpoints (/api/stats, ...). nginx never routes
+# them, so they are only reachable on the compose network; set this to require
+# "Authorization: Bearer <token>" there as well.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
 # AI Configuration (Always uses proxy - LiteLLM, OpenRouter, etc.)
 AI_PROXY_URL = os.environ.get("AI_PROXY_URL", "https://openrouter.ai/api/v1")
 AI_PROXY_API_KEY = os.environ.get('AI_PROXY_API_KEY', '')
@@ -114,6 +273,196 @@ DEFAULT_AI_CONFIG = {
     'enabled': os.environ.get('AI_ENABLED', 'true').lower() == 'true'
 }
 
+# ---------------------------------------------------------------------------
+# Pooled keep-alive client for the AI proxy (one pool per gunicorn worker)
+# ---------------------------------------------------------------------------
+
+# Max keep-alive connections kept per worker; size it to GUNICORN_THREADS so
+# every thread can hold a warm socket. Extra concurrent calls still go through
+# on throwaway connections (the pool never blocks).
+AI_POOL_SIZE = int(os.environ.get('AI_POOL_SIZE', 8))
+# Connections opened (TCP + TLS, no request sent) when a worker starts.
+AI_POOL_WARM = int(os.environ.get('AI_POOL_WARM', 2))
+# Pooled sockets idle longer than this are closed instead of reused: most
+# proxies/CDNs drop idle keep-alives after ~60-90s, and a reused half-closed
+# socket costs a failed request plus a reconnect.
+AI_POOL_IDLE_TIMEOUT = float(os.environ.get('AI_POOL_IDLE_TIMEOUT', 50))
+
+UPSTREAM_POOL_COUNTERS = ('checkouts', 'reused', 'new_connections', 'idle_evictions')
+
+_upstream_pool_lock = threading.Lock()
+_upstream_pool = {
+    'pid': None,
+    'session': None,
+    'started': time.time(),
+    'counters': dict.fromkeys(UPSTREAM_POOL_COUNTERS, 0),
+}
+
+
+def _count_pool_event(name):
+    with _upstream_pool_lock:
+        _upstream_pool['counters'][name] += 1
+
+
+class _KeepAlivePoolMixin:
+    """urllib3 pool hooks: evict stale idle sockets and count reuse.
+
+    _get_conn/_put_conn are private urllib3 API, hence the minor-version pin
+    in requirements.txt.
+    """
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        _count_pool_event('checkouts')
+        if getattr(conn, 'sock', None) is not None:
+            idle = time.monotonic() - getattr(conn, 'doccode_last_used', 0.0)
+            if idle > AI_POOL_IDLE_TIMEOUT:
+                conn.close()
+                _count_pool_event('idle_evictions')
+        # A checked-out connection without a socket connects on first use.
+        if getattr(conn, 'sock', None) is None:
+            _count_pool_event('new_connections')
+        else:
+            _count_pool_event('reused')
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.doccode_last_used = time.monotonic()
+        super()._put_conn(conn)
+
+
+_connect_timing = threading.local()
+
+
+class _TimedConnectMixin:
+    """urllib3 connection hook: time TCP + TLS setup for this thread's stream timer."""
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_timing.seconds = time.perf_counter() - started
+
+
+class _TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    pass
+
+
+class _KeepAliveHTTPPool(_KeepAlivePoolMixin, HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _KeepAliveHTTPSPool(_KeepAlivePoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+def take_connect_time():
+    """Seconds this thread spent opening a proxy connection since the last
+    call, or None if it only reused pooled ones."""
+    seconds = getattr(_connect_timing, 'seconds', None)
+    _connect_timing.seconds = None
+    return seconds
+
+
+class _UpstreamHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _KeepAliveHTTPPool,
+            'https': _KeepAliveHTTPSPool,
+        }
+
+
+def upstream_session():
+    """Return this worker's pooled requests.Session for the AI proxy.
+
+    gunicorn imports the app in the master (preload_app) and then forks, so a
+    session created before the fork would hand the same sockets to every
+    worker. The pool is therefore keyed on the PID and rebuilt lazily in each
+    child; the master's import-time model fetch never leaks into a worker.
+    """
+    pid = os.getpid()
+    if _upstream_pool['pid'] == pid:
+        return _upstream_pool['session']
+    with _upstream_pool_lock:
+        if _upstream_pool['pid'] != pid:
+            session = requests.Session()
+            adapter = _UpstreamHTTPAdapter(pool_connections=2, pool_maxsize=AI_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _upstream_pool.update(
+                session=session,
+                started=time.time(),
+                counters=dict.fromkeys(UPSTREAM_POOL_COUNTERS, 0),
+            )
+            _upstream_pool['pid'] = pid
+        return _upstream_pool['session']
+
+
+def _warm_upstream_pool(session, count):
+    """Open `count` keep-alive connections to the proxy and park them in the pool."""
+    url = AI_PROXY_URL.rstrip('/') + '/'
+    try:
+        # Resolve verify/proxies exactly as a real request would (REQUESTS_CA_BUNDLE
+        # etc. change the urllib3 pool key), or the warmed pool is never used.
+        settings = session.merge_environment_settings(url, {}, None, None, None)
+        pool = session.get_adapter(url).get_connection_with_tls_context(
+            requests.Request('GET', url).prepare(), settings['verify'],
+            proxies=settings['proxies'], cert=settings['cert'])
+    except Exception as e:
+        logger.warning(f"AI proxy pool warm-up skipped: {e}")
+        return
+    conns = []
+    try:
+        for _ in range(count):
+            conn = pool._get_conn()
+            conns.append(conn)
+            if conn.sock is None:
+                conn.connect()
+        logger.info(f"Warmed {len(conns)} AI proxy connection(s) in worker {os.getpid()}")
+    except Exception as e:
+        logger.warning(f"AI proxy pool warm-up failed: {e}")
+    finally:
+        for conn in conns:
+            pool._put_conn(conn)
+
+
+def init_upstream_pool():
+    """Create the worker's proxy pool and warm it in the background.
+
+    Called from gunicorn's post_worker_init hook (after the fork). Warm-up runs
+    on a daemon thread so an unreachable proxy never delays worker boot.
+    """
+    session = upstream_session()
+    count = min(AI_POOL_WARM, AI_POOL_SIZE)
+    if AI_MODE != 'relay' or count <= 0:
+        return
+    threading.Thread(target=_warm_upstream_pool, args=(session, count),
+                     name='ai-pool-warm', daemon=True).start()
+
+
+def upstream_pool_stats():
+    """Counters for this worker's proxy pool (reuse, connect rate, evictions)."""
+    with _upstream_pool_lock:
+        counters = dict(_upstream_pool['counters'])
+        uptime = max(time.time() - _upstream_pool['started'], 1e-6)
+    checkouts = counters['checkouts']
+    return {
+        **counters,
+        'reuse_ratio': round(counters['reused'] / checkouts, 3) if checkouts else None,
+        'new_connections_per_min': round(counters['new_connections'] * 60 / uptime, 3),
+        'pool_size': AI_POOL_SIZE,
+        'idle_timeout_s': AI_POOL_IDLE_TIMEOUT,
+        'uptime_s': round(uptime, 1),
+    }
+
+
 # ---------------------------------------------------------------------------
 # AI mode computation (no PUBLIC_MODE; superseded by user directive)
 # ---------------------------------------------------------------------------
@@ -140,7 +489,8 @@ AI_MODE = compute_ai_mode(DEFAULT_AI_CONFIG['enabled'], bool(AI_PROXY_API_KEY))
 
 # Comma-separated glob patterns; empty = allow all (current behavior).
 AI_MODEL_ALLOWLIST = [p.strip() for p in os.environ.get('AI_MODEL_ALLOWLIST', '').split(',') if p.strip()]
-# Ordered fallback models tried at startup when AI_MODEL is filtered/absent.
+# Ordered fallback models tried at startup when AI_MODEL is filtered/absent,
+# and at runtime while a model's circuit breaker is open.
 AI_MODEL_FALLBACKS = [m.strip() for m in os.environ.get('AI_MODEL_FALLBACKS', '').split(',') if m.strip()]
 
 # ---------------------------------------------------------------------------
@@ -193,24 +543,70 @@ def load_available_models():
         return apply_model_allowlist(fallback)
 
 
+@functools.lru_cache(maxsize=8)
+def _compile_allowlist(patterns):
+    """One regex matching any of the glob patterns (fnmatch semantics)."""
+    return re.compile('|'.join(f'(?:{fnmatch.translate(pat)})' for pat in patterns))
+
+
 def apply_model_allowlist(grouped):
     """Filter the {provider: {model_id: info}} dict by allowlist globs.
 
     Empty list = allow all (current behavior).
     This is the SINGLE filter point that secures both the UI list and the relay
-    (both read AVAILABLE_MODELS).
+    (both read MODEL_REGISTRY, which is built from its output).
     """
     if not AI_MODEL_ALLOWLIST:
         return grouped
+    match = _compile_allowlist(tuple(AI_MODEL_ALLOWLIST)).match
     out = {}
     for provider, models in grouped.items():
-        kept = {mid: info for mid, info in models.items()
-                if any(fnmatch.fnmatch(mid, pat) for pat in AI_MODEL_ALLOWLIST)}
+        kept = {mid: info for mid, info in models.items() if match(mid)}
         if kept:
             out[provider] = kept
     return out
 
 
+class ModelRegistry:
+    """Immutable, indexed snapshot of one model catalog version.
+
+    Built once whenever the catalog changes (boot, background refresh) and
+    swapped in as a whole, so a request that reads MODEL_REGISTRY once sees a
+    single consistent catalog. Never mutate it or the dicts it returns.
+    """
+
+    __slots__ = ('grouped', 'ids', 'version', 'etag', '_by_id', '_provider_of')
+
+    def __init__(self, grouped):
+        self.grouped = {provider: dict(models) for provider, models in grouped.items()}
+        self._by_id = {}
+        self._provider_of = {}
+        for provider, models in self.grouped.items():
+            for model_id, info in models.items():
+                self._by_id[model_id] = info
+                self._provider_of[model_id] = provider
+        self.ids = tuple(self._by_id)
+        canonical = json.dumps(self.grouped, sort_keys=True, separators=(',', ':'))
+        self.version = hashlib.sha256(canonical.encode()).hexdigest()[:16]
+        self.etag = f'"{self.version}"'
+
+    def __contains__(self, model_id):
+        return model_id in self._by_id
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def get(self, model_id):
+        """Model metadata, or None if the model is not in the catalog."""
+        return self._by_id.get(model_id)
+
+    def provider(self, model_id):
+        return self._provider_of.get(model_id)
+
+    def models_for(self, provider):
+        return self.grouped.get(provider, {})
+
+
 # Known non-chat model keywords to filter out
 NON_CHAT_MODEL_KEYWORDS = ['embedding', 'embed', 'tts', 'whisper', 'dall-e', 'moderation']
 
@@ -275,7 +671,7 @@ def build_ai_payload(model, messages, data):
     return payload
 
 def fetch_models_from_proxy():
-    """Fetch available models from the LiteLLM proxy /models endpoint at startup.
+    """Fetch available models from the LiteLLM proxy /models endpoint.
 
     Returns a dict grouped by provider prefix in the same shape as ai-models.json,
     filtered through the allowlist, or None if the proxy is unreachable.
@@ -292,7 +688,7 @@ def fetch_models_from_proxy():
 
     try:
         logger.info(f"Fetching model list from proxy: {models_url}")
-        response = requests.get(models_url, headers=headers, timeout=10)
+        response = upstream_session().get(models_url, headers=headers, timeout=10)
         response.raise_for_status()
 
         model_list = response.json().get('data', [])
@@ -349,19 +745,123 @@ def fetch_models_from_proxy():
 BOLD_RED = '\033[1;31m'
 RESET = '\033[0m'
 
-# Try proxy first, fall back to static JSON (only in relay mode)
+# ---------------------------------------------------------------------------
+# Model catalog: instant boot from a snapshot, background refresh from the proxy
+# ---------------------------------------------------------------------------
+
+# Last catalog fetched from the proxy, reloaded at import so boot never waits on
+# the proxy. Empty = no snapshot (boot from ai-models.json until the first refresh).
+AI_MODELS_SNAPSHOT = os.environ.get('AI_MODELS_SNAPSHOT', '/tmp/doccode-ai-models.json')
+# Seconds between background refreshes per worker; 0 = refresh once at start only.
+AI_MODELS_REFRESH_INTERVAL = int(os.environ.get('AI_MODELS_REFRESH_INTERVAL', 600))
+
+_model_catalog_lock = threading.Lock()
+_model_catalog = {'source': None, 'updated': None, 'refreshes': 0, 'failures': 0, 'refresher_pid': None}
+
+
+def load_models_snapshot():
+    """Return the snapshotted catalog (allowlist re-applied), or None."""
+    if not AI_MODELS_SNAPSHOT:
+        return None
+    try:
+        with open(AI_MODELS_SNAPSHOT, 'r') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable model snapshot {AI_MODELS_SNAPSHOT}: {e}")
+        return None
+    models = apply_model_allowlist(snapshot.get('models') or {})
+    if models:
+        with _model_catalog_lock:
+            _model_catalog['updated'] = snapshot.get('saved_at')
+    return models or None
+
+
+def save_models_snapshot(models):
+    """Persist the catalog atomically (write a temp file, then rename over)."""
+    if not AI_MODELS_SNAPSHOT:
+        return
+    tmp_path = f"{AI_MODELS_SNAPSHOT}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'saved_at': datetime.utcnow().isoformat(), 'models': models}, f)
+        os.replace(tmp_path, AI_MODELS_SNAPSHOT)
+    except OSError as e:
+        logger.warning(f"Could not write model snapshot {AI_MODELS_SNAPSHOT}: {e}")
+
+
+def refresh_available_models():
+    """Fetch the proxy catalog once and swap it in. Returns True on success.
+
+    MODEL_REGISTRY is rebound, never mutated, so a request holding the old
+    registry keeps a consistent view while the new one takes over.
+    """
+    global MODEL_REGISTRY
+    models = fetch_models_from_proxy()
+    if not models:
+        with _model_catalog_lock:
+            _model_catalog['failures'] += 1
+            source = _model_catalog['source']
+        logger.warning(f"Failed to fetch models from LLM proxy; keeping the current model list ({source})")
+        return False
+    MODEL_REGISTRY = ModelRegistry(models)
+    with _model_catalog_lock:
+        _model_catalog.update(source='proxy', updated=datetime.utcnow().isoformat())
+        _model_catalog['refreshes'] += 1
+    _resolve_startup_model()
+    save_models_snapshot(models)
+    return True
+
+
+def _model_refresh_loop():
+    while True:
+        refresh_available_models()
+        if AI_MODELS_REFRESH_INTERVAL <= 0:
+            return
+        time.sleep(AI_MODELS_REFRESH_INTERVAL)
+
+
+def start_model_refresh():
+    """Start this process's background catalog refresher (call after the fork)."""
+    with _model_catalog_lock:
+        if AI_MODE != 'relay' or _model_catalog['refresher_pid'] == os.getpid():
+            return
+        _model_catalog['refresher_pid'] = os.getpid()
+    threading.Thread(target=_model_refresh_loop, name='model-catalog-refresh', daemon=True).start()
+
+
+def model_catalog_stats():
+    with _model_catalog_lock:
+        catalog = dict(_model_catalog)
+    registry = MODEL_REGISTRY
+    return {
+        'source': catalog['source'],
+        'updated': catalog['updated'],
+        'models': len(registry),
+        'version': registry.version,
+        'refresh_interval': AI_MODELS_REFRESH_INTERVAL,
+        'refreshes': catalog['refreshes'],
+        'failures': catalog['failures'],
+    }
+
+
+# Boot from the snapshot, else the static JSON (only in relay mode); the proxy
+# is only ever contacted by the background refresher.
 if AI_MODE != 'relay':
-    AVAILABLE_MODELS = {}
+    MODEL_REGISTRY = ModelRegistry({})
     logger.info(f"AI mode '{AI_MODE}': relay disabled, skipping proxy model fetch")
 else:
-    _proxy_models = fetch_models_from_proxy()
-    if _proxy_models:
-        AVAILABLE_MODELS = _proxy_models
-        logger.info("Using model list from LLM proxy")
+    _snapshot_models = load_models_snapshot()
+    if _snapshot_models:
+        MODEL_REGISTRY = ModelRegistry(_snapshot_models)
+        _model_catalog['source'] = 'snapshot'
+        logger.info(f"Using model list snapshot from {AI_MODELS_SNAPSHOT}; refreshing from the LLM proxy in the background")
     else:
-        AVAILABLE_MODELS = load_available_models()
-        print(f"{BOLD_RED}WARNING: Failed to fetch models from LLM proxy. Using static fallback (ai-models.json).{RESET}")
-        logger.warning("Failed to fetch models from LLM proxy. Using static fallback (ai-models.json).")
+        MODEL_REGISTRY = ModelRegistry(load_available_models())
+        _model_catalog['source'] = 'static'
+        print(f"{BOLD_RED}WARNING: No model snapshot yet. Using static fallback (ai-models.json) until the LLM proxy answers.{RESET}")
+        logger.warning("No model snapshot yet. Using static fallback (ai-models.json) until the LLM proxy answers.")
 
 # ---------------------------------------------------------------------------
 # Startup fallback walk: heal AI_MODEL if it was filtered out / absent
@@ -369,26 +869,26 @@ else:
 
 def _resolve_startup_model():
     """Walk AI_MODEL_FALLBACKS at startup if the configured AI_MODEL is not in
-    AVAILABLE_MODELS. Logs loudly which model wins. Updates DEFAULT_AI_CONFIG in place.
+    MODEL_REGISTRY. Logs loudly which model wins. Updates DEFAULT_AI_CONFIG in place.
     """
     if AI_MODE != 'relay':
         return  # no relay, no model to validate
 
-    all_model_ids = [mid for pm in AVAILABLE_MODELS.values() for mid in pm]
+    registry = MODEL_REGISTRY
     current = DEFAULT_AI_CONFIG['model']
 
-    if current in all_model_ids:
+    if current in registry:
         return  # happy path
 
     logger.warning(f"AI_MODEL '{current}' is absent from the filtered model list.")
     for candidate in AI_MODEL_FALLBACKS:
-        if candidate in all_model_ids:
+        if candidate in registry:
             logger.warning(f"AI startup fallback: '{current}' not available; using '{candidate}' instead.")
             DEFAULT_AI_CONFIG['model'] = candidate
             return
 
-    if all_model_ids:
-        winner = all_model_ids[0]
+    if registry.ids:
+        winner = registry.ids[0]
         logger.warning(f"AI startup fallback: no fallback matched; using first available model '{winner}'.")
         DEFAULT_AI_CONFIG['model'] = winner
     else:
@@ -431,6 +931,81 @@ Code that failed to render:
 Renderer error:
 {{validationError}}''')
 
+# ---------------------------------------------------------------------------
+# Pre-serialized, precompressed, ETagged bodies for read-only endpoints
+# ---------------------------------------------------------------------------
+
+# Bodies smaller than this are sent as-is: compressing them saves nothing.
+COMPRESS_MIN_BYTES = 512
+
+
+class PrecompressedBody:
+    """One immutable response body with its gzip/brotli variants built up front.
+
+    The strong ETag is a content hash; each encoding gets its own tag suffix
+    because the bytes on the wire differ, and any of them revalidates.
+    """
+
+    def __init__(self, body, mimetype, encoded=None, gzip_level=9, brotli_quality=11, compress=True):
+        """`encoded` may supply ready-made {'gzip': ..., 'br': ...} bytes (e.g.
+        build-time sidecar files); missing variants are compressed here unless
+        `compress` is False (already-compressed formats such as images)."""
+        self.body = body
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': body}
+        encoded = encoded or {}
+        if compress and len(body) >= COMPRESS_MIN_BYTES:
+            compressed = encoded.get('gzip') or gzip.compress(body, gzip_level, mtime=0)
+            if len(compressed) < len(body):
+                self.variants['gzip'] = compressed
+            if 'br' in encoded or brotli is not None:
+                compressed = encoded.get('br') or brotli.compress(body, quality=brotli_quality)
+                if len(compressed) < len(body):
+                    self.variants['br'] = compressed
+
+    def etag(self, encoding='identity'):
+        return self.digest if encoding == 'identity' else f'{self.digest}-{encoding}'
+
+    def negotiate(self, accept_encodings):
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+    def response(self, request, cache_control='no-cache'):
+        """Flask response for `request`: 304 on a matching If-None-Match, else the
+        best variant the client accepts."""
+        encoding = self.negotiate(request.accept_encodings)
+        headers = {
+            'ETag': f'"{self.etag(encoding)}"',
+            'Cache-Control': cache_control,
+            'Vary': 'Accept-Encoding',
+        }
+        if any(request.if_none_match.contains(self.etag(e)) for e in self.variants):
+            return Response(status=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(self.variants[encoding], mimetype=self.mimetype, headers=headers)
+
+
+_prepared_json = {}
+
+
+def prepared_json(name, version, build):
+    """PrecompressedBody of build()'s JSON, rebuilt only when `version` changes.
+
+    `version` is a hashable summary of everything the payload depends on
+    (mode, default model, catalog version, ...); build() runs once per version.
+    """
+    cached = _prepared_json.get(name)
+    if cached is None or cached[0] != version:
+        body = app.json.response(build()).get_data()
+        cached = (version, PrecompressedBody(body, 'application/json'))
+        _prepared_json[name] = cached
+    return cached[1]
+
+
 @app.route('/api/ai-prompts', methods=['GET'])
 def get_ai_prompts():
     """Get default AI prompt templates — un-gated in all modes (BYOK clients need it)"""
@@ -438,11 +1013,11 @@ def get_ai_prompts():
         if not validate_origin(request):
             return jsonify({'error': 'Unauthorized origin'}), 403
 
-        return jsonify({
+        return prepared_json('ai-prompts', (), lambda: {
             'system': DEFAULT_SYSTEM_PROMPT,
             'user': DEFAULT_USER_PROMPT,
             'retry': DEFAULT_RETRY_PROMPT
-        })
+        }).response(request)
 
     except Exception as e:
         logger.error(f"Error getting AI prompts: {str(e)}")
@@ -457,21 +1032,24 @@ def get_available_models():
 
         if AI_MODE != 'relay':
             # Do not leak proxy URL or name in non-relay modes
-            return jsonify({
+            return prepared_json('available-models', (AI_MODE,), lambda: {
                 'mode': AI_MODE,
                 'models': {},
                 'proxy_url': None,
                 'proxy_name': None,
                 'default_model': None,
-            })
+            }).response(request)
 
-        return jsonify({
+        registry = MODEL_REGISTRY
+        default_model = DEFAULT_AI_CONFIG['model']
+        version = (AI_MODE, registry.version, default_model, AI_PROXY_URL, AI_PROXY_NAME)
+        return prepared_json('available-models', version, lambda: {
             'mode': 'relay',
-            'models': AVAILABLE_MODELS,
+            'models': registry.grouped,
             'proxy_url': AI_PROXY_URL,
             'proxy_name': AI_PROXY_NAME,
-            'default_model': DEFAULT_AI_CONFIG['model']
-        })
+            'default_model': default_model
+        }).response(request)
 
     except Exception as e:
         logger.error(f"Error getting available models: {str(e)}")
@@ -490,20 +1068,15 @@ def validate_model():
         if not model_name:
             return jsonify({'error': 'Model name is required'}), 400
 
-        # Build a flat list of all allowed models from the JSON configuration
-        allowed_models = {}
-        for provider_models in AVAILABLE_MODELS.values():
-            allowed_models.update(provider_models)
-
         # Check if the requested model is in our allowed list
-        if model_name not in allowed_models:
+        model_info = MODEL_REGISTRY.get(model_name)
+        if model_info is None:
             logger.warning(f"Model validation failed for '{model_name}' - not in allowed models list. Request from: {request.remote_addr}")
             return jsonify({
                 'valid': False,
                 'error': f'Model "{model_name}" is not supported. Please select from available models.'
             }), 400
 
-        model_info = allowed_models[model_name]
         logger.info(f"Model validation successful for '{model_name}'")
 
         # Return model as valid since it's in the JSON (no proxy validation)
@@ -559,6 +1132,20 @@ def validate_session_token(token):
     return hmac.compare_digest(signature, _sign_session(nonce))
 
 
+def check_admin_access(request, token=None):
+    """(body, status) if an operator endpoint must refuse the request, else None.
+
+    `token` defaults to ADMIN_TOKEN; an empty token leaves the endpoint open to
+    whoever can reach the container (nginx does not proxy it).
+    """
+    if not validate_origin(request):
+        return {'error': 'Unauthorized origin'}, 403
+    token = ADMIN_TOKEN if token is None else token
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return {'error': 'Unauthorized'}, 401
+    return None
+
+
 def authorize_ai_request(request):
     """Authenticate a request to the AI relay.
 
@@ -579,271 +1166,3116 @@ def ratelimit_handler(e):
     # Distinguish per-IP quota trips from generic rate limits
     description = str(getattr(e, 'description', '') or '')
     if 'per_ip_quota' in description or (AI_DAILY_LIMIT_PER_IP and 'day' in description.lower()):
+        rejections.inc(('per_ip_quota',))
         return jsonify({'error': PER_IP_COPY, 'code': 'per_ip_quota'}), 429
+    rejections.inc(('rate_limit',))
     return jsonify({'error': 'Rate limit exceeded. Please wait before sending another request.'}), 429
 
 
-def _per_ip_limit():
-    """Return the per-IP daily limit string, or a harmless fallback."""
-    return AI_DAILY_LIMIT_PER_IP or '1000000/day'
-
+# ---------------------------------------------------------------------------
+# Prometheus metrics (/metrics), aggregated across gunicorn workers
+# ---------------------------------------------------------------------------
 
-@app.route('/api/ai-assist', methods=['POST'])
-@limiter.limit("10/minute")
-@limiter.limit(_per_ip_limit, error_message='per_ip_quota',
-               exempt_when=lambda: not AI_DAILY_LIMIT_PER_IP)
-def ai_assist():
-    """AI Assistant API proxy endpoint"""
-    try:
-        # Security checks: browsers always send Origin on POST, so require it,
-        # and demand a session cookie (or the shared access token) so the relay
-        # cannot be driven by arbitrary network clients on the server's key.
-        if not validate_origin(request, require=True):
-            return jsonify({'error': 'Unauthorized origin'}), 403
+# Every worker counts into its own in-process registry (per-thread shards, no
+# lock and no I/O per update) and a writer thread publishes a snapshot to
+# METRICS_DIR/<pid>.json every METRICS_FLUSH_INTERVAL seconds. /metrics merges
+# the serving worker's live values with the other workers' snapshots: counters
+# and histograms are summed over every snapshot, including those of workers
+# that have exited (so totals never go backwards when gunicorn recycles a
+# worker); gauges only over workers that are still running. The gunicorn
+# master empties the directory once per boot (on_starting in gunicorn.conf.py);
+# importing this module never touches it, so scripts can import server safely.
+# Empty METRICS_DIR = this process only.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_DIR = os.environ.get('METRICS_DIR', '/tmp/doccode-metrics')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+# Optional bearer token for scrapers (default ADMIN_TOKEN); nginx does not
+# route /metrics at all.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_PREFIX = 'doccode_'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metric:
+    """One counter, gauge or histogram family; values keyed by a label tuple.
+
+    Each thread updates its own shard, so an update is a thread-local lookup
+    and a dict write with no lock; snapshot() merges the shards (dict.copy()
+    is atomic under the GIL).
+    """
 
-        # Mode gate: must be relay before auth (503 exposes mode to the client
-        # so the frontend can guide BYOK instead of chasing a phantom auth error).
-        if AI_MODE != 'relay':
-            return jsonify({
-                'error': ('The AI relay is disabled on this server. Add your own '
-                          'OpenAI-compatible endpoint and API key in Settings → AI Assistant.'),
-                'mode': AI_MODE,
-            }), 503
+    def __init__(self, name, kind, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = METRICS_PREFIX + name
+        self.kind = kind
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.fixed = {}  # set() values, outside the shards
+        self._local = threading.local()
+        self._shards = []
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            self._shards.append(values)
+            return values
+
+    def inc(self, labels=(), amount=1):
+        values = self._shard()
+        values[labels] = values.get(labels, 0) + amount
+
+    def set(self, value, labels=()):
+        self.fixed[labels] = value
+
+    def observe(self, value, labels=()):
+        values = self._shard()
+        counts = values.get(labels)
+        if counts is None:
+            counts = values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def snapshot(self):
+        merged = dict(self.fixed)
+        for shard in list(self._shards):
+            for labels, value in shard.copy().items():
+                if self.kind == 'histogram':
+                    current = merged.get(labels)
+                    merged[labels] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    merged[labels] = merged.get(labels, 0) + value
+        return [[list(labels), value] for labels, value in merged.items()]
+
+
+class MetricsRegistry:
+    """This process's metrics plus the snapshot files of its sibling workers."""
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self.metrics = {}
+        self._writer_pid = None
+
+    def add(self, name, kind, doc, labels=(), **kwargs):
+        metric = self.metrics[METRICS_PREFIX + name] = Metric(name, kind, doc, labels, **kwargs)
+        return metric
+
+    def reset_directory(self):
+        """Drop every snapshot left by a previous boot (gunicorn master only)."""
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    os.unlink(os.path.join(self.directory, name))
+        except OSError as e:
+            logger.warning(f"Could not reset metrics directory {self.directory}: {e}")
+
+    def start(self):
+        """Start this process's snapshot writer (after the fork; once per pid)."""
+        if not self.directory or self._writer_pid == os.getpid():
+            return
+        self._writer_pid = os.getpid()
+        threading.Thread(target=self._run, name='metrics-writer', daemon=True).start()
 
-        if not authorize_ai_request(request):
-            return jsonify({'error': 'Unauthorized. Please reload the page and try again.'}), 401
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
 
-        # Check request size
-        if request.content_length and request.content_length > MAX_REQUEST_SIZE:
-            return jsonify({'error': 'Request too large'}), 413
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
 
-        # Parse request data
+    def flush(self):
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
         try:
-            data = request.get_json(force=True)
-        except Exception as e:
-            logger.error(f"Invalid JSON in request: {e}")
-            return jsonify({'error': 'Invalid JSON'}), 400
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f, separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics snapshot {path}: {e}")
+
+    def _sibling_snapshots(self):
+        """[(alive, snapshot)] for every other process's snapshot file."""
+        if not self.directory:
+            return []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        snapshots = []
+        for name in names:
+            pid, _, ext = name.partition('.')
+            if ext != 'json' or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # replaced mid-read or half-written by a killed worker
+            try:
+                os.kill(int(pid), 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+            snapshots.append((alive, snapshot))
+        return snapshots
+
+    def collect(self):
+        """{name: {label tuple: merged value}} over all workers."""
+        merged = {name: {} for name in self.metrics}
+        sources = [(True, self.snapshot())] + self._sibling_snapshots()
+        for alive, snapshot in sources:
+            for name, series in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                values = merged[name]
+                for labels, value in series:
+                    labels = tuple(labels)
+                    if metric.kind == 'histogram':
+                        current = values.get(labels)
+                        if current is None:
+                            values[labels] = list(value)
+                        elif len(current) == len(value):
+                            values[labels] = [a + b for a, b in zip(current, value)]
+                    else:
+                        values[labels] = values.get(labels, 0) + value
+        return merged
+
+    def exposition(self):
+        """Prometheus text format (version 0.0.4)."""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.doc}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for labels, value in sorted(values.items()):
+                pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(metric.labels, labels)]
+                if metric.kind != 'histogram':
+                    lines.append(f"{name}{_label_set(pairs)} {_format_sample(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip((*metric.buckets, '+Inf'), value[:-1]):
+                    cumulative += count
+                    le = 'le="%s"' % (bound if bound == '+Inf' else _format_sample(bound))
+                    lines.append(f"{name}_bucket{_label_set(pairs + [le])} {cumulative}")
+                lines.append(f"{name}_sum{_label_set(pairs)} {_format_sample(value[-1])}")
+                lines.append(f"{name}_count{_label_set(pairs)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_set(pairs):
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_sample(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry(METRICS_DIR if METRICS_ENABLED else '', METRICS_FLUSH_INTERVAL)
+http_requests = metrics.add('http_requests_total', 'counter',
+                            'HTTP requests by route template, method and status.', ('route', 'method', 'status'))
+http_duration = metrics.add('http_request_duration_seconds', 'histogram',
+                            'Time until the response body was fully sent, by route template.', ('route',))
+http_in_flight = metrics.add('http_requests_in_flight', 'gauge',
+                             'Requests holding a worker thread right now (streams included).')
+http_threads = metrics.add('http_worker_threads', 'gauge', 'Request threads per worker, summed over workers.')
+ai_upstream_responses = metrics.add('ai_upstream_responses_total', 'counter',
+                                    'AI upstream replies by model and HTTP status ("error" = no reply).',
+                                    ('model', 'status'))
+ai_upstream_latency = metrics.add('ai_upstream_latency_seconds', 'histogram',
+                                  'Time until the AI upstream answered (headers, for streams).', ('model',))
+ai_relay_bytes = metrics.add('ai_relay_bytes_total', 'counter',
+                             'Response bytes relayed from the AI upstream to clients.', ('mode',))
+ai_active_streams = metrics.add('ai_active_streams', 'gauge', 'AI streams currently being relayed.')
+rejections = metrics.add('rejections_total', 'counter',
+                         'Requests turned away, by reason (rate_limit, per_ip_quota, token_budget, '
+                         'ai_busy, render_busy, batch_quota).', ('reason',))
+http_threads.set(int(os.environ.get('GUNICORN_THREADS') or 1))
+
+
+class RequestMetrics:
+    """WSGI middleware: request count, full duration and in-flight gauge.
+
+    Wraps the response iterable, so a streamed reply counts until its last
+    byte and holds its thread in http_requests_in_flight meanwhile.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
 
-        # H6: Belt-and-suspenders — pop client-supplied key/endpoint so they
-        # can never appear in any log entry, even if logging expands later.
-        if isinstance(data, dict) and isinstance(data.get('config'), dict):
-            data['config'].pop('api_key', None)
-            data['config'].pop('endpoint', None)
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        status = ['500']
 
-        if not data or 'messages' not in data:
-            return jsonify({'error': 'Missing messages in request'}), 400
+        def observing_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line[:3]
+            return start_response(status_line, headers, exc_info)
 
-        # Extract configuration from request or use defaults
-        config = data.get('config', {})
-        model = data.get('model', DEFAULT_AI_CONFIG['model'])  # Get model from top-level, not from config
+        def finish():
+            http_in_flight.inc(amount=-1)
+            route = environ.get('doccode.route', 'unmatched')
+            http_requests.inc((route, environ.get('REQUEST_METHOD', ''), status[0]))
+            http_duration.observe(time.perf_counter() - started, (route,))
 
-        # Client-supplied timeout must be numeric and is clamped so a request
-        # cannot pin server threads on arbitrarily long upstream connections.
+        http_in_flight.inc()
         try:
-            timeout = float(config.get('timeout', DEFAULT_AI_CONFIG['timeout']))
-        except (TypeError, ValueError):
-            return jsonify({'error': 'Invalid timeout value'}), 400
-        timeout = max(1, min(timeout, AI_TIMEOUT_MAX))
-
-        # Validate model against allowed models from JSON to prevent model injection
-        if model:
-            # Build a flat list of all allowed models from the JSON configuration
-            allowed_models = []
-            for provider_models in AVAILABLE_MODELS.values():
-                allowed_models.extend(provider_models.keys())
-
-            # Check if the requested model is in our allowed list
-            if model not in allowed_models:
-                logger.warning(f"Model injection attempt detected: '{model}' not in allowed models list. Request from: {request.remote_addr}")
-                return jsonify({'error': f'Model "{model}" is not supported. Please select from available models.'}), 400
-
-            logger.info(f"Validated model '{model}' against allowed models list")
-        else:
-            # If no model provided, use default (which should also be validated)
-            if DEFAULT_AI_CONFIG['model'] not in [model_id for provider_models in AVAILABLE_MODELS.values() for model_id in provider_models.keys()]:
-                logger.error(f"Default model '{DEFAULT_AI_CONFIG['model']}' is not in allowed models list")
-                return jsonify({'error': 'Server configuration error: default model not supported'}), 500
+            body = self.wsgi_app(environ, observing_start_response)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(body, finish)
 
-        # This endpoint ONLY ever proxies to the trusted, server-configured AI
-        # proxy. Direct/custom API endpoints are handled entirely client-side, so
-        # /api/ai-assist cannot be used as an SSRF / open relay to arbitrary URLs.
-        endpoint = f"{AI_PROXY_URL}/chat/completions"
-        api_key = AI_PROXY_API_KEY
 
-        if not api_key:
-            return jsonify({'error': 'Backend proxy API key not configured'}), 400
+@app.before_request
+def _tag_route():
+    # Route templates, not raw paths, so label cardinality stays bounded.
+    request.environ['doccode.route'] = request.url_rule.rule if request.url_rule else 'unmatched'
 
-        logger.info(f"Using backend proxy: {endpoint}")
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {api_key}'
+if METRICS_ENABLED:
+    app.wsgi_app = RequestMetrics(app.wsgi_app)
+
+
+def record_upstream(model, status, latency):
+    """Count one AI upstream reply (status None = the call itself failed)."""
+    ai_upstream_responses.inc((model or 'unknown', str(status) if status else 'error'))
+    ai_upstream_latency.observe(latency, (model or 'unknown',))
+
+
+# ---------------------------------------------------------------------------
+# AI stream timing (queue, connect, TTFB, TTFT, tokens/s, stalls)
+# ---------------------------------------------------------------------------
+
+# Every relayed stream is timestamped phase by phase: admission queue, TCP +
+# TLS connect to the proxy (new connections only), upstream headers (TTFB),
+# first content delta (TTFT), then the gap between consecutive content
+# deltas. Phases after the queue are measured from the moment the upstream
+# call is sent. One compact JSON summary per stream is logged and kept in a
+# per-model rolling window for /api/stream-timings (this worker's recent
+# streams); the same observations feed the /metrics histograms, which are
+# summed over all workers.
+AI_STREAM_STALL_SECONDS = float(os.environ.get('AI_STREAM_STALL_SECONDS', 2))  # a gap this long is a stall
+AI_STREAM_TIMING_WINDOW = int(os.environ.get('AI_STREAM_TIMING_WINDOW', 500))  # streams per model, per worker
+STREAM_PHASES = ('queue_s', 'connect_s', 'ttfb_s', 'ttft_s', 'total_s')
+TOKEN_GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320, 640)
+
+ai_stream_phases = metrics.add('ai_stream_phase_seconds', 'histogram',
+                               'Relayed AI streams: time to each phase (queue, connect, ttfb, ttft, total).',
+                               ('model', 'phase'))
+ai_stream_token_gaps = metrics.add('ai_stream_token_gap_seconds', 'histogram',
+                                   'Gaps between consecutive content deltas of relayed AI streams.', ('model',),
+                                   buckets=TOKEN_GAP_BUCKETS)
+ai_stream_token_rate = metrics.add('ai_stream_tokens_per_second', 'histogram',
+                                   'Generation speed of relayed AI streams, first to last content delta.',
+                                   ('model',), buckets=TOKEN_RATE_BUCKETS)
+ai_streams = metrics.add('ai_streams_total', 'counter',
+                         'Relayed AI streams by outcome (complete, interrupted, abandoned).', ('model', 'outcome'))
+ai_stream_stalls = metrics.add('ai_stream_stalls_total', 'counter',
+                               'Content delta gaps of at least AI_STREAM_STALL_SECONDS.', ('model',))
+
+
+def sse_delta_text(line):
+    """The content text a chat-completion SSE data line adds ('' if none)."""
+    if '"content"' not in line or not line.startswith('data:'):
+        return ''
+    try:
+        choices = json.loads(line[5:]).get('choices') or []
+        return ''.join((choice.get('delta') or {}).get('content') or '' for choice in choices)
+    except (ValueError, AttributeError, TypeError):
+        return ''
+
+
+class StreamTimer:
+    """Phase timestamps (perf_counter) of one relayed stream, leader side."""
+
+    def __init__(self, model):
+        self.model = model
+        self.arrived = time.perf_counter()
+        self.sent = None
+        self.connect = None     # seconds; None = pooled connection reused
+        self.headers = None
+        self.first = None
+        self.last = None
+        self.deltas = 0
+        self.max_gap = 0.0
+        self.stalls = 0
+        self.outcome = 'abandoned'  # until the upstream stream ends or fails
+
+    def request_sent(self):
+        self.sent = time.perf_counter()
+
+    def response_started(self, connect_seconds):
+        self.headers = time.perf_counter()
+        self.connect = connect_seconds
+
+    def line(self, line):
+        if not sse_delta_text(line):
+            return
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        else:
+            gap = now - self.last
+            ai_stream_token_gaps.observe(gap, (self.model,))
+            self.max_gap = max(self.max_gap, gap)
+            if gap >= AI_STREAM_STALL_SECONDS:
+                self.stalls += 1
+        self.last = now
+        self.deltas += 1
+
+    def finish(self, usage, relayed_bytes):
+        """Record and log the stream's summary; returns it."""
+        end = time.perf_counter()
+        completion = int((usage or {}).get('completion_tokens') or 0)
+        tokens = completion or self.deltas
+        span = self.last - self.first if self.deltas > 1 else 0
+        summary = {
+            'model': self.model,
+            'outcome': self.outcome,
+            'queue_s': round(self.sent - self.arrived, 3),
+            'connect_s': round(self.connect, 3) if self.connect is not None else None,
+            'ttfb_s': round(self.headers - self.sent, 3),
+            'ttft_s': round(self.first - self.sent, 3) if self.first is not None else None,
+            'total_s': round(end - self.sent, 3),
+            'tokens': tokens,
+            'tokens_estimated': not completion,  # counted content deltas, no usage report
+            'tokens_per_s': round(tokens / span, 1) if span > 0 else None,
+            'max_gap_s': round(self.max_gap, 3),
+            'stalls': self.stalls,
+            'bytes': relayed_bytes,
         }
+        stream_timings.record(summary)
+        logger.info('AI stream timing ' + json.dumps(summary, separators=(',', ':')))
+        return summary
+
+
+class StreamTimings:
+    """Rolling per-model window of recent stream summaries (this worker)."""
+
+    def __init__(self, window):
+        self.window = window
+        self.lock = threading.Lock()
+        self.recent = {}
+        self.totals = {}
+
+    def record(self, summary):
+        model = summary['model']
+        with self.lock:
+            self.recent.setdefault(model, deque(maxlen=self.window)).append(summary)
+            self.totals[model] = self.totals.get(model, 0) + 1
+        ai_streams.inc((model, summary['outcome']))
+        for phase in STREAM_PHASES:
+            if summary[phase] is not None:
+                ai_stream_phases.observe(summary[phase], (model, phase[:-2]))
+        if summary['tokens_per_s'] is not None:
+            ai_stream_token_rate.observe(summary['tokens_per_s'], (model,))
+        if summary['stalls']:
+            ai_stream_stalls.inc((model,), summary['stalls'])
+
+    def stats(self):
+        with self.lock:
+            recent = {model: list(window) for model, window in self.recent.items()}
+            totals = dict(self.totals)
+        report = {}
+        for model, window in recent.items():
+            outcomes = {}
+            for summary in window:
+                outcomes[summary['outcome']] = outcomes.get(summary['outcome'], 0) + 1
+            report[model] = {
+                'streams': totals[model],
+                'window': len(window),
+                'outcomes': outcomes,
+                'new_connections': sum(s['connect_s'] is not None for s in window),
+                'stalled_streams': sum(s['stalls'] > 0 for s in window),
+                **{field: _percentiles([s[field] for s in window if s[field] is not None])
+                   for field in (*STREAM_PHASES, 'tokens_per_s', 'max_gap_s')},
+            }
+        return report
 
-        # Build payload with provider-specific parameter handling
-        ai_payload = build_ai_payload(model, data['messages'], data)
 
-        logger.info(f"Proxying AI request to {endpoint} with model {model}")
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {'p50': values[len(values) // 2],
+            'p90': values[int(len(values) * 0.9)],
+            'p99': values[int(len(values) * 0.99)],
+            'max': values[-1]}
 
-        # Handle streaming responses
-        if data.get('stream'):
-            ai_payload['stream'] = True
-            start_time = time.time()
-            resp = requests.post(
-                endpoint,
-                headers=headers,
-                json=ai_payload,
-                stream=True,
-                timeout=timeout
-            )
 
-            if resp.status_code != 200:
-                error_msg = f"AI API error: {resp.status_code}"
-                retry_after = None
-                try:
-                    error_data = resp.json()
-                    if 'error' in error_data:
-                        error_msg = error_data['error'].get('message', error_msg)
-                    # Extract retry_after from metadata headers
-                    meta = error_data.get('error', {}).get('metadata', {})
-                    hdrs = meta.get('headers', {})
-                    retry_after = hdrs.get('X-RateLimit-Reset') or resp.headers.get('Retry-After')
-                except Exception:
-                    error_msg = resp.text or error_msg
-
-                # Map upstream quota errors to a client-visible quota state
-                if resp.status_code in (429, 402):
-                    logger.warning(f"Upstream quota/billing error {resp.status_code}: {error_msg}")
-                    return jsonify({
-                        'error': FREE_QUOTA_COPY,
-                        'code': 'free_quota_exhausted',
-                        'retry_after': retry_after,
-                    }), 429
-
-                logger.error(f"AI API streaming error: {error_msg}")
-                return jsonify({'error': error_msg}), resp.status_code
-
-            def generate():
-                try:
-                    for line in resp.iter_lines():
-                        if line:
-                            yield line.decode('utf-8') + '\n'
-                except Exception as stream_err:
-                    # Surface mid-stream upstream failures as a terminal SSE error
-                    # frame so the client shows a real error instead of an empty/
-                    # "invalid JSON" result.
-                    logger.error(f"AI API stream interrupted: {stream_err}")
-                    yield 'data: ' + json.dumps({'error': 'The AI stream was interrupted. Please try again.'}) + '\n'
-                finally:
-                    # Runs on GeneratorExit too, so a client disconnect releases
-                    # the upstream connection instead of leaking it.
-                    resp.close()
-                    logger.info(f"AI API streaming completed in {time.time() - start_time:.2f}s")
+stream_timings = StreamTimings(AI_STREAM_TIMING_WINDOW)
 
-            return Response(stream_with_context(generate()), content_type='text/event-stream')
 
-        # Non-streaming response
-        start_time = time.time()
-        response = requests.post(
-            endpoint,
-            headers=headers,
-            json=ai_payload,
-            timeout=timeout
-        )
+# ---------------------------------------------------------------------------
+# Opt-in completion cache for non-streaming /api/ai-assist calls
+# ---------------------------------------------------------------------------
 
-        response_time = time.time() - start_time
-        logger.info(f"AI API response received in {response_time:.2f}s, status: {response.status_code}")
+AI_CACHE_ENABLED = os.environ.get('AI_CACHE_ENABLED', 'false').lower() == 'true'
+AI_CACHE_MAX_BYTES = int(os.environ.get('AI_CACHE_MAX_BYTES', 32 * 1024 * 1024))  # per worker
+AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', 3600))
+# Only near-deterministic completions are reused. Payloads without a
+# temperature (providers that reject it, e.g. anthropic/*) sample at the
+# provider default and are never cached.
+AI_CACHE_MAX_TEMPERATURE = float(os.environ.get('AI_CACHE_MAX_TEMPERATURE', 0.3))
+# Optional on-disk tier shared by all workers and kept across restarts.
+AI_CACHE_DIR = os.environ.get('AI_CACHE_DIR', '')
+AI_CACHE_DISK_MAX_BYTES = int(os.environ.get('AI_CACHE_DISK_MAX_BYTES', 256 * 1024 * 1024))
+
+AI_CACHE_HEADER = 'X-AI-Cache'
+
+
+class LRUByteCache:
+    """Thread-safe in-memory LRU bounded by total value bytes, with a TTL."""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.time() + (ttl or self.ttl), value)
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def _drop(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'evictions': self.evictions}
+
+
+class DiskCache:
+    """Sharded on-disk byte cache shared by every worker on the host.
+
+    Entries live at <root>/<key[:2]>/<key>: an expiry timestamp line, then the
+    value. Writes go through a temp file + os.replace so concurrent workers
+    never read a torn entry. The file mtime is the LRU clock (bumped on every
+    hit); a sweep every PRUNE_EVERY writes trims the least recently used files
+    once the directory exceeds max_bytes. Directories are created on the first
+    write, so building one (at import) touches nothing on disk.
+    """
 
-        # Handle response
-        if response.status_code == 200:
-            ai_response = response.json()
-            return jsonify(ai_response)
-        else:
-            # Map upstream quota errors to a client-visible quota state
-            if response.status_code in (429, 402):
-                retry_after = None
-                try:
-                    error_data = response.json()
-                    meta = error_data.get('error', {}).get('metadata', {})
-                    hdrs = meta.get('headers', {})
-                    retry_after = hdrs.get('X-RateLimit-Reset') or response.headers.get('Retry-After')
-                    error_msg = error_data.get('error', {}).get('message', '')
-                except Exception:
-                    error_msg = response.text or ''
-                logger.warning(f"Upstream quota/billing error {response.status_code}: {error_msg}")
-                return jsonify({
-                    'error': FREE_QUOTA_COPY,
-                    'code': 'free_quota_exhausted',
-                    'retry_after': retry_after,
-                }), 429
-
-            error_msg = f"AI API error: {response.status_code}"
-            try:
-                error_data = response.json()
-                if 'error' in error_data:
-                    error_msg = error_data['error'].get('message', error_msg)
-            except Exception:
-                error_msg = response.text or error_msg
+    PRUNE_EVERY = 64
 
-            logger.error(f"AI API error: {error_msg}")
-            return jsonify({'error': error_msg}), response.status_code
+    def __init__(self, root, max_bytes, ttl):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
 
-    except requests.exceptions.Timeout:
-        logger.error("AI API request timeout")
-        return jsonify({'error': 'Request timeout'}), 504
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
 
-    except requests.exceptions.ConnectionError:
-        logger.error("Failed to connect to AI API")
-        return jsonify({'error': 'Failed to connect to AI service'}), 503
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at = float(f.readline())
+                value = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires_at <= time.time():
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value, ttl=None):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(f"{time.time() + (ttl or self.ttl):.3f}\n".encode())
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Disk cache write failed for {path}: {e}")
+            self._remove(tmp)
+            return False
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.PRUNE_EVERY == 0
+        if due:
+            self.prune()
+        return True
+
+    def prune(self):
+        """Drop least recently used entries until the tree is under 90% of the cap."""
+        files, total = [], 0
+        try:
+            shards = [e.path for e in os.scandir(self.root) if e.is_dir()]
+            for shard in shards:
+                for entry in os.scandir(shard):
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        except OSError as e:
+            logger.warning(f"Disk cache sweep failed for {self.root}: {e}")
+            return 0
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes * 0.9:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        with self._lock:
+            self.evictions += removed
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-    except Exception as e:
-        logger.error(f"Unexpected error in AI assist: {e}")
-        return jsonify({'error': 'Internal server error'}), 500
+    def stats(self):
+        return {'root': self.root, 'max_bytes': self.max_bytes, 'evictions': self.evictions}
 
-@app.route('/api/config', methods=['GET'])
-def get_config():
-    """Get server AI and Draw.io configuration (without sensitive data)"""
-    config = {
-        'ai': {
-            'enabled': AI_MODE == 'relay',  # back-compat: true only in relay mode
-            'mode': AI_MODE,
-            'has_api_key': AI_MODE == 'relay' and bool(DEFAULT_AI_CONFIG['api_key']),
-            'model': DEFAULT_AI_CONFIG['model'] if AI_MODE == 'relay' else None,
-            'timeout': DEFAULT_AI_CONFIG['timeout']
-        },
-        'drawio': {
-            'server_url': os.environ.get('DRAWIO_SERVER_URL', 'https://embed.diagrams.net/')
-        },
-        'kroki': {
-            'maxBodySize': KROKI_MAX_BODY_SIZE,
-            'disabledDiagramTypes': DISABLED_DIAGRAM_TYPES
-        }
-    }
-    return jsonify(config)
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.utcnow().isoformat(),
-        'ai_enabled': AI_MODE == 'relay',
-        'ai_mode': AI_MODE,
-    })
+AI_CACHE_COUNTERS = ('memory_hits', 'disk_hits', 'misses', 'bypassed', 'stores')
 
-@app.route('/api/version', methods=['GET'])
-def get_version():
-    """Get version and system information"""
-    try:
-        if not validate_origin(request):
-            return jsonify({'error': 'Unauthorized origin'}), 403
+_ai_cache_lock = threading.Lock()
+_ai_cache_counters = dict.fromkeys(AI_CACHE_COUNTERS, 0)
+_ai_cache_memory = LRUByteCache(AI_CACHE_MAX_BYTES, AI_CACHE_TTL)
+_ai_cache_disk = (DiskCache(AI_CACHE_DIR, AI_CACHE_DISK_MAX_BYTES, AI_CACHE_TTL)
+                  if AI_CACHE_ENABLED and AI_CACHE_DIR else None)
 
-        return jsonify({
-            'version': os.environ.get('VERSION', '1.0.0'),
-            'name': 'DocCode - The Kroki Server Frontend',
-            'description': 'A comprehensive interactive frontend for Kroki diagram rendering server with AI assistance',
-            'build_date': os.environ.get('BUILD_DATE', '2025-06-19'),
-            'author': os.environ.get('AUTHOR_NAME', 'Vysakh Pillai'),
+
+def _count_ai_cache(name):
+    with _ai_cache_lock:
+        _ai_cache_counters[name] += 1
+
+
+def ai_cache_key(payload):
+    """Cache key for a built upstream payload, or None when policy forbids caching.
+
+    The key hashes the normalized build_ai_payload() output (model, messages,
+    clamped token limit, clamped temperature), so requests that differ only in
+    ignored or out-of-range client fields share an entry.
+    """
+    if not AI_CACHE_ENABLED or payload.get('stream'):
+        return None
+    temperature = payload.get('temperature')
+    if temperature is None or temperature > AI_CACHE_MAX_TEMPERATURE:
+        _count_ai_cache('bypassed')
+        return None
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def ai_cache_get(key):
+    body = _ai_cache_memory.get(key)
+    if body is not None:
+        _count_ai_cache('memory_hits')
+        return body
+    if _ai_cache_disk is not None:
+        body = _ai_cache_disk.get(key)
+        if body is not None:
+            _ai_cache_memory.put(key, body)
+            _count_ai_cache('disk_hits')
+            return body
+    _count_ai_cache('misses')
+    return None
+
+
+def ai_cache_put(key, body):
+    _ai_cache_memory.put(key, body)
+    if _ai_cache_disk is not None:
+        _ai_cache_disk.put(key, body)
+    _count_ai_cache('stores')
+
+
+def ai_cache_stats():
+    with _ai_cache_lock:
+        counters = dict(_ai_cache_counters)
+    hits = counters['memory_hits'] + counters['disk_hits']
+    lookups = hits + counters['misses']
+    return {
+        'enabled': AI_CACHE_ENABLED,
+        **counters,
+        'hit_ratio': round(hits / lookups, 3) if lookups else None,
+        'memory': _ai_cache_memory.stats(),
+        'disk': _ai_cache_disk.stats() if _ai_cache_disk else None,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Kroki render gateway: POST renders through a shared content-addressed cache
+# ---------------------------------------------------------------------------
+
+# nginx caches GET renders by URL but can never cache POST ones, which carry
+# every large diagram. /api/render forwards them to Kroki core and keeps the
+# output in a DiskCache shared by all workers, keyed on what determines it.
+KROKI_CORE_URL = os.environ.get('KROKI_CORE_URL', 'http://core:8000').rstrip('/')
+KROKI_CORE_IMAGE = os.environ.get('KROKI_CORE_IMAGE', '')
+KROKI_TIMEOUT = float(os.environ.get('KROKI_TIMEOUT', 60))
+# Renderer version baked into every key, so a core upgrade never serves old
+# output. Empty = ask core's /health (re-checked every RENDER_VERSION_TTL s, or
+# RENDER_VERSION_RETRY_TTL s while core is down or reports no version; renders
+# in that window are forwarded uncached).
+KROKI_CORE_VERSION = os.environ.get('KROKI_CORE_VERSION', '')
+RENDER_VERSION_TTL = 300
+RENDER_VERSION_RETRY_TTL = 10
+# Empty RENDER_GATEWAY_CACHE_DIR = forward every render uncached.
+RENDER_GATEWAY_CACHE_DIR = os.environ.get('RENDER_GATEWAY_CACHE_DIR', '/tmp/doccode-render-cache')
+RENDER_GATEWAY_CACHE_MAX_BYTES = int(os.environ.get('RENDER_GATEWAY_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+RENDER_GATEWAY_CACHE_TTL = int(os.environ.get('RENDER_GATEWAY_CACHE_TTL', 7 * 86400))
+# Render errors (bad diagram source) are cached briefly so a broken diagram
+# re-submitted on every keystroke does not reach the renderer each time.
+RENDER_GATEWAY_ERROR_TTL = int(os.environ.get('RENDER_GATEWAY_ERROR_TTL', 30))
+# Client errors that describe the diagram, not the moment: worth a short cache.
+RENDER_NEGATIVE_STATUSES = frozenset({400, 404, 422})
+
+RENDER_CACHE_HEADER = 'X-Render-Cache'
+_RENDER_NAME_RE = re.compile(r'^[a-z0-9]+$')
+_RENDER_OPTION_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+_RENDER_OPTION_HEADER = 'Kroki-Diagram-Options-'
+
+RENDER_CACHE_COUNTERS = ('hits', 'negative_hits', 'misses', 'stores', 'bypassed', 'upstream_errors')
+
+_render_lock = threading.Lock()
+_render_counters = dict.fromkeys(RENDER_CACHE_COUNTERS, 0)
+_render_cache = (DiskCache(RENDER_GATEWAY_CACHE_DIR, RENDER_GATEWAY_CACHE_MAX_BYTES, RENDER_GATEWAY_CACHE_TTL)
+                 if RENDER_GATEWAY_CACHE_DIR else None)
+_kroki_pool = {'pid': None, 'session': None}
+_kroki_version_lock = threading.Lock()
+_kroki_version = {'value': None, 'checked': 0.0}
+
+
+def _count_render(name):
+    with _render_lock:
+        _render_counters[name] += 1
+
+
+def kroki_session():
+    """This worker's keep-alive session to Kroki core (rebuilt after the fork)."""
+    pid = os.getpid()
+    with _render_lock:
+        if _kroki_pool['pid'] != pid:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AI_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _kroki_pool.update(pid=pid, session=session)
+        return _kroki_pool['session']
+
+
+def kroki_core_version():
+    """Version string of the running Kroki core for cache keys, or None.
+
+    None (core unreachable, or /health without a version) is remembered for
+    RENDER_VERSION_RETRY_TTL only, so the real version is picked up soon after
+    core is back without a /health call in front of every render meanwhile.
+    """
+    if KROKI_CORE_VERSION:
+        return KROKI_CORE_VERSION
+    now = time.time()
+    with _kroki_version_lock:
+        value, checked = _kroki_version['value'], _kroki_version['checked']
+    if now - checked < (RENDER_VERSION_TTL if value else RENDER_VERSION_RETRY_TTL):
+        return value
+    try:
+        resp = kroki_session().get(f"{KROKI_CORE_URL}/health", timeout=5)
+        version = resp.json().get('version')
+        value = json.dumps(version, sort_keys=True) if version else None
+    except (requests.RequestException, ValueError, AttributeError) as e:
+        logger.warning(f"Could not read Kroki core version from {KROKI_CORE_URL}/health: {e}")
+        value = None
+    with _kroki_version_lock:
+        _kroki_version.update(value=value, checked=now)
+    return value
+
+
+def normalize_diagram_source(source):
+    """Line endings, BOM and trailing whitespace differ between editors and
+    clipboards without changing the rendered diagram."""
+    lines = source.lstrip('\ufeff').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip('\n') + '\n'
+
+
+# Renderers that ignore trailing blanks and line-ending style. ASCII-art types
+# (ditaa, svgbob, goat) and YAML/LaTeX ones draw with whitespace, so their
+# sources stay verbatim wherever equivalent sources are folded together.
+WHITESPACE_INSENSITIVE_TYPES = frozenset({
+    'actdiag', 'blockdiag', 'bpmn', 'bytefield', 'c4plantuml', 'd2', 'dbml', 'diagramsnet', 'erd',
+    'excalidraw', 'graphviz', 'mermaid', 'nomnoml', 'nwdiag', 'packetdiag', 'pikchr', 'plantuml',
+    'rackdiag', 'seqdiag', 'structurizr', 'symbolator', 'vega', 'vegalite', 'wavedrom',
+})
+
+
+def canonical_diagram_source(diagram_type, source):
+    """Source as cache keys see it: normalized only where the renderer can't tell."""
+    if diagram_type in WHITESPACE_INSENSITIVE_TYPES:
+        return normalize_diagram_source(source)
+    return source
+
+
+def render_cache_key(diagram_type, output_format, options, source, core_version=None):
+    """Cache key of a render; the source is canonicalized here only, Kroki gets it verbatim."""
+    parts = [core_version or kroki_core_version() or 'unknown', KROKI_CORE_IMAGE, diagram_type, output_format,
+             sorted(options.items()), canonical_diagram_source(diagram_type, source)]
+    optimizer = svg_optimize_signature(diagram_type, output_format)
+    if optimizer:
+        parts.append(optimizer)
+    canonical = json.dumps(parts, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def render_request_fields(request, diagram_type=None, output_format=None):
+    """(type, format, options, source) of a Kroki-style POST, or an error string.
+
+    Accepts both forms the editor sends: a plain-text body on /<type>/<format>
+    (options in the query string or Kroki-Diagram-Options-* headers), and the
+    JSON body {diagram_source, diagram_type, output_format, diagram_options}.
+    """
+    options = {k: v for k, v in request.args.items()}
+    for name, value in request.headers.items():
+        if name.lower().startswith(_RENDER_OPTION_HEADER.lower()):
+            options[name[len(_RENDER_OPTION_HEADER):].lower()] = value
+    if request.mimetype == 'application/json':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return 'Invalid JSON'
+        source = data.get('diagram_source')
+        diagram_type = diagram_type or data.get('diagram_type')
+        output_format = output_format or data.get('output_format')
+        if isinstance(data.get('diagram_options'), dict):
+            options.update(data['diagram_options'])
+    else:
+        source = request.get_data(as_text=True)
+    return check_render_fields(diagram_type, output_format, options, source)
+
+
+def check_render_fields(diagram_type, output_format, options, source):
+    """Validated (type, format, options, source), or an error string."""
+    if not isinstance(source, str) or not source.strip():
+        return 'Empty diagram source'
+    for value in (diagram_type, output_format):
+        if not isinstance(value, str) or not _RENDER_NAME_RE.match(value):
+            return 'Invalid diagram type or output format'
+    if not isinstance(options, dict) or not all(
+            _RENDER_OPTION_RE.match(k) and isinstance(v, (str, int, float, bool)) for k, v in options.items()):
+        return 'Invalid diagram options'
+    return diagram_type, output_format, {k: str(v) for k, v in options.items()}, source
+
+
+# ---------------------------------------------------------------------------
+# Kroki URL encoding (deflate + base64url) and canonical GET render URLs
+# ---------------------------------------------------------------------------
+
+# nginx caches GET /<type>/<format>/<encoded> renders on the raw request URI, so
+# the same diagram with CRLF line endings, trailing spaces or a different
+# deflate level is a different cache entry. The canonical encoding is the
+# editor's own: canonical_diagram_source(), then zlib at the default level
+# (byte-identical to pako's deflate()) and padded base64url. The editor encodes
+# canonical sources itself; POST /api/encode gives other tools the same URL.
+_KROKI_PATH_RE = re.compile(r'^/([a-z0-9_-]{1,32})/([a-z0-9_-]{1,32})/([A-Za-z0-9_=-]+)$')
+
+
+def encode_kroki_source(source):
+    """Kroki's GET encoding of a source: zlib deflate, then base64url."""
+    return base64.urlsafe_b64encode(zlib.compress(source.encode('utf-8'))).decode('ascii')
+
+
+def decode_kroki_source(encoded, max_bytes=None):
+    """Inverse of encode_kroki_source(); also accepts raw deflate and missing
+    padding, as Kroki does. ValueError for anything undecodable or larger than
+    max_bytes (KROKI_MAX_BODY_SIZE) once inflated."""
+    max_bytes = KROKI_MAX_BODY_SIZE if max_bytes is None else max_bytes
+    try:
+        data = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f'Invalid base64url: {e}') from e
+    for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+        inflater = zlib.decompressobj(wbits)
+        try:
+            raw = inflater.decompress(data, max_bytes + 1)
+        except zlib.error:
+            continue
+        if len(raw) > max_bytes or inflater.unconsumed_tail:
+            raise ValueError('Decoded diagram too large')
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise ValueError('Decoded diagram is not UTF-8') from e
+    raise ValueError('Invalid deflate data')
+
+
+def canonical_render_path(diagram_type, output_format, options, source):
+    """Canonical GET render path (with its query string) for one diagram."""
+    path = f"/{diagram_type}/{output_format}/{encode_kroki_source(canonical_diagram_source(diagram_type, source))}"
+    if options:
+        path += '?' + urlencode(sorted(options.items()), quote_via=quote, safe="-_.!~*'()")
+    return path
+
+
+def canonical_render_uri(uri):
+    """Canonical form of a recorded GET render URI, or None if it is not one."""
+    parsed = urlparse(uri)
+    match = _KROKI_PATH_RE.match(parsed.path)
+    if not match:
+        return None
+    diagram_type, output_format, encoded = match.groups()
+    try:
+        source = decode_kroki_source(encoded)
+    except ValueError:
+        return None
+    return canonical_render_path(diagram_type, output_format, dict(parse_qsl(parsed.query)), source)
+
+
+def _pack_render(status, content_type, body):
+    return json.dumps({'status': status, 'type': content_type}).encode() + b'\n' + body
+
+
+def _unpack_render(value):
+    meta, _, body = value.partition(b'\n')
+    meta = json.loads(meta)
+    return meta['status'], meta['type'], body
+
+
+def render_via_gateway(diagram_type, output_format, options, source, lane='interactive'):
+    """(status, content type, body, headers) for one render.
+
+    Cache misses go through render_scheduler, which coalesces identical
+    renders and bounds how many of each type reach Kroki at once. While the
+    core version is unknown, renders bypass the cache: an entry keyed on no
+    version would outlive the next core upgrade.
+    """
+    core_version = kroki_core_version()
+    key = render_cache_key(diagram_type, output_format, options, source, core_version)
+    cache = _render_cache if core_version else None
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            status, content_type, body = _unpack_render(cached)
+            _count_render('hits' if status == 200 else 'negative_hits')
+            return status, content_type, body, _render_headers(key, status, 'HIT')
+        _count_render('misses')
+    else:
+        _count_render('bypassed')
+    return render_scheduler.run(key, diagram_type, lane, lambda: _render_upstream(
+        key, diagram_type, output_format, options, source, cache))
+
+
+def _render_upstream(key, diagram_type, output_format, options, source, cache):
+    try:
+        resp = kroki_session().post(f"{KROKI_CORE_URL}/{diagram_type}/{output_format}", params=options,
+                                    data=source.encode('utf-8'), timeout=KROKI_TIMEOUT,
+                                    headers={'Content-Type': 'text/plain; charset=utf-8'})
+    except requests.RequestException as e:
+        logger.error(f"Kroki core unreachable for {diagram_type}/{output_format}: {e}")
+        _count_render('upstream_errors')
+        body = json.dumps({'error': 'Diagram renderer unavailable'}).encode()
+        return 503, 'application/json', body, _render_headers(key, 503, 'BYPASS')
+
+    content_type = resp.headers.get('Content-Type', 'application/octet-stream')
+    body = resp.content
+    if resp.status_code == 200 and output_format == 'svg' and content_type.startswith('image/svg+xml'):
+        body = optimize_svg_render(diagram_type, body)
+    state = 'BYPASS'
+    if cache is not None:
+        if resp.status_code == 200:
+            ttl = None
+        elif resp.status_code in RENDER_NEGATIVE_STATUSES:
+            ttl = RENDER_GATEWAY_ERROR_TTL
+        else:
+            ttl = 0  # renderer overloaded or down: try again next time
+            _count_render('upstream_errors')
+        if ttl != 0 and cache.put(key, _pack_render(resp.status_code, content_type, body), ttl):
+            _count_render('stores')
+            state = 'MISS'
+    return resp.status_code, content_type, body, _render_headers(key, resp.status_code, state)
+
+
+def _render_headers(key, status, state):
+    headers = {RENDER_CACHE_HEADER: state}
+    if status == 200:
+        headers['ETag'] = f'"{key[:32]}"'
+    return headers
+
+
+def render_cache_stats():
+    with _render_lock:
+        counters = dict(_render_counters)
+    with _kroki_version_lock:
+        core_version = KROKI_CORE_VERSION or _kroki_version['value']
+    hits = counters['hits'] + counters['negative_hits']
+    lookups = hits + counters['misses']
+    return {
+        **counters,
+        'hit_ratio': round(hits / lookups, 3) if lookups else None,
+        'core_version': core_version,
+        'disk': _render_cache.stats() if _render_cache else None,
+        'svg_optimizer': svg_optimize_stats(),
+    }
+
+
+# ---------------------------------------------------------------------------
+# SVG optimizer for gateway renders (minify + normalize before caching)
+# ---------------------------------------------------------------------------
+
+# PlantUML, Mermaid and Graphviz SVGs carry comments (PlantUML embeds the whole
+# encoded source), indentation, full-precision coordinates and style attributes
+# that repeat presentation attributes. With SVG_OPTIMIZE_ENABLED the gateway
+# rewrites successful svg renders once, before they are cached, so every later
+# hit is served (and kept in the editor's code history) at the smaller size.
+# The rewrite is token-level: no element is moved, renamed or dropped, text
+# content is never touched and <foreignObject>/<script> pass through verbatim.
+SVG_OPTIMIZE_ENABLED = os.environ.get('SVG_OPTIMIZE_ENABLED', 'false').lower() == 'true'
+SVG_OPTIMIZE_PRECISION = int(os.environ.get('SVG_OPTIMIZE_PRECISION', 3))
+# Bump when the rewrite changes, so cached optimized renders are not reused.
+SVG_OPTIMIZER_VERSION = 1
+
+SVG_OPTIMIZE_RULES = {
+    'comments': True,     # drop <!-- --> (not processing instructions)
+    'whitespace': True,   # drop whitespace-only text between tags outside text elements
+    'precision': SVG_OPTIMIZE_PRECISION,  # decimals kept in geometry attributes (None = off)
+    'dedup': True,        # repeated attributes and style declarations; attributes the style overrides
+    'css': True,          # collapse whitespace in <style> blocks
+}
+SVG_OPTIMIZE_TYPE_RULES = {
+    # dvisvgm output is in pt under scale() transforms: a rounding step is larger on screen
+    'tikz': {'precision': SVG_OPTIMIZE_PRECISION + 1},
+    # @font-face rules with inline font data; nothing to gain, nothing to risk
+    'excalidraw': {'css': False},
+}
+
+_SVG_TOKEN_RE = re.compile(
+    r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!(?:[^>"\'\[]|"[^"]*"|\'[^\']*\'|\[.*?\])*>'
+    r'|<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>|[^<]+', re.S)
+_SVG_TAG_RE = re.compile(r'<([^\s/>]+)(.*?)(/?)>$', re.S)
+_SVG_ATTR_RE = re.compile(r'([^\s=/>]+)\s*=\s*("[^"]*"|\'[^\']*\')')
+_SVG_NUMBER_RE = re.compile(r'[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+_SVG_STYLE_DECL_RE = re.compile(r'(?:[^;("\']|\([^)]*\)|"[^"]*"|\'[^\']*\')+')
+# Inside these, whitespace is content; tags inside still get their attributes optimized
+_SVG_TEXT_ELEMENTS = {'text', 'tspan', 'textPath', 'title', 'desc', 'style', 'pre'}
+# Inside these, nothing is rewritten at all
+_SVG_VERBATIM_ELEMENTS = {'foreignObject', 'script'}
+_SVG_GEOMETRY_ATTRS = {
+    'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry', 'dx', 'dy', 'width', 'height',
+    'd', 'points', 'transform', 'gradientTransform', 'patternTransform', 'viewBox',
+    'stroke-width', 'font-size', 'textLength', 'refX', 'refY', 'markerWidth', 'markerHeight',
+}
+_SVG_PRESENTATION_ATTRS = {
+    'fill', 'fill-opacity', 'fill-rule', 'stroke', 'stroke-width', 'stroke-opacity', 'stroke-dasharray',
+    'stroke-dashoffset', 'stroke-linecap', 'stroke-linejoin', 'stroke-miterlimit', 'opacity', 'color',
+    'font-family', 'font-size', 'font-style', 'font-weight', 'text-anchor', 'dominant-baseline',
+    'visibility', 'display',
+}
+
+_svg_counters = {'optimized': 0, 'failed': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_ms': 0.0}
+_svg_lock = threading.Lock()
+
+
+def svg_optimize_rules(diagram_type):
+    """The rule set for one diagram type, or None when renders are left as-is."""
+    if not SVG_OPTIMIZE_ENABLED:
+        return None
+    return {**SVG_OPTIMIZE_RULES, **SVG_OPTIMIZE_TYPE_RULES.get(diagram_type, {})}
+
+
+def svg_optimize_signature(diagram_type, output_format):
+    """Part of the render cache key: optimized and raw renders never mix."""
+    rules = svg_optimize_rules(diagram_type) if output_format == 'svg' else None
+    return f"svgopt{SVG_OPTIMIZER_VERSION}:{json.dumps(rules, sort_keys=True)}" if rules else None
+
+
+def _round_numbers(value, precision):
+    def rounded(match):
+        text = match.group()
+        if '.' not in text and 'e' not in text.lower():
+            return text
+        out = f"{float(text):.{precision}f}".rstrip('0').rstrip('.')
+        out = out.replace('0.', '.', 1) if out.startswith(('0.', '-0.')) else out
+        if out in ('-0', '', '-'):
+            out = '0'
+        # The sign or leading dot may have been the only separator from the
+        # previous number ("M1-0.0001" must not become "M10"), and a lost
+        # decimal point the only separator from the next (".5" after "2.0004").
+        before = value[match.start() - 1:match.start()]
+        if before and (before.isdigit() or before == '.') and out[0] not in '-.':
+            out = ' ' + out
+        if '.' not in out and value[match.end():match.end() + 1] == '.':
+            out += ' '
+        return out
+    return _SVG_NUMBER_RE.sub(rounded, value)
+
+
+def _style_declarations(style):
+    declarations = {}
+    for decl in _SVG_STYLE_DECL_RE.findall(style):
+        name, sep, value = decl.partition(':')
+        if sep and name.strip():
+            declarations.pop(name.strip(), None)  # the last declaration wins; keep its position
+            declarations[name.strip()] = value.strip()
+    return declarations
+
+
+def _optimize_svg_tag(match, rules):
+    name, body, self_closing = match.groups()
+    attrs = {}
+    for attr, quoted in _SVG_ATTR_RE.findall(body):
+        if rules['dedup'] and attr in attrs:
+            continue
+        attrs[attr] = quoted
+    style = attrs.get('style')
+    if rules['dedup'] and style:
+        declarations = _style_declarations(style[1:-1])
+        quote = style[0]
+        attrs['style'] = quote + ';'.join(f"{k}:{v}" for k, v in declarations.items()) + quote
+        for attr in _SVG_PRESENTATION_ATTRS & declarations.keys():
+            attrs.pop(attr, None)
+    if rules['precision'] is not None:
+        for attr in _SVG_GEOMETRY_ATTRS & attrs.keys():
+            quoted = attrs[attr]
+            if attr == 'd' and re.search('[aA]', quoted):
+                continue  # arc flags may be packed against numbers ("a1 1 0 01.5 2")
+            attrs[attr] = quoted[0] + _round_numbers(quoted[1:-1], rules['precision']).strip() + quoted[0]
+    parts = ''.join(f" {attr}={quoted}" for attr, quoted in attrs.items())
+    return f"<{name}{parts}{'/' if self_closing else ''}>"
+
+
+def _minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    return re.sub(r'\s*([{};,])\s*', r'\1', css).strip()
+
+
+def optimize_svg(svg, rules):
+    """Minified, normalized copy of an SVG document (str) under one rule set."""
+    out = []
+    open_elements = []  # names of the enclosing text/verbatim elements
+    verbatim = 0  # how many of them are verbatim
+    for token in _SVG_TOKEN_RE.findall(svg):
+        if token.startswith('<!--'):
+            if not (rules['comments'] and not verbatim):
+                out.append(token)
+        elif token.startswith('<![CDATA['):
+            if rules['css'] and not verbatim and open_elements and open_elements[-1] == 'style':
+                token = f"<![CDATA[{_minify_css(token[9:-3])}]]>"
+            out.append(token)
+        elif token.startswith(('<?', '<!')):
+            out.append(token)
+        elif token.startswith('</'):
+            name = token[2:-1].strip()
+            if open_elements and open_elements[-1] == name:
+                verbatim -= open_elements.pop() in _SVG_VERBATIM_ELEMENTS
+            out.append(token)
+        elif token.startswith('<'):
+            match = _SVG_TAG_RE.match(token)
+            if not match:
+                out.append(token)
+                continue
+            out.append(token if verbatim else _optimize_svg_tag(match, rules))
+            name = match.group(1)
+            if not match.group(3) and (
+                    open_elements or name in _SVG_TEXT_ELEMENTS or name in _SVG_VERBATIM_ELEMENTS):
+                open_elements.append(name)
+                verbatim += name in _SVG_VERBATIM_ELEMENTS
+        elif verbatim:
+            out.append(token)
+        elif open_elements:
+            if rules['css'] and open_elements[-1] == 'style':
+                token = _minify_css(token)
+            out.append(token)
+        elif not (rules['whitespace'] and not token.strip()):
+            out.append(token)
+    return ''.join(out)
+
+
+def optimize_svg_render(diagram_type, body):
+    """Optimized render body (bytes); the original when disabled or unusable."""
+    rules = svg_optimize_rules(diagram_type)
+    if rules is None:
+        return body
+    started = time.perf_counter()
+    try:
+        optimized = optimize_svg(body.decode('utf-8'), rules).encode('utf-8')
+        if b'<svg' not in optimized or len(optimized) > len(body):
+            raise ValueError('no smaller svg document')
+    except (UnicodeDecodeError, ValueError, AttributeError) as e:
+        logger.warning(f"SVG optimization skipped for a {diagram_type} render: {e}")
+        with _svg_lock:
+            _svg_counters['failed'] += 1
+        return body
+    with _svg_lock:
+        _svg_counters['optimized'] += 1
+        _svg_counters['bytes_in'] += len(body)
+        _svg_counters['bytes_out'] += len(optimized)
+        _svg_counters['cpu_ms'] += (time.perf_counter() - started) * 1000
+    return optimized
+
+
+def svg_optimize_stats():
+    with _svg_lock:
+        counters = dict(_svg_counters)
+    return {
+        'enabled': SVG_OPTIMIZE_ENABLED,
+        **counters,
+        'cpu_ms': round(counters['cpu_ms'], 1),
+        'saved_ratio': (round(1 - counters['bytes_out'] / counters['bytes_in'], 3)
+                        if counters['bytes_in'] else None),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Render scheduler: per-type concurrency, priority lanes, coalescing (per worker)
+# ---------------------------------------------------------------------------
+
+# Renders in flight to Kroki per diagram type and worker (0 = unlimited). The
+# Chromium-backed companions degrade or run out of memory under a flood, so
+# they get small defaults; RENDER_MAX_CONCURRENT_PER_TYPE overrides or adds
+# types ("mermaid=2,plantuml=16").
+RENDER_MAX_CONCURRENT_DEFAULT = int(os.environ.get('RENDER_MAX_CONCURRENT_DEFAULT', 8))
+RENDER_MAX_CONCURRENT_PER_TYPE = {'mermaid': 4, 'bpmn': 2, 'excalidraw': 2, 'diagramsnet': 2}
+for _item in os.environ.get('RENDER_MAX_CONCURRENT_PER_TYPE', '').split(','):
+    _type, _, _limit = _item.partition('=')
+    if _type.strip() and _limit.strip():
+        RENDER_MAX_CONCURRENT_PER_TYPE[_type.strip().lower()] = int(_limit)
+# Waiting renders per lane; beyond that, or after the lane's timeout, a 503.
+RENDER_QUEUE_SIZE = int(os.environ.get('RENDER_QUEUE_SIZE', 64))
+RENDER_QUEUE_TIMEOUT = float(os.environ.get('RENDER_QUEUE_TIMEOUT', 15))
+RENDER_BULK_QUEUE_TIMEOUT = float(os.environ.get('RENDER_BULK_QUEUE_TIMEOUT', 120))
+
+# Editor previews go first; exports and batch jobs send X-Render-Priority: bulk
+# and only get a slot when no interactive render of that type is waiting.
+RENDER_LANES = ('interactive', 'bulk')
+RENDER_PRIORITY_HEADER = 'X-Render-Priority'
+RENDER_BUSY_COPY = 'The diagram renderer is busy. Please try again in {seconds} seconds.'
+
+
+class _RenderWaiter:
+    def __init__(self, diagram_type, rank, seq):
+        self.diagram_type = diagram_type
+        self.rank = rank
+        self.seq = seq
+        self.event = threading.Event()
+        self.granted = False
+
+
+class _RenderFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.followers = 0
+
+
+class RenderScheduler:
+    """Per-diagram-type render slots with strict-priority lanes.
+
+    run() first joins an identical render already in flight (same cache key),
+    so N editors submitting one diagram cost one backend call. Otherwise it
+    takes a slot for the diagram type, waiting if the type is at its limit;
+    a freed slot goes to the oldest interactive waiter of that type, then the
+    oldest bulk one. Waits are recorded per lane for /api/stats.
+    """
+
+    # Assumed render time before a type has been observed (seconds).
+    DEFAULT_SERVICE_TIME = 2.0
+
+    def __init__(self, limits, default_limit, queue_size, timeouts):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.queue_size = queue_size
+        self.timeouts = timeouts
+        self.lock = threading.Lock()
+        self.active = {}
+        self.waiters = []
+        self.inflight = {}
+        self.service_times = {}
+        self.waits = {lane: deque(maxlen=1024) for lane in RENDER_LANES}
+        self.seq = 0
+        self.counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0, 'coalesced': 0}
+
+    def run(self, key, diagram_type, lane, work):
+        """work() -> (status, content type, body, headers), at most once per key at a time."""
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _RenderFlight()
+            else:
+                flight.followers += 1
+                self.counters['coalesced'] += 1
+        if not leader:
+            if flight.event.wait(self.timeouts[lane] + KROKI_TIMEOUT):
+                status, content_type, body, headers = flight.result
+                return status, content_type, body, {**headers, RENDER_CACHE_HEADER: 'COALESCED'}
+            return self._busy(diagram_type)
+        try:
+            granted, retry_after = self.acquire(diagram_type, lane)
+            if not granted:
+                flight.result = self._busy(diagram_type, retry_after)
+            else:
+                started = time.monotonic()
+                try:
+                    flight.result = work()
+                finally:
+                    self.release(diagram_type, time.monotonic() - started)
+        finally:
+            if flight.result is None:
+                flight.result = (500, 'application/json', json.dumps({'error': 'Render failed'}).encode(), {})
+            with self.lock:
+                del self.inflight[key]
+            flight.event.set()
+        return flight.result
+
+    def acquire(self, diagram_type, lane):
+        """Returns (True, None) once a slot is held, or (False, retry_after)."""
+        queued_at = time.monotonic()
+        with self.lock:
+            if self._has_room(diagram_type):
+                self._grant(diagram_type)
+                self.waits[lane].append(0.0)
+                return True, None
+            rank = RENDER_LANES.index(lane)
+            if sum(w.rank == rank for w in self.waiters) >= self.queue_size:
+                self.counters['rejected'] += 1
+                return False, self._retry_after(diagram_type)
+            self.seq += 1
+            waiter = _RenderWaiter(diagram_type, rank, self.seq)
+            self.waiters.append(waiter)
+            self.counters['queued'] += 1
+        waiter.event.wait(self.timeouts[lane])
+        with self.lock:
+            if not waiter.granted:
+                self.waiters.remove(waiter)
+                self.counters['timed_out'] += 1
+                return False, self._retry_after(diagram_type)
+        self.waits[lane].append(time.monotonic() - queued_at)
+        return True, None
+
+    def release(self, diagram_type, elapsed):
+        with self.lock:
+            self.active[diagram_type] -= 1
+            if not self.active[diagram_type]:
+                del self.active[diagram_type]
+            previous = self.service_times.get(diagram_type)
+            self.service_times[diagram_type] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+            for waiter in sorted(self.waiters, key=lambda w: (w.rank, w.seq)):
+                if waiter.diagram_type == diagram_type and self._has_room(diagram_type):
+                    self.waiters.remove(waiter)
+                    self._grant(diagram_type)
+                    waiter.granted = True
+                    waiter.event.set()
+
+    def limit(self, diagram_type):
+        return self.limits.get(diagram_type, self.default_limit)
+
+    def _has_room(self, diagram_type):
+        limit = self.limit(diagram_type)
+        return not limit or self.active.get(diagram_type, 0) < limit
+
+    def _grant(self, diagram_type):
+        self.active[diagram_type] = self.active.get(diagram_type, 0) + 1
+        self.counters['admitted'] += 1
+
+    def _retry_after(self, diagram_type):
+        service = self.service_times.get(diagram_type, self.DEFAULT_SERVICE_TIME)
+        waiting = sum(w.diagram_type == diagram_type for w in self.waiters)
+        estimate = service * (waiting + 1) / (self.limit(diagram_type) or 1)
+        return max(1, min(int(estimate + 0.999), 120))
+
+    def _busy(self, diagram_type, retry_after=None):
+        with self.lock:
+            retry_after = retry_after or self._retry_after(diagram_type)
+        body = {'error': RENDER_BUSY_COPY.format(seconds=retry_after), 'code': 'render_busy',
+                'retry_after': retry_after}
+        rejections.inc(('render_busy',))
+        return 503, 'application/json', json.dumps(body).encode(), {'Retry-After': str(retry_after)}
+
+    def stats(self):
+        with self.lock:
+            waiting = {lane: sum(w.rank == rank for w in self.waiters) for rank, lane in enumerate(RENDER_LANES)}
+            waits = {lane: sorted(self.waits[lane]) for lane in RENDER_LANES}
+            return {
+                'limits': {'default': self.default_limit, **self.limits},
+                'queue_size': self.queue_size,
+                'active': dict(self.active),
+                'waiting': waiting,
+                'in_flight_keys': len(self.inflight),
+                'wait_ms': {lane: _wait_summary(samples) for lane, samples in waits.items()},
+                'service_time_s': {t: round(s, 3) for t, s in self.service_times.items()},
+                **self.counters,
+            }
+
+
+def _wait_summary(samples):
+    if not samples:
+        return None
+    return {'p50': round(samples[len(samples) // 2] * 1000, 1),
+            'p95': round(samples[int(len(samples) * 0.95)] * 1000, 1),
+            'max': round(samples[-1] * 1000, 1)}
+
+
+render_scheduler = RenderScheduler(RENDER_MAX_CONCURRENT_PER_TYPE, RENDER_MAX_CONCURRENT_DEFAULT, RENDER_QUEUE_SIZE,
+                                   {'interactive': RENDER_QUEUE_TIMEOUT, 'bulk': RENDER_BULK_QUEUE_TIMEOUT})
+
+
+def render_lane(request):
+    """'bulk' when the client marked the render as background work."""
+    return 'bulk' if request.headers.get(RENDER_PRIORITY_HEADER, '').lower() == 'bulk' else 'interactive'
+
+
+# ---------------------------------------------------------------------------
+# Batch renders: many diagrams per request, results streamed as they finish
+# ---------------------------------------------------------------------------
+
+# Documentation builds render hundreds of diagrams; /api/render/batch takes
+# them in one request, renders them on a bounded per-worker thread pool
+# through the gateway (cache, coalescing and the bulk lane of the scheduler)
+# and streams each result back as soon as it is ready.
+RENDER_BATCH_MAX_ITEMS = int(os.environ.get('RENDER_BATCH_MAX_ITEMS', 500))
+RENDER_BATCH_MAX_BYTES = int(os.environ.get('RENDER_BATCH_MAX_BYTES', 16 * 1024 * 1024))
+# Pool threads per worker, shared by all batches; each batch keeps at most
+# RENDER_BATCH_PARALLEL items on it so concurrent batches interleave.
+RENDER_BATCH_THREADS = int(os.environ.get('RENDER_BATCH_THREADS', 8))
+RENDER_BATCH_PARALLEL = int(os.environ.get('RENDER_BATCH_PARALLEL', 4))
+# nginx counts a batch as one request, so its items are charged per client IP
+# against this allowance (flask-limiter notation, on the shared rate-limit
+# store); the default matches the public profile's 10r/s. Empty = no cap.
+RENDER_BATCH_ITEM_LIMIT = os.environ.get('RENDER_BATCH_ITEM_LIMIT', '600/minute;3000/hour')
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Output that is sent as-is in NDJSON; anything else is base64-encoded.
+_TEXT_RENDER_TYPES = ('text/', 'image/svg+xml', 'application/json', 'application/xml')
+
+_batch_pool = {'pid': None, 'executor': None}
+
+
+def batch_executor():
+    """This worker's render pool (threads do not survive the gunicorn fork)."""
+    pid = os.getpid()
+    with _render_lock:
+        if _batch_pool['pid'] != pid:
+            _batch_pool.update(pid=pid, executor=futures.ThreadPoolExecutor(
+                max_workers=RENDER_BATCH_THREADS, thread_name_prefix='render-batch'))
+        return _batch_pool['executor']
+
+
+def parse_render_batch(data):
+    """[(index, item id, fields or error string)] for a batch body, or an error string.
+
+    The body is a list of {type, format, source[, options][, id]} items, bare
+    or under "items".
+    """
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return 'Expected a non-empty list of {type, format, source} items'
+    if len(items) > RENDER_BATCH_MAX_ITEMS:
+        return f'At most {RENDER_BATCH_MAX_ITEMS} items per batch'
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            parsed.append((index, None, 'Item must be an object'))
+            continue
+        fields = check_render_fields(item.get('type'), item.get('format'), item.get('options') or {},
+                                     item.get('source'))
+        if not isinstance(fields, str) and fields[0] in DISABLED_DIAGRAM_TYPES:
+            fields = f"Diagram type '{fields[0]}' is disabled on this server"
+        parsed.append((index, item.get('id'), fields))
+    return parsed
+
+
+def _render_batch_item(fields):
+    try:
+        return render_via_gateway(*fields, lane='bulk')
+    except Exception as e:
+        logger.error(f"Batch render of {fields[0]}/{fields[1]} failed: {e}")
+        return 500, 'application/json', json.dumps({'error': 'Render failed'}).encode(), {}
+
+
+def render_batch(items, parallel=None):
+    """Yield (index, item id, type, format, result) in completion order.
+
+    Invalid items come first with a (400, ...) result; the rest are rendered
+    with at most `parallel` on the pool at once. Closing the generator (client
+    gone) cancels the items not yet started.
+    """
+    parallel = parallel or RENDER_BATCH_PARALLEL
+    queue = deque()
+    for index, item_id, fields in items:
+        if isinstance(fields, str):
+            body = json.dumps({'error': fields}).encode()
+            yield index, item_id, None, None, (400, 'application/json', body, {})
+        else:
+            queue.append((index, item_id, fields))
+    pending = {}
+    try:
+        while queue or pending:
+            while queue and len(pending) < parallel:
+                index, item_id, fields = queue.popleft()
+                pending[batch_executor().submit(_render_batch_item, fields)] = (index, item_id, fields)
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                index, item_id, fields = pending.pop(future)
+                yield index, item_id, fields[0], fields[1], future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def batch_ndjson_line(index, item_id, diagram_type, output_format, result):
+    status, content_type, body, headers = result
+    entry = {'index': index, 'id': item_id, 'type': diagram_type, 'format': output_format,
+             'status': status, 'cache': headers.get(RENDER_CACHE_HEADER), 'content_type': content_type}
+    if status != 200:
+        try:
+            error = json.loads(body).get('error')
+        except (ValueError, AttributeError):
+            error = body.decode('utf-8', 'replace')
+        entry['error'] = error or f'Render failed with status {status}'
+    elif content_type.startswith(_TEXT_RENDER_TYPES):
+        entry['data'] = body.decode('utf-8', 'replace')
+    else:
+        entry['encoding'] = 'base64'
+        entry['data'] = base64.b64encode(body).decode('ascii')
+    return json.dumps(entry, ensure_ascii=False) + '\n'
+
+
+def batch_multipart_part(boundary, index, item_id, diagram_type, output_format, result):
+    status, content_type, body, headers = result
+    part = [f'--{boundary}', f'Content-Type: {content_type}', f'Content-ID: <{index}>',
+            f'X-Render-Status: {status}', f'X-Render-Cache: {headers.get(RENDER_CACHE_HEADER) or "-"}']
+    if item_id is not None:
+        part.append(f'X-Render-Id: {json.dumps(item_id)}')
+    if diagram_type:
+        part.append(f'X-Render-Type: {diagram_type}/{output_format}')
+    return ('\r\n'.join(part) + '\r\n\r\n').encode('utf-8') + body + b'\r\n'
+
+
+# ---------------------------------------------------------------------------
+# Single-flight coalescing of identical in-flight relay calls (per worker)
+# ---------------------------------------------------------------------------
+
+# Identical payloads arriving while one is already upstream (double submits,
+# several tabs, a classroom pasting the same prompt) share that one call.
+AI_COALESCE_ENABLED = os.environ.get('AI_COALESCE_ENABLED', 'true').lower() == 'true'
+
+AI_COALESCE_HEADER = 'X-AI-Coalesced'
+
+
+class Flight:
+    """One upstream relay call that identical requests subscribe to.
+
+    A flight resolves either to a finished reply (non-streaming answers and
+    every error) or to a 200 SSE stream. Stream lines are buffered so a
+    subscriber that joins late replays the stream from the beginning. There
+    is no pump thread: whichever subscriber first needs a line that is not
+    buffered yet reads it from upstream while the others wait, so the stream
+    keeps flowing if the original requester disconnects. The upstream
+    response is closed once it ends or its last subscriber leaves.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.cond = threading.Condition()
+        self.ready = False
+        self.result = None       # (body bytes, status, headers) for finished replies
+        self.chunks = []         # buffered SSE lines of a 200 stream
+        self.done = False
+        self.subscribers = 1     # the leader
+        self._source = None
+        self._close = None
+        self._pumping = False
+
+    def publish(self, response):
+        """Resolve the flight with a finished Flask response."""
+        headers = [(k, v) for k, v in response.headers if k.lower() != 'content-length']
+        with self.cond:
+            self.result = (response.get_data(), response.status_code, headers)
+            self.ready = self.done = True
+            self.cond.notify_all()
+        land_flight(self)
+
+    def start_stream(self, lines, close):
+        """Resolve the flight with an upstream line iterator and its closer."""
+        with self.cond:
+            self._source = lines
+            self._close = close
+            self.ready = True
+            self.cond.notify_all()
+
+    def response(self, timeout, follower=False):
+        """Flask response for one subscriber (the leader or a follower)."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.ready, timeout)
+            if not self.ready:
+                self.subscribers -= 1
+                return jsonify({'error': 'Request timeout'}), 504
+        extra = {AI_COALESCE_HEADER: 'follower'} if follower else {}
+        if self.result is not None:
+            body, status, headers = self.result
+            return Response(body, status=status, headers=headers + list(extra.items()))
+        leave = self._leaver()
+        response = Response(stream_with_context(self._iter_stream(leave)),
+                            content_type='text/event-stream', headers=extra)
+        # A generator's finally never runs if it is closed before its first
+        # step (client gone before the body started), so closing the response
+        # must drop the subscriber as well.
+        response.call_on_close(leave)
+        return response
+
+    def _leaver(self):
+        """One-shot callback that drops a subscriber; the last one out ends the flight."""
+        left = []
+
+        def leave():
+            with self.cond:
+                if left:
+                    return
+                left.append(True)
+                self.subscribers -= 1
+                abandoned = self.subscribers == 0 and not self.done
+                if abandoned:
+                    self.done = True
+            if abandoned:
+                # Runs on GeneratorExit and response close too, so when every
+                # client has gone the upstream connection is released instead
+                # of leaked.
+                self._finish()
+
+        return leave
+
+    def _iter_stream(self, leave):
+        index = 0
+        try:
+            while True:
+                with self.cond:
+                    while index >= len(self.chunks) and not self.done and self._pumping:
+                        self.cond.wait()
+                    if index < len(self.chunks):
+                        chunk = self.chunks[index]
+                        index += 1
+                    elif self.done:
+                        return
+                    else:
+                        self._pumping = True
+                        chunk = None
+                if chunk is not None:
+                    yield chunk
+                    continue
+                self._pump()
+        finally:
+            leave()
+
+    def _pump(self):
+        """Read one upstream line into the buffer (caller holds the pump role)."""
+        finished = False
+        try:
+            line = next(self._source)
+        except StopIteration:
+            line, finished = None, True
+        except Exception as stream_err:
+            # Surface mid-stream upstream failures as a terminal SSE error frame
+            # so the client shows a real error instead of an empty/"invalid
+            # JSON" result.
+            logger.error(f"AI API stream interrupted: {stream_err}")
+            line, finished = STREAM_INTERRUPTED_FRAME, True
+        with self.cond:
+            if line is not None:
+                self.chunks.append(line)
+            if finished:
+                self.done = True
+            self._pumping = False
+            self.cond.notify_all()
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        with self.cond:
+            close, self._close = self._close, None
+        try:
+            if close is not None:
+                close()
+        finally:
+            land_flight(self)
+
+
+_inflight_lock = threading.Lock()
+_inflight = {}
+_coalesce_counters = {'leaders': 0, 'followers': 0}
+
+
+def coalesce_key(payload):
+    if not AI_COALESCE_ENABLED:
+        return None
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def join_flight(key):
+    """Return (flight, is_leader) for a payload key.
+
+    A None key (coalescing disabled) always gets a private, unregistered flight.
+    """
+    with _inflight_lock:
+        flight = _inflight.get(key) if key else None
+        if flight is not None:
+            with flight.cond:
+                if not (flight.done and flight.result is None):
+                    flight.subscribers += 1
+                    _coalesce_counters['followers'] += 1
+                    return flight, False
+        flight = Flight(key)
+        if key:
+            _inflight[key] = flight
+            _coalesce_counters['leaders'] += 1
+        return flight, True
+
+
+def count_coalesce(role):
+    """Record a 'leaders' or 'followers' join (also used by the ASGI relay)."""
+    with _inflight_lock:
+        _coalesce_counters[role] += 1
+
+
+def land_flight(flight):
+    with _inflight_lock:
+        if flight.key and _inflight.get(flight.key) is flight:
+            del _inflight[flight.key]
+
+
+def coalesce_stats():
+    with _inflight_lock:
+        return {'enabled': AI_COALESCE_ENABLED, 'in_flight': len(_inflight), **_coalesce_counters}
+
+
+# ---------------------------------------------------------------------------
+# Admission control: upstream concurrency slots + per-client fair queue
+# ---------------------------------------------------------------------------
+
+# Concurrent upstream calls allowed per worker, overall and per model
+# (0 = unlimited). Coalesced followers and cache hits never take a slot.
+AI_MAX_CONCURRENT = int(os.environ.get('AI_MAX_CONCURRENT', 32))
+AI_MAX_CONCURRENT_PER_MODEL = int(os.environ.get('AI_MAX_CONCURRENT_PER_MODEL', 16))
+# Requests that find every slot busy wait in a short bounded queue; past
+# AI_QUEUE_SIZE waiters, or after AI_QUEUE_TIMEOUT seconds, they get a 503.
+AI_QUEUE_SIZE = int(os.environ.get('AI_QUEUE_SIZE', 64))
+AI_QUEUE_TIMEOUT = float(os.environ.get('AI_QUEUE_TIMEOUT', 10))
+# Waiters are ordered per client ('session' cookie, falling back to the IP,
+# or 'ip'), so one user's many tabs queue behind everyone else's first turn.
+AI_FAIR_QUEUE_KEY = os.environ.get('AI_FAIR_QUEUE_KEY', 'session').lower()
+# Optional larger shares for known client IPs, e.g. "10.0.0.5=4,10.0.0.6=2".
+AI_FAIR_WEIGHTS = {}
+for _item in os.environ.get('AI_FAIR_WEIGHTS', '').split(','):
+    _ip, _, _weight = _item.partition('=')
+    if _ip.strip() and _weight.strip():
+        AI_FAIR_WEIGHTS[_ip.strip()] = max(float(_weight), 0.01)
+
+AI_BUSY_COPY = ('The AI service is currently unavailable: too many requests are in '
+                'progress on this server. Please try again in {seconds} seconds.')
+
+
+class AdmissionSlot:
+    """A granted upstream slot; release() it exactly when the upstream call ends."""
+
+    def __init__(self, controller, model):
+        self.controller = controller
+        self.model = model
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        self.controller.release(self)
+
+
+class _Waiter:
+    def __init__(self, model, start, seq, wake):
+        self.model = model
+        self.start = start
+        self.seq = seq
+        self.wake = wake
+        self.slot = None
+
+
+class AdmissionController:
+    """Global and per-model concurrency limits with start-time fair queuing.
+
+    Every admission (queued or not) is stamped with a virtual start tag:
+    max(virtual clock, the client's previous finish tag). A client's finish
+    tag advances by the model's observed service time divided by its weight,
+    so a client already holding slots gets later tags and its next waiter is
+    served after other clients' waiters. Freed slots go to the waiter with
+    the lowest tag whose model still has room. Observed service times also
+    drive the Retry-After sent with a 503.
+    """
+
+    # Assumed service time before a model has been observed (seconds).
+    DEFAULT_SERVICE_TIME = 5.0
+
+    def __init__(self, max_concurrent, max_per_model, queue_size, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_per_model = max_per_model
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_by_model = {}
+        self.waiters = []
+        self.vtime = 0.0
+        self.finish_tags = {}
+        self.service_times = {}
+        self.seq = 0
+        self.counters = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0}
+
+    def admit(self, client, model, timeout=None, weight=1.0):
+        """Block until a slot is free. Returns (slot, None) or (None, retry_after)."""
+        event = threading.Event()
+        slot, waiter, retry_after = self._enter(client, model, weight, event.set)
+        if waiter is None:
+            return slot, retry_after
+        event.wait(self._wait_time(timeout))
+        return self._leave(waiter)
+
+    async def admit_async(self, client, model, timeout=None, weight=1.0):
+        """Event-loop twin of admit() for the ASGI relay."""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        slot, waiter, retry_after = self._enter(
+            client, model, weight, lambda: loop.call_soon_threadsafe(event.set))
+        if waiter is None:
+            return slot, retry_after
+        try:
+            await asyncio.wait_for(event.wait(), self._wait_time(timeout))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            slot, _ = self._leave(waiter)
+            if slot is not None:
+                slot.release()
+            raise
+        return self._leave(waiter)
+
+    def release(self, slot):
+        with self.lock:
+            if slot.released:
+                return
+            slot.released = True
+            self.active -= 1
+            self.active_by_model[slot.model] -= 1
+            if not self.active_by_model[slot.model]:
+                del self.active_by_model[slot.model]
+            elapsed = time.monotonic() - slot.started
+            previous = self.service_times.get(slot.model)
+            self.service_times[slot.model] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+            woken = self._dispatch()
+        for waiter in woken:
+            waiter.wake()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_per_model': self.max_per_model,
+                'queue_size': self.queue_size,
+                'active': self.active,
+                'active_by_model': dict(self.active_by_model),
+                'waiting': len(self.waiters),
+                'service_time_s': {m: round(t, 3) for m, t in self.service_times.items()},
+                **self.counters,
+            }
+
+    def _wait_time(self, timeout):
+        return self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+
+    def _has_room(self, model):
+        if self.max_concurrent and self.active >= self.max_concurrent:
+            return False
+        if self.max_per_model and self.active_by_model.get(model, 0) >= self.max_per_model:
+            return False
+        return True
+
+    def _grant(self, model):
+        self.active += 1
+        self.active_by_model[model] = self.active_by_model.get(model, 0) + 1
+        self.counters['admitted'] += 1
+        return AdmissionSlot(self, model)
+
+    def _enter(self, client, model, weight, wake):
+        """Returns (slot, None, None), (None, waiter, None) or (None, None, retry_after)."""
+        with self.lock:
+            start = max(self.vtime, self.finish_tags.get(client, 0.0))
+            cost = self.service_times.get(model, self.DEFAULT_SERVICE_TIME) / weight
+            if not self.waiters and self._has_room(model):
+                self.vtime = start
+                self._stamp(client, start + cost)
+                return self._grant(model), None, None
+            if len(self.waiters) >= self.queue_size:
+                self.counters['rejected'] += 1
+                return None, None, self._retry_after(model)
+            self._stamp(client, start + cost)
+            self.seq += 1
+            waiter = _Waiter(model, start, self.seq, wake)
+            self.waiters.append(waiter)
+            self.counters['queued'] += 1
+            woken = self._dispatch()
+        for other in woken:
+            other.wake()
+        return None, waiter, None
+
+    def _leave(self, waiter):
+        """Collect a waiter after it was woken or timed out."""
+        with self.lock:
+            if waiter.slot is not None:
+                return waiter.slot, None
+            self.waiters.remove(waiter)
+            self.counters['timed_out'] += 1
+            return None, self._retry_after(waiter.model)
+
+    def _dispatch(self):
+        """Hand freed slots to eligible waiters in tag order (caller holds the lock)."""
+        woken = []
+        for waiter in sorted(self.waiters, key=lambda w: (w.start, w.seq)):
+            if self.max_concurrent and self.active >= self.max_concurrent:
+                break
+            if self._has_room(waiter.model):
+                self.waiters.remove(waiter)
+                self.vtime = max(self.vtime, waiter.start)
+                waiter.slot = self._grant(waiter.model)
+                woken.append(waiter)
+        return woken
+
+    def _stamp(self, client, finish):
+        self.finish_tags[client] = finish
+        if len(self.finish_tags) > 4096:
+            # Clients whose tags the virtual clock has passed carry no history.
+            self.finish_tags = {c: t for c, t in self.finish_tags.items() if t > self.vtime}
+
+    def _retry_after(self, model):
+        """Seconds until a slot is likely free: queue depth x observed service time."""
+        service = self.service_times.get(model, self.DEFAULT_SERVICE_TIME)
+        slots = self.max_per_model or self.max_concurrent or 1
+        if self.max_concurrent:
+            slots = min(slots, self.max_concurrent)
+        estimate = service * (len(self.waiters) + 1) / slots
+        return max(1, min(int(estimate + 0.999), 120))
+
+
+ai_admission = AdmissionController(AI_MAX_CONCURRENT, AI_MAX_CONCURRENT_PER_MODEL,
+                                   AI_QUEUE_SIZE, AI_QUEUE_TIMEOUT)
+
+
+def admission_client(request):
+    """(fair-queue key, weight) for a relay request (flask.Request or AsgiRequest)."""
+    ip = request.remote_addr or 'unknown'
+    weight = AI_FAIR_WEIGHTS.get(ip, 1.0)
+    if AI_FAIR_QUEUE_KEY == 'session':
+        token = request.cookies.get(SESSION_COOKIE_NAME, '')
+        if validate_session_token(token):
+            return 'session:' + token.rsplit('.', 1)[0], weight
+    return 'ip:' + ip, weight
+
+
+def admit_relay(relay):
+    """Take an upstream slot for a relay call; (slot, None) or (None, busy reply)."""
+    slot, retry_after = ai_admission.admit(relay['client'], relay['model'],
+                                           relay['timeout'], relay['weight'])
+    if slot is None:
+        return None, busy_reply(relay['model'], retry_after)
+    # Claim a half-open breaker's probe only now that the call really goes
+    # upstream; another request may have taken it since select_model().
+    retry_after = claim_model(relay['model'])
+    if retry_after is not None:
+        slot.release()
+        return None, unavailable_reply(retry_after)
+    return slot, None
+
+
+def busy_reply(model, retry_after):
+    """(body, status, headers) for a request turned away by admission control."""
+    logger.warning(f"AI relay busy for model {model}; asking client to retry in {retry_after}s")
+    rejections.inc(('ai_busy',))
+    body = {'error': AI_BUSY_COPY.format(seconds=retry_after), 'retry_after': retry_after}
+    return body, 503, {'Retry-After': str(retry_after)}
+
+
+# ---------------------------------------------------------------------------
+# Per-model circuit breakers + runtime failover across AI_MODEL_FALLBACKS
+# ---------------------------------------------------------------------------
+
+# A model's breaker opens when, over its last AI_BREAKER_WINDOW seconds (and at
+# least AI_BREAKER_MIN_REQUESTS calls), the failure rate reaches
+# AI_BREAKER_ERROR_RATE or the p95 latency reaches AI_BREAKER_SLOW_SECONDS.
+AI_BREAKER_ENABLED = os.environ.get('AI_BREAKER_ENABLED', 'true').lower() == 'true'
+AI_BREAKER_WINDOW = float(os.environ.get('AI_BREAKER_WINDOW', 60))
+AI_BREAKER_MIN_REQUESTS = int(os.environ.get('AI_BREAKER_MIN_REQUESTS', 5))
+AI_BREAKER_ERROR_RATE = float(os.environ.get('AI_BREAKER_ERROR_RATE', 0.5))
+AI_BREAKER_SLOW_SECONDS = float(os.environ.get('AI_BREAKER_SLOW_SECONDS', 45))
+# Seconds an open breaker waits before letting a single half-open probe through.
+AI_BREAKER_COOLDOWN = float(os.environ.get('AI_BREAKER_COOLDOWN', 30))
+
+AI_MODEL_HEADER = 'X-AI-Model'
+
+AI_UNAVAILABLE_COPY = ('The AI service is currently unavailable: the selected model and its '
+                       'fallbacks are failing. Please try again in {seconds} seconds.')
+
+
+class CircuitBreaker:
+    """Rolling error-rate / p95-latency breaker for one model.
+
+    closed -> open when the window trips; open -> half-open after the
+    cooldown, admitting one probe at a time; the probe's outcome closes the
+    breaker (fresh window) or re-opens it for another cooldown.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.state = 'closed'
+        self.samples = []        # (monotonic time, ok, latency seconds)
+        self.opened_at = 0.0
+        self.probe_started = None
+        self.trips = 0
+
+    def allow(self, now):
+        """Whether a request may be sent to this model now (claims nothing)."""
+        if self.state == 'closed':
+            return True
+        if now - self.opened_at < AI_BREAKER_COOLDOWN:
+            return False
+        # Half-open: one probe at a time; a probe that never reported back
+        # (client gone mid-call) is replaced after another cooldown.
+        return self.probe_started is None or now - self.probe_started >= AI_BREAKER_COOLDOWN
+
+    def claim(self, now):
+        """allow(), and for a call that is about to go upstream take the probe."""
+        if not self.allow(now):
+            return False
+        if self.state != 'closed':
+            self.state = 'half_open'
+            self.probe_started = now
+        return True
+
+    def record(self, now, ok, latency):
+        if self.state == 'half_open':
+            self.probe_started = None
+            if ok:
+                logger.warning(f"AI circuit breaker for '{self.model}' closed after a successful probe")
+                self.state = 'closed'
+                self.samples = []
+            else:
+                self._open(now, 'probe failed')
+            return
+        self.samples.append((now, ok, latency))
+        horizon = now - AI_BREAKER_WINDOW
+        while self.samples and self.samples[0][0] < horizon:
+            self.samples.pop(0)
+        if self.state != 'closed' or len(self.samples) < AI_BREAKER_MIN_REQUESTS:
+            return
+        error_rate, p95 = self._window()
+        if error_rate >= AI_BREAKER_ERROR_RATE:
+            self._open(now, f"error rate {error_rate:.0%}")
+        elif p95 >= AI_BREAKER_SLOW_SECONDS:
+            self._open(now, f"p95 latency {p95:.1f}s")
+
+    def retry_after(self, now):
+        return max(1, int(AI_BREAKER_COOLDOWN - (now - self.opened_at) + 0.999))
+
+    def stats(self):
+        error_rate, p95 = self._window()
+        return {'state': self.state, 'samples': len(self.samples), 'error_rate': round(error_rate, 3),
+                'p95_s': round(p95, 3), 'trips': self.trips}
+
+    def _window(self):
+        if not self.samples:
+            return 0.0, 0.0
+        failures = sum(1 for _, ok, _ in self.samples if not ok)
+        latencies = sorted(latency for _, _, latency in self.samples)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        return failures / len(self.samples), p95
+
+    def _open(self, now, reason):
+        logger.warning(f"AI circuit breaker for '{self.model}' opened ({reason}); failing over for {AI_BREAKER_COOLDOWN:.0f}s")
+        self.state = 'open'
+        self.opened_at = now
+        self.samples = []
+        self.trips += 1
+
+
+_breaker_lock = threading.Lock()
+_breakers = {}
+
+
+def _breaker(model):
+    """Caller holds _breaker_lock."""
+    if model not in _breakers:
+        _breakers[model] = CircuitBreaker(model)
+    return _breakers[model]
+
+
+def select_model(requested, registry):
+    """Pick the model to relay to: `requested` unless its breaker is open.
+
+    Fails over along [requested, AI_MODEL, *AI_MODEL_FALLBACKS] (models in
+    the registry only) to the first one whose breaker admits the call.
+    Returns (model, None), or (None, retry_after) when every candidate is open.
+    A half-open probe is not claimed here: the request may still be answered
+    from the cache or a coalesced flight, so admit_relay() claims it.
+    """
+    if not AI_BREAKER_ENABLED:
+        return requested, None
+    candidates = []
+    for model in [requested, DEFAULT_AI_CONFIG['model'], *AI_MODEL_FALLBACKS]:
+        if model and model not in candidates and (model == requested or model in registry):
+            candidates.append(model)
+    now = time.monotonic()
+    with _breaker_lock:
+        for model in candidates:
+            if _breaker(model).allow(now):
+                if model != requested:
+                    logger.warning(f"AI model '{requested}' is unhealthy; failing over to '{model}'")
+                return model, None
+        return None, min(_breaker(model).retry_after(now) for model in candidates)
+
+
+def claim_model(model):
+    """Claim `model`'s breaker for a call going upstream now; None, or retry-after seconds."""
+    if not AI_BREAKER_ENABLED or not model:
+        return None
+    now = time.monotonic()
+    with _breaker_lock:
+        breaker = _breaker(model)
+        return None if breaker.claim(now) else breaker.retry_after(now)
+
+
+def unavailable_reply(retry_after):
+    """(body, status, headers) for a call whose model (and every fallback) is open."""
+    body = {'error': AI_UNAVAILABLE_COPY.format(seconds=retry_after), 'retry_after': retry_after}
+    return body, 503, {'Retry-After': str(retry_after)}
+
+
+def breaker_outcome(status_code):
+    """True/False for a healthy/failing upstream reply; None if it says nothing about the model."""
+    if status_code == 200:
+        return True
+    if status_code in (408, 429) or status_code >= 500:
+        return False
+    return None
+
+
+def record_model_result(model, ok, latency, status=None):
+    """Feed one upstream outcome (ok=None is ignored) into the model's breaker
+    and the upstream metrics (status None = no HTTP reply)."""
+    record_upstream(model, status, latency)
+    if not AI_BREAKER_ENABLED or ok is None:
+        return
+    with _breaker_lock:
+        _breaker(model).record(time.monotonic(), ok, latency)
+
+
+def breaker_stats():
+    with _breaker_lock:
+        return {model: breaker.stats() for model, breaker in _breakers.items()}
+
+
+# ---------------------------------------------------------------------------
+# Token budgets (per IP, per session, global) and the AI usage ledger
+# ---------------------------------------------------------------------------
+
+# Token allowances in flask-limiter notation ("200000/day;20000/hour"), kept on
+# the shared rate-limit store so every worker spends from one budget. Checked
+# before the upstream call against an estimate, then charged with the usage
+# the model reports. Empty = no budget for that scope.
+AI_TOKEN_BUDGET_PER_IP = os.environ.get('AI_TOKEN_BUDGET_PER_IP', '')
+AI_TOKEN_BUDGET_PER_SESSION = os.environ.get('AI_TOKEN_BUDGET_PER_SESSION', '')
+AI_TOKEN_BUDGET_GLOBAL = os.environ.get('AI_TOKEN_BUDGET_GLOBAL', '')
+# Ask OpenAI-compatible upstreams to end streams with a usage chunk.
+AI_STREAM_USAGE = os.environ.get('AI_STREAM_USAGE', 'true').lower() == 'true'
+# Rough prompt-size estimate used before the model reports real counts.
+AI_CHARS_PER_TOKEN = 4
+
+# JSON-lines usage ledger shared by all workers; empty = off. Records are
+# buffered and appended every AI_USAGE_FLUSH_INTERVAL seconds (or once
+# AI_USAGE_FLUSH_BATCH are pending), never fsynced per request. The ledger is
+# split into one file per UTC day (doccode-ai-usage.YYYY-MM-DD.jsonl) and days
+# older than AI_USAGE_RETENTION_DAYS are deleted (0 = keep everything).
+AI_USAGE_LEDGER = os.environ.get('AI_USAGE_LEDGER', '/tmp/doccode-ai-usage.jsonl')
+AI_USAGE_FLUSH_INTERVAL = float(os.environ.get('AI_USAGE_FLUSH_INTERVAL', 5))
+AI_USAGE_FLUSH_BATCH = int(os.environ.get('AI_USAGE_FLUSH_BATCH', 256))
+AI_USAGE_RETENTION_DAYS = int(os.environ.get('AI_USAGE_RETENTION_DAYS', 90))
+
+TOKEN_BUDGET_COPY = ("The AI token budget for {scope} is used up. "
+                     "Please try again in {seconds} seconds.")
+
+
+class TokenBudget:
+    """Tokens spent per key in clock-aligned windows, on a `limits` storage."""
+
+    def __init__(self, scope, spec):
+        self.scope = scope
+        self.items = parse_many(spec) if spec else []
+
+    def _windows(self, key, now):
+        for item in self.items:
+            expiry = item.get_expiry()
+            yield item, f'token-budget/{self.scope}/{key}/{expiry}/{int(now // expiry)}', expiry
+
+    def retry_after(self, storage, key, tokens):
+        """None if `tokens` more fit every window, else seconds until one resets."""
+        now = time.time()
+        for item, window, expiry in self._windows(key, now):
+            if storage.get(window) + tokens > item.amount:
+                return max(1, int(expiry - now % expiry))
+        return None
+
+    def charge(self, storage, key, tokens):
+        for _, window, expiry in self._windows(key, time.time()):
+            storage.incr(window, expiry, tokens)
+
+
+TOKEN_BUDGETS = [budget for budget in (
+    TokenBudget('ip', AI_TOKEN_BUDGET_PER_IP),
+    TokenBudget('session', AI_TOKEN_BUDGET_PER_SESSION),
+    TokenBudget('global', AI_TOKEN_BUDGET_GLOBAL),
+) if budget.items]
+_budget_storage = {}
+
+
+def budget_storage():
+    """The rate-limit store, opened once per process."""
+    if _budget_storage.get('pid') != os.getpid():
+        _budget_storage.update(pid=os.getpid(), storage=storage_from_string(RATELIMIT_STORAGE_URI))
+    return _budget_storage['storage']
+
+
+def token_budget_keys(request):
+    """{scope: key} charged for a relay request (flask.Request or AsgiRequest)."""
+    keys = {'ip': request.remote_addr or 'unknown', 'global': 'all'}
+    token = request.cookies.get(SESSION_COOKIE_NAME, '')
+    if validate_session_token(token):
+        keys['session'] = token.rsplit('.', 1)[0]
+    return keys
+
+
+def estimate_tokens(payload):
+    """Upper-bound cost of a call: prompt characters / 4 plus the completion cap."""
+    prompt = len(json.dumps(payload.get('messages', []))) // AI_CHARS_PER_TOKEN
+    completion = payload.get('max_completion_tokens') or payload.get('max_tokens') or AI_MAX_TOKENS
+    return prompt + completion
+
+
+def check_token_budgets(relay):
+    """None, or the (body, 429, headers) reply when the estimate exceeds a budget."""
+    if not TOKEN_BUDGETS:
+        return None
+    storage = budget_storage()
+    for budget in TOKEN_BUDGETS:
+        key = relay['budget_keys'].get(budget.scope)
+        retry_after = key and budget.retry_after(storage, key, relay['estimate'])
+        if retry_after:
+            logger.warning(f"AI token budget ({budget.scope}) exhausted; retry in {retry_after}s")
+            rejections.inc(('token_budget',))
+            body = {'error': TOKEN_BUDGET_COPY.format(scope=budget.scope, seconds=retry_after),
+                    'code': 'token_budget', 'scope': budget.scope, 'retry_after': retry_after}
+            return body, 429, {'Retry-After': str(retry_after)}
+    return None
+
+
+def usage_from_sse_line(line):
+    """The `usage` object of an SSE data line, if it carries one."""
+    if '"usage"' not in line or not line.startswith('data:'):
+        return None
+    try:
+        usage = json.loads(line[5:]).get('usage')
+    except (ValueError, AttributeError):
+        return None
+    return usage if isinstance(usage, dict) else None
+
+
+def record_usage(relay, usage):
+    """Charge the budgets and append a ledger entry for one upstream call.
+
+    Without a usage report (aborted stream, upstream that omits it) the
+    pre-call estimate is charged instead, so budgets err on the safe side.
+    """
+    usage = usage if isinstance(usage, dict) else {}
+    prompt = int(usage.get('prompt_tokens') or 0)
+    completion = int(usage.get('completion_tokens') or 0)
+    total = int(usage.get('total_tokens') or prompt + completion)
+    estimated = total == 0
+    if estimated:
+        total = relay['estimate']
+    if TOKEN_BUDGETS:
+        storage = budget_storage()
+        for budget in TOKEN_BUDGETS:
+            key = relay['budget_keys'].get(budget.scope)
+            if key:
+                budget.charge(storage, key, total)
+    usage_ledger.record({
+        'ts': round(time.time(), 3),
+        'model': relay['model'],
+        'requested_model': relay['requested_model'],
+        'stream': relay['stream'],
+        'client': _sign_session(relay['client'])[:16],  # keyed hash, no raw IPs on disk
+        'prompt_tokens': prompt,
+        'completion_tokens': completion,
+        'total_tokens': total,
+        'estimated': estimated,
+    })
+
+
+def _utc_day(ts):
+    return time.strftime('%Y-%m-%d', time.gmtime(ts))
+
+
+class UsageLedger:
+    """Append-only JSON-lines record of AI token usage, written in batches.
+
+    record() only appends to a list; a per-process writer thread flushes it
+    with a single O_APPEND write per day file, so entries from several
+    workers never interleave and the relay never waits on the disk. Entries
+    go to the file of their UTC day, so entries(since) only reads the days it
+    asks for and old days can be deleted whole.
+    """
+
+    def __init__(self, path, interval, batch, retention_days=0):
+        self.path = path
+        self.interval = interval
+        self.batch = batch
+        self.retention_days = retention_days
+        self._pruned_before = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer_pid = None
+        self.written = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def record(self, entry):
+        if not self.path:
+            return
+        with self._lock:
+            self._pending.append(entry)
+            full = len(self._pending) >= self.batch
+            if self._writer_pid != os.getpid():
+                # Threads do not survive the gunicorn fork: one writer per process.
+                self._writer_pid = os.getpid()
+                threading.Thread(target=self._run, name='usage-ledger', daemon=True).start()
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def day_path(self, day):
+        root, ext = os.path.splitext(self.path)
+        return f'{root}.{day}{ext}'
+
+    def _day_files(self):
+        """{day: path} of the ledger files on disk."""
+        directory, name = os.path.split(self.path)
+        root, ext = os.path.splitext(name)
+        try:
+            names = os.listdir(directory or '.')
+        except OSError:
+            return {}
+        days = {}
+        for file in names:
+            day = file[len(root) + 1:len(file) - len(ext)]
+            if file.startswith(root + '.') and file.endswith(ext) and len(day) == 10:
+                days[day] = os.path.join(directory, file)
+        return days
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        by_day = {}
+        for entry in batch:
+            by_day.setdefault(_utc_day(entry.get('ts', 0)), []).append(entry)
+        for day, entries in sorted(by_day.items()):
+            path = self.day_path(day)
+            data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries).encode('utf-8')
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                self.errors += 1
+                logger.warning(f"Could not append {len(entries)} entries to usage ledger {path}: {e}")
+                continue
+            self.written += len(entries)
+        self.flushes += 1
+        self._prune()
+
+    def _prune(self):
+        """Delete day files past the retention window (checked once per day)."""
+        if not self.retention_days:
+            return
+        cutoff = _utc_day(time.time() - self.retention_days * 86400)
+        if cutoff == self._pruned_before:
+            return
+        self._pruned_before = cutoff
+        for day, path in self._day_files().items():
+            if day < cutoff:
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    logger.warning(f"Could not delete expired usage ledger {path}: {e}")
+
+    def entries(self, since=0.0):
+        """Ledger entries at or after `since`, including this process's unflushed ones."""
+        with self._lock:
+            pending = list(self._pending)
+        first_day = _utc_day(since)
+        for day, path in sorted(self._day_files().items()):
+            if day < first_day:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue  # a torn last line after a crash
+                        if entry.get('ts', 0) >= since:
+                            yield entry
+            except OSError:
+                pass
+        yield from (entry for entry in pending if entry['ts'] >= since)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'path': self.path or None, 'pending': pending, 'written': self.written,
+                'flushes': self.flushes, 'errors': self.errors}
+
+
+usage_ledger = UsageLedger(AI_USAGE_LEDGER, AI_USAGE_FLUSH_INTERVAL, AI_USAGE_FLUSH_BATCH,
+                           AI_USAGE_RETENTION_DAYS)
+atexit.register(usage_ledger.flush)
+
+USAGE_GROUPS = {
+    'model': lambda entry: entry.get('model') or 'unknown',
+    'day': lambda entry: _utc_day(entry.get('ts', 0)),
+    'client': lambda entry: entry.get('client') or 'unknown',
+}
+
+
+def aggregate_usage(entries, group_by):
+    def bucket():
+        return {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'estimated': 0}
+
+    totals, groups = bucket(), {}
+    key_of = USAGE_GROUPS[group_by]
+    for entry in entries:
+        for target in (totals, groups.setdefault(key_of(entry), bucket())):
+            target['requests'] += 1
+            target['estimated'] += bool(entry.get('estimated'))
+            for field in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+                target[field] += entry.get(field, 0)
+    return totals, dict(sorted(groups.items()))
+
+
+def _per_ip_limit():
+    """Return the per-IP daily limit string, or a harmless fallback."""
+    return AI_DAILY_LIMIT_PER_IP or '1000000/day'
+
+
+# Terminal SSE frame sent when the upstream stream dies after headers went out.
+STREAM_INTERRUPTED_FRAME = 'data: ' + json.dumps({'error': 'The AI stream was interrupted. Please try again.'}) + '\n'
+
+
+def check_ai_access(request):
+    """Origin, mode and auth gates shared by the WSGI and ASGI relays.
+
+    Returns None when the request may proceed, else an (error body, status)
+    tuple. Order matters: origin first, then the mode gate (so byok/off
+    clients see 503 rather than a phantom auth error), then authentication.
+    """
+    # Browsers always send Origin on POST, so require it, and demand a session
+    # cookie (or the shared access token) so the relay cannot be driven by
+    # arbitrary network clients on the server's key.
+    if not validate_origin(request, require=True):
+        return {'error': 'Unauthorized origin'}, 403
+
+    if AI_MODE != 'relay':
+        return {
+            'error': ('The AI relay is disabled on this server. Add your own '
+                      'OpenAI-compatible endpoint and API key in Settings → AI Assistant.'),
+            'mode': AI_MODE,
+        }, 503
+
+    if not authorize_ai_request(request):
+        return {'error': 'Unauthorized. Please reload the page and try again.'}, 401
+    return None
+
+
+def prepare_ai_relay(data, remote_addr=None):
+    """Validate a parsed /api/ai-assist body and build the upstream call.
+
+    Returns (relay, None) on success, where relay holds endpoint, headers,
+    payload, timeout, model (the one actually relayed to), requested_model,
+    stream, estimate (tokens, see estimate_tokens) and repair (see
+    repair_options); or (None, (error body, status[, headers])).
+    """
+    # H6: Belt-and-suspenders — pop client-supplied key/endpoint so they
+    # can never appear in any log entry, even if logging expands later.
+    if isinstance(data, dict) and isinstance(data.get('config'), dict):
+        data['config'].pop('api_key', None)
+        data['config'].pop('endpoint', None)
+
+    if not data or 'messages' not in data:
+        return None, ({'error': 'Missing messages in request'}, 400)
+
+    # Extract configuration from request or use defaults
+    config = data.get('config', {})
+    model = data.get('model', DEFAULT_AI_CONFIG['model'])  # Get model from top-level, not from config
+
+    # Client-supplied timeout must be numeric and is clamped so a request
+    # cannot pin server threads on arbitrarily long upstream connections.
+    try:
+        timeout = float(config.get('timeout', DEFAULT_AI_CONFIG['timeout']))
+    except (TypeError, ValueError):
+        return None, ({'error': 'Invalid timeout value'}, 400)
+    timeout = max(1, min(timeout, AI_TIMEOUT_MAX))
+
+    # Validate model against allowed models from JSON to prevent model injection.
+    # One registry snapshot serves the whole request, even across a refresh.
+    registry = MODEL_REGISTRY
+    if model:
+        # Check if the requested model is in our allowed list
+        if model not in registry:
+            logger.warning(f"Model injection attempt detected: '{model}' not in allowed models list. Request from: {remote_addr}")
+            return None, ({'error': f'Model "{model}" is not supported. Please select from available models.'}, 400)
+
+        logger.info(f"Validated model '{model}' against allowed models list")
+    else:
+        # If no model provided, use default (which should also be validated)
+        if DEFAULT_AI_CONFIG['model'] not in registry:
+            logger.error(f"Default model '{DEFAULT_AI_CONFIG['model']}' is not in allowed models list")
+            return None, ({'error': 'Server configuration error: default model not supported'}, 500)
+
+    # This endpoint ONLY ever proxies to the trusted, server-configured AI
+    # proxy. Direct/custom API endpoints are handled entirely client-side, so
+    # /api/ai-assist cannot be used as an SSRF / open relay to arbitrary URLs.
+    endpoint = f"{AI_PROXY_URL}/chat/completions"
+    api_key = AI_PROXY_API_KEY
+
+    if not api_key:
+        return None, ({'error': 'Backend proxy API key not configured'}, 400)
+
+    logger.info(f"Using backend proxy: {endpoint}")
+
+    # Runtime failover: while the requested model's circuit breaker is open the
+    # call goes to the next healthy fallback instead of waiting out a timeout.
+    requested_model = model
+    if model:
+        model, retry_after = select_model(requested_model, registry)
+        if model is None:
+            return None, unavailable_reply(retry_after)
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {api_key}'
+    }
+
+    # Build payload with provider-specific parameter handling
+    ai_payload = build_ai_payload(model, data['messages'], data)
+    stream = bool(data.get('stream'))
+    if stream:
+        ai_payload['stream'] = True
+        if AI_STREAM_USAGE:
+            ai_payload['stream_options'] = {'include_usage': True}
+
+    logger.info(f"Proxying AI request to {endpoint} with model {model}")
+    return {
+        'endpoint': endpoint,
+        'headers': headers,
+        'payload': ai_payload,
+        'timeout': timeout,
+        'model': model,
+        'requested_model': requested_model,
+        'stream': stream,
+        'estimate': estimate_tokens(ai_payload),
+        'repair': repair_options(data, stream),
+    }, None
+
+
+def upstream_error_body(status_code, error_data, text, resp_headers):
+    """Map a non-200 upstream reply to the (error body, status) sent to the client.
+
+    error_data is the parsed JSON body (None if it was not JSON). Upstream
+    quota/billing errors (429/402) become the client-visible free-quota state.
+    """
+    error_data = error_data if isinstance(error_data, dict) else {}
+    error = error_data.get('error') if isinstance(error_data.get('error'), dict) else {}
+
+    if status_code in (429, 402):
+        # Extract retry_after from metadata headers
+        hdrs = error.get('metadata', {}).get('headers', {})
+        retry_after = hdrs.get('X-RateLimit-Reset') or resp_headers.get('Retry-After')
+        error_msg = error.get('message', '') if error_data else (text or '')
+        logger.warning(f"Upstream quota/billing error {status_code}: {error_msg}")
+        return {
+            'error': FREE_QUOTA_COPY,
+            'code': 'free_quota_exhausted',
+            'retry_after': retry_after,
+        }, 429
+
+    error_msg = f"AI API error: {status_code}"
+    if error:
+        error_msg = error.get('message', error_msg)
+    elif not error_data and text:
+        error_msg = text
+    logger.error(f"AI API error: {error_msg}")
+    return {'error': error_msg}, status_code
+
+
+def _upstream_error_response(resp):
+    try:
+        error_data = resp.json()
+    except Exception:
+        error_data = None
+    body, status = upstream_error_body(resp.status_code, error_data, resp.text, resp.headers)
+    return jsonify(body), status
+
+
+def upstream_failure_body(error):
+    """Map an exception from the upstream call to (error body, status)."""
+    if isinstance(error, requests.exceptions.Timeout):
+        logger.error("AI API request timeout")
+        return {'error': 'Request timeout'}, 504
+    if isinstance(error, requests.exceptions.ConnectionError):
+        logger.error("Failed to connect to AI API")
+        return {'error': 'Failed to connect to AI service'}, 503
+    logger.error(f"Unexpected error in AI assist: {error}")
+    return {'error': 'Internal server error'}, 500
+
+
+def _upstream_failure_response(error):
+    """Map an exception from the upstream call to the client reply."""
+    body, status = upstream_failure_body(error)
+    return jsonify(body), status
+
+
+def _as_response(result):
+    """Normalize a view-style return value ((response, status) or response)."""
+    if isinstance(result, tuple):
+        response, status = result
+        response.status_code = status
+        return response
+    return result
+
+
+def _relay_reply(reply):
+    """Flask response for a (body, status, headers) relay reply: admission and
+    token-budget denials, repair-loop answers."""
+    body, status, headers = reply
+    response = jsonify(body)
+    response.status_code = status
+    response.headers.update(headers)
+    return response
+
+
+def _served_by(result, relay):
+    """Tag a relay reply with the model that answered it (it differs after failover)."""
+    response = _as_response(result)
+    if relay['model']:
+        response.headers[AI_MODEL_HEADER] = relay['model']
+    return response
+
+
+def _relay_stream(relay):
+    flight, leader = join_flight(coalesce_key(relay['payload']))
+    if not leader:
+        logger.info(f"Joined in-flight AI stream for model {relay['model']}")
+        return flight.response(relay['timeout'], follower=True)
+
+    timer = StreamTimer(relay['model'])
+    slot, busy = admit_relay(relay)
+    if busy:
+        flight.publish(_relay_reply(busy))
+        return flight.response(relay['timeout'])
+
+    start_time = time.time()
+    take_connect_time()  # drop a connect left over from this thread's last call
+    timer.request_sent()
+    try:
+        resp = upstream_session().post(
+            relay['endpoint'],
+            headers=relay['headers'],
+            json=relay['payload'],
+            stream=True,
+            timeout=relay['timeout']
+        )
+    except Exception as e:
+        slot.release()
+        record_model_result(relay['model'], False, time.time() - start_time)
+        flight.publish(_as_response(_upstream_failure_response(e)))
+        return flight.response(relay['timeout'])
+
+    timer.response_started(take_connect_time())
+    record_model_result(relay['model'], breaker_outcome(resp.status_code), time.time() - start_time,
+                        resp.status_code)
+    if resp.status_code != 200:
+        try:
+            flight.publish(_as_response(_upstream_error_response(resp)))
+        finally:
+            resp.close()
+            slot.release()
+        return flight.response(relay['timeout'])
+
+    usage = {'bytes': 0}
+
+    def close():
+        # Release first; a failing usage write must not strand the slot or gauge.
+        try:
+            resp.close()
+        finally:
+            slot.release()
+            ai_active_streams.inc(amount=-1)
+            ai_relay_bytes.inc(('stream',), usage['bytes'])
+            try:
+                record_usage(relay, usage.get('usage'))
+            finally:
+                timer.finish(usage.get('usage'), usage['bytes'])
+
+    def lines():
+        try:
+            for raw in resp.iter_lines():
+                if raw:
+                    line = raw.decode('utf-8')
+                    usage['usage'] = usage_from_sse_line(line) or usage.get('usage')
+                    usage['bytes'] += len(raw) + 1
+                    timer.line(line)
+                    yield line + '\n'
+            timer.outcome = 'complete'
+        except Exception:
+            timer.outcome = 'interrupted'
+            raise
+
+    ai_active_streams.inc()
+    flight.start_stream(lines(), close)
+    return flight.response(relay['timeout'])
+
+
+def _relay_once(relay, cache_key):
+    flight, leader = join_flight(coalesce_key(relay['payload']))
+    if not leader:
+        logger.info(f"Joined in-flight AI request for model {relay['model']}")
+        return flight.response(relay['timeout'], follower=True)
+
+    slot, busy = admit_relay(relay)
+    if busy:
+        flight.publish(_relay_reply(busy))
+        return flight.response(relay['timeout'])
+
+    try:
+        start_time = time.time()
+        response = upstream_session().post(
+            relay['endpoint'],
+            headers=relay['headers'],
+            json=relay['payload'],
+            timeout=relay['timeout']
+        )
+
+        response_time = time.time() - start_time
+        logger.info(f"AI API response received in {response_time:.2f}s, status: {response.status_code}")
+        record_model_result(relay['model'], breaker_outcome(response.status_code), response_time,
+                            response.status_code)
+
+        # Handle response
+        if response.status_code == 200:
+            ai_response = response.json()
+            record_usage(relay, ai_response.get('usage') if isinstance(ai_response, dict) else None)
+            result = jsonify(ai_response)
+            ai_relay_bytes.inc(('once',), len(result.get_data()))
+            if AI_CACHE_ENABLED:
+                result.headers[AI_CACHE_HEADER] = 'MISS' if cache_key else 'BYPASS'
+                if cache_key:
+                    ai_cache_put(cache_key, result.get_data())
+        else:
+            result = _upstream_error_response(response)
+    except Exception as e:
+        if isinstance(e, requests.exceptions.RequestException):
+            record_model_result(relay['model'], False, time.time() - start_time)
+        result = _upstream_failure_response(e)
+    finally:
+        slot.release()
+    flight.publish(_as_response(result))
+    return flight.response(relay['timeout'])
+
+
+# ---------------------------------------------------------------------------
+# Server-side render-validate-repair loop (opt-in, non-streaming relay only)
+# ---------------------------------------------------------------------------
+
+# With AI_REPAIR_ENABLED a client may send {"repair": {"diagramType": ...,
+# "userPrompt": ..., "currentCode": ...}} with a non-streaming request. The
+# server then renders the answer's diagramCode through the render gateway and,
+# on a render error, sends DEFAULT_RETRY_PROMPT upstream itself, up to
+# AI_REPAIR_MAX_ATTEMPTS times, instead of the browser doing one full round
+# trip per retry. The reply is the last completion plus a "repair" report.
+AI_REPAIR_ENABLED = os.environ.get('AI_REPAIR_ENABLED', 'false').lower() == 'true'
+AI_REPAIR_MAX_ATTEMPTS = int(os.environ.get('AI_REPAIR_MAX_ATTEMPTS', 2))
+AI_REPAIR_FORMAT = os.environ.get('AI_REPAIR_FORMAT', 'svg')
+AI_REPAIR_ERROR_CHARS = 2000
+
+_FENCE_RE = re.compile(r'^```[a-zA-Z]*\s*|\s*```$')
+
+
+def repair_options(data, stream):
+    """The validated "repair" block of a request body, or None (loop not used)."""
+    repair = data.get('repair')
+    if not AI_REPAIR_ENABLED or stream or not isinstance(repair, dict):
+        return None
+    diagram_type = repair.get('diagramType')
+    if not isinstance(diagram_type, str) or not _RENDER_NAME_RE.match(diagram_type):
+        return None
+    if diagram_type in DISABLED_DIAGRAM_TYPES:
+        return None
+    return {
+        'diagram_type': diagram_type,
+        'user_prompt': str(repair.get('userPrompt') or ''),
+        'current_code': str(repair.get('currentCode') or ''),
+        'include_render': bool(repair.get('includeRender')),
+    }
+
+
+def parse_diagram_answer(ai_response):
+    """The {"diagramCode", "explanation"} object in a completion, or None."""
+    try:
+        content = ai_response['choices'][0]['message']['content']
+    except (KeyError, IndexError, TypeError):
+        return None
+    if not isinstance(content, str):
+        return None
+    content = _FENCE_RE.sub('', content.strip())
+    start, end = content.find('{'), content.rfind('}')
+    if start < 0 or end < start:
+        return None
+    try:
+        answer = json.loads(content[start:end + 1])
+    except ValueError:
+        return None
+    return answer if isinstance(answer, dict) else None
+
+
+def retry_prompt(repair, failed_code, error):
+    """DEFAULT_RETRY_PROMPT filled in the same way as the browser's retry."""
+    values = {
+        'userPrompt': repair['user_prompt'] or 'No original request available',
+        'diagramType': repair['diagram_type'],
+        'currentCode': repair['current_code'] or 'No existing code',
+        'failedCode': failed_code,
+        'validationError': f"The diagram code failed to render: {error}. Please fix the syntax.",
+    }
+    prompt = DEFAULT_RETRY_PROMPT
+    for name, value in values.items():
+        prompt = prompt.replace('{{' + name + '}}', value)
+    return prompt
+
+
+def _repair_call(relay, messages):
+    """One upstream completion; (ai_response, None) or (None, (body, status, headers))."""
+    payload = dict(relay['payload'], messages=messages)
+    slot, busy = admit_relay(relay)
+    if busy:
+        return None, busy
+    start_time = time.time()
+    try:
+        resp = upstream_session().post(relay['endpoint'], headers=relay['headers'],
+                                       json=payload, timeout=relay['timeout'])
+    except requests.exceptions.RequestException as e:
+        record_model_result(relay['model'], False, time.time() - start_time)
+        return None, (*upstream_failure_body(e), {})
+    finally:
+        slot.release()
+    record_model_result(relay['model'], breaker_outcome(resp.status_code), time.time() - start_time,
+                        resp.status_code)
+    if resp.status_code != 200:
+        try:
+            error_data = resp.json()
+        except ValueError:
+            error_data = None
+        return None, (*upstream_error_body(resp.status_code, error_data, resp.text, resp.headers), {})
+    try:
+        ai_response = resp.json()
+    except ValueError:
+        return None, ({'error': 'Invalid response from AI service'}, 502, {})
+    record_usage(dict(relay, estimate=estimate_tokens(payload)),
+                 ai_response.get('usage') if isinstance(ai_response, dict) else None)
+    return ai_response, None
+
+
+def run_repair_loop(relay):
+    """(body, status, headers) for a relay request carrying repair options.
+
+    Render failures feed the retry prompt; anything that prevents a verdict
+    (unparseable answer, renderer down or busy, token budget spent) ends the
+    loop with "checked": false so the browser falls back to validating itself.
+    """
+    repair = relay['repair']
+    messages = relay['payload']['messages']
+    report = {'checked': False, 'valid': None, 'attempts': 0}
+    ai_response = None
+    while True:
+        if report['attempts'] and check_token_budgets(relay):
+            report['error'] = 'Token budget exhausted before the diagram could be repaired'
+            break
+        reply, error = _repair_call(relay, messages)
+        if error:
+            if ai_response is None:
+                return error
+            break  # keep the last answer that did arrive
+        ai_response = reply
+        report['attempts'] += 1
+        answer = parse_diagram_answer(ai_response)
+        code = answer.get('diagramCode') if answer else None
+        if not isinstance(code, str) or not code.strip():
+            report.pop('error', None)
+            report.update(checked=answer is not None, valid=None)
+            break
+        fields = check_render_fields(repair['diagram_type'], AI_REPAIR_FORMAT, {}, code)
+        status, content_type, body, _ = render_via_gateway(*fields)
+        if status == 200:
+            report.update(checked=True, valid=True)
+            report.pop('error', None)
+            if repair['include_render']:
+                text = content_type.startswith(_TEXT_RENDER_TYPES)
+                report['render'] = {'content_type': content_type,
+                                    'data': body.decode('utf-8', 'replace') if text
+                                    else base64.b64encode(body).decode('ascii')}
+                if not text:
+                    report['render']['encoding'] = 'base64'
+            break
+        if status not in RENDER_NEGATIVE_STATUSES:
+            report.update(checked=False, valid=None, error=f'Renderer unavailable (HTTP {status})')
+            break
+        render_error = body.decode('utf-8', 'replace').strip()[:AI_REPAIR_ERROR_CHARS] or f'HTTP {status}'
+        report.update(checked=True, valid=False, error=render_error)
+        if report['attempts'] > AI_REPAIR_MAX_ATTEMPTS:
+            break
+        logger.info(f"AI diagram for {repair['diagram_type']} failed to render; "
+                    f"repair attempt {report['attempts']}/{AI_REPAIR_MAX_ATTEMPTS}")
+        messages = messages[:-1] + [{'role': 'user', 'content': retry_prompt(repair, code, render_error)}]
+    body = dict(ai_response) if isinstance(ai_response, dict) else {'choices': []}
+    body['repair'] = report
+    return body, 200, {}
+
+
+@app.route('/api/ai-assist', methods=['POST'])
+@limiter.limit("10/minute")
+@limiter.limit(_per_ip_limit, error_message='per_ip_quota',
+               exempt_when=lambda: not AI_DAILY_LIMIT_PER_IP)
+def ai_assist():
+    """AI Assistant API proxy endpoint"""
+    try:
+        denied = check_ai_access(request)
+        if denied:
+            return jsonify(denied[0]), denied[1]
+
+        # Check request size
+        if request.content_length and request.content_length > MAX_REQUEST_SIZE:
+            return jsonify({'error': 'Request too large'}), 413
+
+        # Parse request data
+        try:
+            data = request.get_json(force=True)
+        except Exception as e:
+            logger.error(f"Invalid JSON in request: {e}")
+            return jsonify({'error': 'Invalid JSON'}), 400
+
+        relay, error = prepare_ai_relay(data, request.remote_addr)
+        if error:
+            return (jsonify(error[0]), *error[1:])
+        relay['client'], relay['weight'] = admission_client(request)
+        relay['budget_keys'] = token_budget_keys(request)
+        over_budget = check_token_budgets(relay)
+        if over_budget:
+            return _relay_reply(over_budget)
+
+        # Handle streaming responses
+        if relay['stream']:
+            return _served_by(_relay_stream(relay), relay)
+
+        # Validated answers are rendered and repaired here, never cached or coalesced
+        if relay['repair']:
+            return _served_by(_relay_reply(run_repair_loop(relay)), relay)
+
+        # Non-streaming response
+        cache_key = ai_cache_key(relay['payload'])
+        if cache_key:
+            cached = ai_cache_get(cache_key)
+            if cached is not None:
+                logger.info(f"AI completion for model {relay['model']} served from cache")
+                return _served_by(Response(cached, content_type='application/json',
+                                           headers={AI_CACHE_HEADER: 'HIT'}), relay)
+
+        return _served_by(_relay_once(relay, cache_key), relay)
+
+    except Exception as e:
+        return _upstream_failure_response(e)
+
+@app.route('/api/config', methods=['GET'])
+def get_config():
+    """Get server AI and Draw.io configuration (without sensitive data)"""
+    ai_model = DEFAULT_AI_CONFIG['model'] if AI_MODE == 'relay' else None
+    has_api_key = AI_MODE == 'relay' and bool(DEFAULT_AI_CONFIG['api_key'])
+    drawio_url = os.environ.get('DRAWIO_SERVER_URL', 'https://embed.diagrams.net/')
+    version = (AI_MODE, ai_model, has_api_key, DEFAULT_AI_CONFIG['timeout'], drawio_url,
+               KROKI_MAX_BODY_SIZE, tuple(DISABLED_DIAGRAM_TYPES), AI_REPAIR_ENABLED)
+    return prepared_json('config', version, lambda: {
+        'ai': {
+            'enabled': AI_MODE == 'relay',  # back-compat: true only in relay mode
+            'mode': AI_MODE,
+            'has_api_key': has_api_key,
+            'model': ai_model,
+            'timeout': DEFAULT_AI_CONFIG['timeout'],
+            'repair': AI_REPAIR_ENABLED and AI_MODE == 'relay'
+        },
+        'drawio': {
+            'server_url': drawio_url
+        },
+        'kroki': {
+            'maxBodySize': KROKI_MAX_BODY_SIZE,
+            'disabledDiagramTypes': DISABLED_DIAGRAM_TYPES
+        }
+    }).response(request)
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    """Health check endpoint"""
+    return jsonify({
+        'status': 'healthy',
+        'timestamp': datetime.utcnow().isoformat(),
+        'ai_enabled': AI_MODE == 'relay',
+        'ai_mode': AI_MODE,
+    })
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Per-worker runtime counters (each gunicorn worker reports its own)"""
+    denied = check_admin_access(request)
+    if denied:
+        return jsonify(denied[0]), denied[1]
+    return jsonify({
+        'pid': os.getpid(),
+        'upstream_pool': upstream_pool_stats(),
+        'ai_cache': ai_cache_stats(),
+        'coalescing': coalesce_stats(),
+        'admission': ai_admission.stats(),
+        'breakers': breaker_stats(),
+        'model_catalog': model_catalog_stats(),
+        'usage_ledger': usage_ledger.stats(),
+        'render_cache': render_cache_stats(),
+        'render_scheduler': render_scheduler.stats(),
+        'render_warmer': render_warm_stats(),
+        'static': static_cache_stats(),
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition, summed over every worker (see MetricsRegistry)"""
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Metrics disabled'}), 404
+    denied = check_admin_access(request, METRICS_TOKEN or ADMIN_TOKEN)
+    if denied:
+        return jsonify(denied[0]), denied[1]
+    return Response(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/stream-timings', methods=['GET'])
+def get_stream_timings():
+    """Rolling per-model AI stream phase percentiles (this worker's recent streams)"""
+    denied = check_admin_access(request)
+    if denied:
+        return jsonify(denied[0]), denied[1]
+    return jsonify({
+        'pid': os.getpid(),
+        'window': AI_STREAM_TIMING_WINDOW,
+        'stall_threshold_s': AI_STREAM_STALL_SECONDS,
+        'models': stream_timings.stats(),
+    })
+
+@app.route('/api/usage', methods=['GET'])
+def get_usage():
+    """AI token usage from the ledger: ?since=<epoch seconds>&group_by=model|day|client"""
+    denied = check_admin_access(request)
+    if denied:
+        return jsonify(denied[0]), denied[1]
+    if not AI_USAGE_LEDGER:
+        return jsonify({'error': 'Usage ledger disabled'}), 404
+    group_by = request.args.get('group_by', 'model')
+    if group_by not in USAGE_GROUPS:
+        return jsonify({'error': f"group_by must be one of {', '.join(USAGE_GROUPS)}"}), 400
+    try:
+        since = float(request.args.get('since', time.time() - 86400))
+    except ValueError:
+        return jsonify({'error': 'since must be a Unix timestamp'}), 400
+    totals, groups = aggregate_usage(usage_ledger.entries(since), group_by)
+    return jsonify({'since': since, 'group_by': group_by, 'totals': totals, 'groups': groups})
+
+@app.route('/api/version', methods=['GET'])
+def get_version():
+    """Get version and system information"""
+    try:
+        if not validate_origin(request):
+            return jsonify({'error': 'Unauthorized origin'}), 403
+
+        ai_model = DEFAULT_AI_CONFIG['model'] if AI_MODE == 'relay' else None
+        return prepared_json('version', (AI_MODE, ai_model), lambda: {
+            'version': os.environ.get('VERSION', '1.0.0'),
+            'name': 'DocCode - The Kroki Server Frontend',
+            'description': 'A comprehensive interactive frontend for Kroki diagram rendering server with AI assistance',
+            'build_date': os.environ.get('BUILD_DATE', '2025-06-19'),
+            'author': os.environ.get('AUTHOR_NAME', 'Vysakh Pillai'),
             'features': [
                 'Interactive diagram editor',
                 'AI-powered diagram assistance',
@@ -859,21 +4291,766 @@ def get_version():
                 'https_port': HTTPS_PORT,
                 'ai_enabled': AI_MODE == 'relay',
                 'ai_mode': AI_MODE,
-                'ai_model': DEFAULT_AI_CONFIG['model'] if AI_MODE == 'relay' else None
+                'ai_model': ai_model
             }
-        })
+        }).response(request)
     except Exception as e:
         logger.error(f"Error getting version info: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+def _example_assets(manifest):
+    """{diagram type: asset} for examples/<type>.txt, minus disabled types."""
+    examples = {}
+    for relpath, asset in manifest.assets.items():
+        folder, _, name = relpath.partition('/')
+        if folder == 'examples' and '/' not in name and name.endswith('.txt'):
+            diagram_type = name[:-len('.txt')]
+            if diagram_type not in DISABLED_DIAGRAM_TYPES:
+                examples[diagram_type] = asset
+    return dict(sorted(examples.items()))
+
+
+RENDER_BATCH_QUOTA_COPY = 'Too many batch renders. Please try again in {seconds} seconds.'
+_render_batch_budget = TokenBudget('render-batch', RENDER_BATCH_ITEM_LIMIT)
+
+
+def check_batch_quota(request, count):
+    """None, or the (body, 429, headers) reply when `count` more items exceed the IP's allowance."""
+    if not _render_batch_budget.items or not count:
+        return None
+    storage = budget_storage()
+    key = request.remote_addr or 'unknown'
+    retry_after = _render_batch_budget.retry_after(storage, key, count)
+    if retry_after:
+        rejections.inc(('batch_quota',))
+        body = {'error': RENDER_BATCH_QUOTA_COPY.format(seconds=retry_after), 'code': 'batch_quota',
+                'retry_after': retry_after}
+        return body, 429, {'Retry-After': str(retry_after)}
+    _render_batch_budget.charge(storage, key, count)
+    return None
+
+
+@app.route('/api/render/batch', methods=['POST'])
+def render_diagram_batch():
+    """Render many diagrams; results stream back in completion order.
+
+    NDJSON by default, one object per item (text output inline, binary output
+    base64); with Accept: multipart/mixed each item is a raw part instead.
+    A failed item is reported in its own result and never fails the batch.
+    """
+    if not validate_origin(request):
+        return jsonify({'error': 'Unauthorized origin'}), 403
+    if request.content_length and request.content_length > RENDER_BATCH_MAX_BYTES:
+        return jsonify({'error': 'Batch too large'}), 413
+    request.max_content_length = RENDER_BATCH_MAX_BYTES
+    items = parse_render_batch(request.get_json(silent=True))
+    if isinstance(items, str):
+        return jsonify({'error': items}), 400
+    limited = check_batch_quota(request, sum(1 for _, _, fields in items if not isinstance(fields, str)))
+    if limited:
+        return jsonify(limited[0]), limited[1], limited[2]
+
+    results = render_batch(items)
+    if request.accept_mimetypes.best_match([NDJSON_MIMETYPE, 'multipart/mixed']) == 'multipart/mixed':
+        boundary = secrets.token_hex(16)
+
+        def parts():
+            for result in results:
+                yield batch_multipart_part(boundary, *result)
+            yield f'--{boundary}--\r\n'.encode()
+
+        return Response(stream_with_context(parts()), content_type=f'multipart/mixed; boundary={boundary}',
+                        headers={'X-Accel-Buffering': 'no'})
+    return Response(stream_with_context(batch_ndjson_line(*result) for result in results),
+                    content_type=NDJSON_MIMETYPE, headers={'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/render/', methods=['POST'])
+@app.route('/api/render/<diagram_type>/<output_format>', methods=['POST'])
+def render_diagram(diagram_type=None, output_format=None):
+    """Kroki POST render through the shared render cache (see render_via_gateway)"""
+    if not validate_origin(request):
+        return jsonify({'error': 'Unauthorized origin'}), 403
+    if request.content_length and request.content_length > KROKI_MAX_BODY_SIZE:
+        return jsonify({'error': 'Diagram too large'}), 413
+    request.max_content_length = KROKI_MAX_BODY_SIZE
+    fields = render_request_fields(request, diagram_type, output_format)
+    if isinstance(fields, str):
+        return jsonify({'error': fields}), 400
+    diagram_type, output_format, options, source = fields
+    if diagram_type in DISABLED_DIAGRAM_TYPES:
+        return jsonify({'error': f"Diagram type '{diagram_type}' is disabled on this server"}), 404
+    status, content_type, body, headers = render_via_gateway(
+        diagram_type, output_format, options, source, render_lane(request))
+    response = Response(body, status=status, content_type=content_type, headers=headers)
+    if status == 200:
+        response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
+
+
+@app.route('/api/encode', methods=['POST'])
+@app.route('/api/encode/<diagram_type>/<output_format>', methods=['POST'])
+def encode_diagram(diagram_type=None, output_format=None):
+    """Canonical GET render URL for a diagram; same request forms as /api/render"""
+    if not validate_origin(request):
+        return jsonify({'error': 'Unauthorized origin'}), 403
+    if request.content_length and request.content_length > KROKI_MAX_BODY_SIZE:
+        return jsonify({'error': 'Diagram too large'}), 413
+    request.max_content_length = KROKI_MAX_BODY_SIZE
+    fields = render_request_fields(request, diagram_type, output_format)
+    if isinstance(fields, str):
+        return jsonify({'error': fields}), 400
+    diagram_type, output_format, options, source = fields
+    path = canonical_render_path(diagram_type, output_format, options, source)
+    return jsonify({
+        'path': path,
+        'url': request.host_url.rstrip('/') + path,
+        'encoded': path.split('/', 3)[3].split('?', 1)[0],
+        'source': source,
+    })
+
+
+@app.route('/api/examples', methods=['GET'])
+def get_examples():
+    """All example diagram sources in one payload.
+
+    ?types=a,b limits it to those diagram types; ?index=1 returns only each
+    example's size and ETag, so a client can fetch lazily with ?types=.
+    """
+    try:
+        if not validate_origin(request):
+            return jsonify({'error': 'Unauthorized origin'}), 403
+
+        # The manifest is rebound whenever the static tree is reloaded.
+        manifest = STATIC_ASSETS
+        version = (manifest, tuple(DISABLED_DIAGRAM_TYPES))
+        if request.args.get('index'):
+            return prepared_json('examples-index', version, lambda: {
+                'examples': {
+                    diagram_type: {'bytes': len(asset.body), 'etag': asset.etag()}
+                    for diagram_type, asset in _example_assets(manifest).items()
+                }
+            }).response(request)
+
+        types = request.args.get('types')
+        if types is None:
+            return prepared_json('examples', version, lambda: {
+                'examples': {
+                    diagram_type: asset.body.decode('utf-8')
+                    for diagram_type, asset in _example_assets(manifest).items()
+                }
+            }).response(request)
+
+        # Subsets are not cached: there are too many combinations to keep.
+        examples = _example_assets(manifest)
+        wanted = sorted({t.strip().lower() for t in types.split(',')} & examples.keys())
+        body = app.json.response({
+            'examples': {diagram_type: examples[diagram_type].body.decode('utf-8') for diagram_type in wanted}
+        }).get_data()
+        return PrecompressedBody(body, 'application/json', gzip_level=STATIC_GZIP_LEVEL,
+                                 brotli_quality=STATIC_BROTLI_QUALITY).response(request)
+    except Exception as e:
+        logger.error(f"Error building examples catalog: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+# Server-side files that live next to the static assets but must not be served
+BLOCKED_STATIC_FILES = {'requirements.txt', 'requirements-dev.txt', 'Dockerfile', '.dockerignore'}
+BLOCKED_STATIC_DIRS = {'__pycache__', 'tests'}
+
+
+# ---------------------------------------------------------------------------
+# Static asset pipeline: fingerprinted URLs, precompressed variants, ETags
+# ---------------------------------------------------------------------------
+
+# Directories under STATIC_ROOT held in memory with gzip/brotli variants. Every
+# asset is also reachable as <name>.<hash>.<ext>, which is cached as immutable.
+STATIC_ASSET_DIRS = ('js', 'css', 'examples')
+STATIC_FINGERPRINT_LENGTH = 12
+STATIC_IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+# Boot-time compression levels; build-time sidecars (see precompress_static_assets)
+# carry the maximum levels and are picked up instead when they are fresh.
+STATIC_GZIP_LEVEL = int(os.environ.get('STATIC_GZIP_LEVEL', 6))
+STATIC_BROTLI_QUALITY = int(os.environ.get('STATIC_BROTLI_QUALITY', 5))
+
+_FINGERPRINT_RE = re.compile(r'^(.+)\.([0-9a-f]{%d})(\.[^./]+)$' % STATIC_FINGERPRINT_LENGTH)
+# src/href attributes in index.html; the inline importmap is left untouched
+# (its CSP hash is pinned in setup-kroki-server.sh).
+_ASSET_ATTR_RE = re.compile(r'(\s(?:src|href)=")(/?)([^"?#]+)(")')
+
+SIDECAR_SUFFIXES = {'gzip': '.gz', 'br': '.br'}
+
+
+def _static_asset_paths(root):
+    for top in STATIC_ASSET_DIRS:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, top)):
+            dirnames[:] = sorted(d for d in dirnames if d not in BLOCKED_STATIC_DIRS)
+            for name in sorted(filenames):
+                if name.endswith(tuple(SIDECAR_SUFFIXES.values())):
+                    continue
+                full = os.path.join(dirpath, name)
+                yield os.path.relpath(full, root).replace(os.sep, '/'), full
+
+
+def _read_sidecars(full):
+    """Build-time .gz/.br files next to `full`, if at least as new as it."""
+    encoded = {}
+    source_mtime = os.path.getmtime(full)
+    for encoding, suffix in SIDECAR_SUFFIXES.items():
+        try:
+            if os.path.getmtime(full + suffix) >= source_mtime:
+                with open(full + suffix, 'rb') as f:
+                    encoded[encoding] = f.read()
+        except OSError:
+            pass
+    return encoded
+
+
+class AssetManifest:
+    """Every static asset under STATIC_ASSET_DIRS, loaded once at startup."""
+
+    def __init__(self, root):
+        self.assets = {}
+        for relpath, full in _static_asset_paths(root):
+            with open(full, 'rb') as f:
+                body = f.read()
+            mimetype = mimetypes.guess_type(relpath)[0] or 'application/octet-stream'
+            self.assets[relpath] = PrecompressedBody(
+                body, mimetype, _read_sidecars(full),
+                gzip_level=STATIC_GZIP_LEVEL, brotli_quality=STATIC_BROTLI_QUALITY)
+
+    def url(self, relpath):
+        """Fingerprinted path for an asset (unchanged if it is not one)."""
+        asset = self.assets.get(relpath)
+        if asset is None:
+            return relpath
+        stem, ext = os.path.splitext(relpath)
+        return f'{stem}.{asset.digest[:STATIC_FINGERPRINT_LENGTH]}{ext}'
+
+    def lookup(self, filename):
+        """(asset, immutable) for a plain or fingerprinted path, else (None, False).
+
+        A fingerprint for older content still resolves (a page from before a
+        deploy may ask for it) but is then served revalidatable, not immutable.
+        """
+        asset = self.assets.get(filename)
+        if asset is not None:
+            return asset, False
+        match = _FINGERPRINT_RE.match(filename)
+        if match:
+            asset = self.assets.get(match.group(1) + match.group(3))
+            if asset is not None:
+                return asset, asset.digest.startswith(match.group(2))
+        return None, False
+
+    def rewrite_html(self, html):
+        """Point src/href attributes at fingerprinted asset URLs."""
+        def fingerprint(match):
+            prefix, slash, path, quote = match.groups()
+            return f'{prefix}{slash}{self.url(path)}{quote}'
+        return _ASSET_ATTR_RE.sub(fingerprint, html)
+
+
+def precompress_static_assets(root=None):
+    """Build-time stage: write max-level .gz/.br sidecars next to every asset.
+
+    Run in the image build (see Dockerfile); AssetManifest then loads these
+    instead of compressing at boot with the faster STATIC_* levels.
+    """
+    root = root or STATIC_ROOT
+    for relpath, full in _static_asset_paths(root):
+        with open(full, 'rb') as f:
+            body = f.read()
+        if len(body) < COMPRESS_MIN_BYTES:
+            continue
+        variants = {'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(body, quality=11)
+        for encoding, data in variants.items():
+            with open(full + SIDECAR_SUFFIXES[encoding], 'wb') as f:
+                f.write(data)
+    logger.info(f"Precompressed static assets under {root}")
+
+
+STATIC_ASSETS = AssetManifest(STATIC_ROOT)
+_index_page = {}
+
+
+# ---------------------------------------------------------------------------
+# Production module bundles (scripts/build-bundles.mjs)
+# ---------------------------------------------------------------------------
+
+# Serve index.html with the bundle built into js/bundles/ instead of its ~70
+# separately loaded ES modules. Ignored when no bundle has been built.
+JS_BUNDLES_ENABLED = os.environ.get('JS_BUNDLES_ENABLED', 'false').lower() == 'true'
+JS_BUNDLE_MANIFEST = 'js/bundles/manifest.json'
+
+_MODULE_SCRIPT_TAG_RE = re.compile(r'[ \t]*<script type="module" src="(/?)([^"?#]+)"></script>\n?')
+
+
+class JsBundles:
+    """The bundle build's manifest: the entry scripts it replaces and the
+    content-hashed files it produced."""
+
+    def __init__(self, root):
+        with open(os.path.join(root, JS_BUNDLE_MANIFEST), 'r') as f:
+            data = json.load(f)
+        self.entry = data['entry']
+        self.replaces = list(data['replaces'])
+        self.files = set(data['files'])
+
+    def rewrite_html(self, html):
+        """Swap the entry <script type="module"> tags for the one bundle.
+
+        A bundle built from a different set of entries than this index.html
+        would run modules twice or miss some, so the page is then left as is.
+        """
+        if _MODULE_SCRIPT_RE.findall(html) != self.replaces:
+            logger.warning(f"{JS_BUNDLE_MANIFEST} does not match index.html's module scripts; serving unbundled")
+            return html
+        tags = []
+
+        def swap(match):
+            tags.append(match)
+            if len(tags) > 1:
+                return ''
+            return f'    <script type="module" src="{match.group(1)}{self.entry}"></script>\n'
+        return _MODULE_SCRIPT_TAG_RE.sub(swap, html)
+
+
+def _load_bundles():
+    if not JS_BUNDLES_ENABLED:
+        return None
+    try:
+        return JsBundles(STATIC_ROOT)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"JS_BUNDLES_ENABLED but no usable bundle ({e}); serving unbundled modules")
+        return None
+
+
+JS_BUNDLES = _load_bundles()
+
+
+# ---------------------------------------------------------------------------
+# Preload hints for index.html's module graph (Link header, 103 Early Hints)
+# ---------------------------------------------------------------------------
+
+# Send the module graph as a Link header on index.html (and as a 103 Early
+# Hints response where the server supports it, see asgi.py).
+INDEX_PRELOAD_ENABLED = os.environ.get('INDEX_PRELOAD_ENABLED', 'true').lower() == 'true'
+# Also inject <link rel="modulepreload"> tags for the whole graph into <head>.
+INDEX_PRELOAD_INJECT = os.environ.get('INDEX_PRELOAD_INJECT', 'false').lower() == 'true'
+# Upper bound for the Link header: nginx rejects upstream headers larger than
+# its proxy_buffer_size (raised to 16k in setup-kroki-server.sh; the nginx
+# default is 4k). Modules past it are left to the browser.
+INDEX_PRELOAD_HEADER_BYTES = int(os.environ.get('INDEX_PRELOAD_HEADER_BYTES', 8192))
+
+# Static import/export-from statements, minified or not; import() is lazy by
+# design and deliberately not followed.
+_IMPORT_RE = re.compile(r'''\b(?:import|export)\s*(?:[\w$*{}\s,]*?\bfrom\s*)?["']([^"'\n]+)["']''')
+_IMPORTMAP_RE = re.compile(r'<script type="importmap">(.*?)</script>', re.S)
+_MODULE_SCRIPT_RE = re.compile(r'<script type="module" src="/?([^"?#]+)"')
+
+
+class ModulePreload:
+    """The static import graph of index.html's module scripts, scanned once.
+
+    Dependencies are listed breadth-first from the entry scripts: without hints
+    the browser discovers each level only after parsing the one before it.
+    """
+
+    def __init__(self, html, manifest):
+        started = time.perf_counter()
+        match = _IMPORTMAP_RE.search(html)
+        self.importmap = json.loads(match.group(1)).get('imports', {}) if match else {}
+        self.entries = [path for path in _MODULE_SCRIPT_RE.findall(html) if path in manifest.assets]
+        self.modules = []
+        seen = set(self.entries)
+        queue = deque(self.entries)
+        while queue:
+            importer = queue.popleft()
+            source = manifest.assets[importer].body.decode('utf-8', 'replace')
+            for specifier in _IMPORT_RE.findall(source):
+                path = self._resolve(specifier, importer)
+                if path in manifest.assets and path not in seen:
+                    seen.add(path)
+                    self.modules.append(path)
+                    queue.append(path)
+
+        # Hints go out before the importmap is parsed, so they are plain
+        # script preloads (same cors mode as a module fetch) rather than
+        # modulepreload, which would start module loading too early for
+        # browsers that accept a single import map only. Dependencies come
+        # first: the entry scripts are in the HTML the browser gets anyway.
+        links = [f'</{path}>; rel=preload; as=script; crossorigin' for path in self.modules]
+        links += [f'</{manifest.url(path)}>; rel=preload; as=script; crossorigin' for path in self.entries]
+        self.links = []
+        size = 0
+        for link in links:
+            size += len(link) + 2
+            if size > INDEX_PRELOAD_HEADER_BYTES:
+                break
+            self.links.append(link)
+        self.link_header = ', '.join(self.links)
+        # Injected after the importmap, where modulepreload is safe everywhere.
+        self.html_block = ''.join(f'    <link rel="modulepreload" href="/{path}">\n' for path in self.modules)
+        self.scan_ms = (time.perf_counter() - started) * 1000
+
+    def _resolve(self, specifier, importer):
+        """Path under STATIC_ROOT for an import specifier, or None (e.g. an unmapped bare name)."""
+        if specifier in self.importmap:
+            target = self.importmap[specifier]
+        elif specifier.startswith(('./', '../', '/')):
+            target = posixpath.join(posixpath.dirname('/' + importer), specifier)
+        else:
+            return None
+        return posixpath.normpath(target).lstrip('/')
+
+    def server_timing(self, index_ms):
+        return f'preload-scan;dur={self.scan_ms:.1f};desc="cached", index;dur={index_ms:.1f}'
+
+
+def _load_preload(manifest, bundles):
+    if not INDEX_PRELOAD_ENABLED:
+        return None
+    try:
+        with open(os.path.join(STATIC_ROOT, 'index.html'), 'r', encoding='utf-8') as f:
+            html = f.read()
+        return ModulePreload(bundles.rewrite_html(html) if bundles is not None else html, manifest)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not scan the index.html module graph; sending no preload hints: {e}")
+        return None
+
+
+def render_index(html, manifest, bundles, preload):
+    """index.html as served: the module bundle if there is one, fingerprinted
+    asset URLs, plus the modulepreload block when INDEX_PRELOAD_INJECT is on."""
+    if bundles is not None:
+        html = bundles.rewrite_html(html)
+    html = manifest.rewrite_html(html)
+    if preload is not None and INDEX_PRELOAD_INJECT:
+        html = html.replace('</head>', preload.html_block + '</head>', 1)
+    return html
+
+
+INDEX_PRELOAD = _load_preload(STATIC_ASSETS, JS_BUNDLES)
+
+
+def _index_body():
+    """index.html as served, re-read only when it changes on disk."""
+    table = STATIC_TABLE
+    if table is not None and table.index is not None:
+        return table.index
+    path = os.path.join(STATIC_ROOT, 'index.html')
+    mtime = os.path.getmtime(path)
+    if _index_page.get('mtime') != mtime:
+        with open(path, 'r', encoding='utf-8') as f:
+            html = render_index(f.read(), STATIC_ASSETS, JS_BUNDLES, INDEX_PRELOAD)
+        _index_page.update(mtime=mtime, body=PrecompressedBody(html.encode('utf-8'), 'text/html'))
+    return _index_page['body']
+
+
+# ---------------------------------------------------------------------------
+# Whole-tree static cache (STATIC_CACHE=memory) and development file watcher
+# ---------------------------------------------------------------------------
+
+# 'memory' loads every servable file under STATIC_ROOT at boot and answers from
+# RAM without touching the filesystem per request; 'off' (default) holds only
+# the STATIC_ASSET_DIRS assets and reads everything else from disk.
+STATIC_CACHE = os.environ.get('STATIC_CACHE', 'off').lower()
+# Files larger than this, and anything past the total budget, stay on disk.
+STATIC_CACHE_MAX_FILE_BYTES = int(os.environ.get('STATIC_CACHE_MAX_FILE_BYTES', 4 * 1024 * 1024))
+STATIC_CACHE_MAX_BYTES = int(os.environ.get('STATIC_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Development: poll STATIC_ROOT every N seconds and rebuild on change (0 = off).
+STATIC_CACHE_WATCH_INTERVAL = float(os.environ.get('STATIC_CACHE_WATCH_INTERVAL', 0))
+
+# Only these are gzip/brotli-encoded; images, fonts and archives go out as stored.
+_COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                       'application/xml', 'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+# Never walked: dependency trees from a dev checkout.
+_STATIC_SKIP_DIRS = {'node_modules'}
+
+
+def is_blocked_static(filename):
+    """True for server-side files under STATIC_ROOT that must never be served."""
+    return (filename in BLOCKED_STATIC_FILES
+            or filename.endswith(('.py', '.pyc'))
+            or filename.split('/')[0] in BLOCKED_STATIC_DIRS)
+
+
+def _static_tree(root):
+    """(relpath, full path, stat) for every servable file under `root`.
+
+    Dot-files, blocked entries and build-time .gz/.br sidecars are skipped.
+    """
+    sidecars = tuple(SIDECAR_SUFFIXES.values())
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith('.') and d not in BLOCKED_STATIC_DIRS and d not in _STATIC_SKIP_DIRS)
+        names = set(filenames)
+        for name in sorted(filenames):
+            if name.startswith('.') or (name.endswith(sidecars) and os.path.splitext(name)[0] in names):
+                continue
+            full = os.path.join(dirpath, name)
+            relpath = os.path.relpath(full, root).replace(os.sep, '/')
+            if is_blocked_static(relpath):
+                continue
+            try:
+                yield relpath, full, os.stat(full)
+            except OSError:
+                continue
+
+
+def _static_tree_signature(root):
+    return tuple((relpath, st.st_mtime_ns, st.st_size) for relpath, _, st in _static_tree(root))
+
+
+class StaticTable:
+    """Immutable snapshot of STATIC_ROOT: relative path -> PrecompressedBody.
+
+    Rebuilt and swapped whole on reload, so a request always sees one
+    consistent tree. Files already in `manifest` share its bodies.
+    """
+
+    def __init__(self, root, manifest, bundles=None, preload=None):
+        self.files = {}
+        self.bytes = 0
+        self.skipped = 0
+        for relpath, full, st in _static_tree(root):
+            body = manifest.assets.get(relpath)
+            if body is None:
+                if st.st_size > STATIC_CACHE_MAX_FILE_BYTES or self.bytes + st.st_size > STATIC_CACHE_MAX_BYTES:
+                    self.skipped += 1
+                    continue
+                with open(full, 'rb') as f:
+                    data = f.read()
+                mimetype = mimetypes.guess_type(relpath)[0] or 'application/octet-stream'
+                body = PrecompressedBody(
+                    data, mimetype, _read_sidecars(full),
+                    gzip_level=STATIC_GZIP_LEVEL, brotli_quality=STATIC_BROTLI_QUALITY,
+                    compress=mimetype.startswith(_COMPRESSIBLE_TYPES))
+            self.files[relpath] = body
+            self.bytes += len(body.body)
+        index = self.files.get('index.html')
+        self.index = None
+        if index is not None:
+            html = render_index(index.body.decode('utf-8'), manifest, bundles, preload)
+            self.index = PrecompressedBody(html.encode('utf-8'), 'text/html')
+
+    def get(self, filename):
+        return self.files.get(filename)
+
+    def __len__(self):
+        return len(self.files)
+
+
+STATIC_TABLE = (StaticTable(STATIC_ROOT, STATIC_ASSETS, JS_BUNDLES, INDEX_PRELOAD)
+                if STATIC_CACHE == 'memory' else None)
+_static_watch = {'signature': None, 'reloads': 0, 'watcher_pid': None}
+
+
+def reload_static_assets():
+    """Rebuild the asset manifest, bundle manifest, preload hints (and the
+    whole-tree table in memory mode) from disk and swap them in; in-flight requests keep the objects they hold."""
+    global STATIC_ASSETS, STATIC_TABLE, JS_BUNDLES, INDEX_PRELOAD
+    manifest = AssetManifest(STATIC_ROOT)
+    bundles = _load_bundles()
+    preload = _load_preload(manifest, bundles)
+    table = StaticTable(STATIC_ROOT, manifest, bundles, preload) if STATIC_CACHE == 'memory' else None
+    STATIC_ASSETS, STATIC_TABLE, JS_BUNDLES, INDEX_PRELOAD = manifest, table, bundles, preload
+    _index_page.clear()
+    _static_watch['reloads'] += 1
+
+
+def _static_watch_loop(interval):
+    while True:
+        time.sleep(interval)
+        signature = _static_tree_signature(STATIC_ROOT)
+        if signature == _static_watch['signature']:
+            continue
+        _static_watch['signature'] = signature
+        logger.info(f"Static files changed under {STATIC_ROOT}; reloading")
+        try:
+            reload_static_assets()
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Static reload failed, keeping the previous tree: {e}")
+
+
+def start_static_watcher(interval=None):
+    """Start this process's static file watcher (call after the fork).
+
+    Development aid only: a production image never changes its files in place.
+    """
+    interval = STATIC_CACHE_WATCH_INTERVAL if interval is None else interval
+    if interval <= 0 or _static_watch['watcher_pid'] == os.getpid():
+        return
+    _static_watch['watcher_pid'] = os.getpid()
+    _static_watch['signature'] = _static_tree_signature(STATIC_ROOT)
+    threading.Thread(target=_static_watch_loop, args=(interval,), name='static-watch', daemon=True).start()
+
+
+def static_cache_stats():
+    table = STATIC_TABLE
+    return {
+        'mode': STATIC_CACHE,
+        'assets': len(STATIC_ASSETS.assets),
+        'files': len(table) if table is not None else 0,
+        'bytes': table.bytes if table is not None else 0,
+        'skipped': table.skipped if table is not None else 0,
+        'bundle': JS_BUNDLES.entry if JS_BUNDLES is not None else None,
+        'reloads': _static_watch['reloads'],
+    }
+
+
+# ---------------------------------------------------------------------------
+# Render cache warmer (bundled examples + RENDER_WARM_DIR)
+# ---------------------------------------------------------------------------
+
+# After a deploy the first visitors would pay the cold JVM/Chromium render
+# for exactly the examples everyone opens first. One worker per host renders
+# them into the shared gateway cache shortly after boot, at low concurrency in
+# the bulk lane. Also runnable before a cut-over: scripts/warm_render_cache.py
+RENDER_WARM_ENABLED = os.environ.get('RENDER_WARM_ENABLED', 'true').lower() == 'true'
+RENDER_WARM_FORMATS = [f.strip() for f in os.environ.get('RENDER_WARM_FORMATS', 'svg').split(',') if f.strip()]
+# Extra sources: <dir>/<type>/<name>.<ext> or <dir>/<type>[.<name>].<ext>
+RENDER_WARM_DIR = os.environ.get('RENDER_WARM_DIR', '')
+RENDER_WARM_CONCURRENCY = int(os.environ.get('RENDER_WARM_CONCURRENCY', 2))
+RENDER_WARM_DELAY = float(os.environ.get('RENDER_WARM_DELAY', 5))
+
+_render_warm = {'pid': None, 'state': 'idle', 'started': None, 'finished': None, 'report': None}
+
+
+def render_warm_sources(extra_dir=None):
+    """[(label, diagram type, source)] for every example plus the extra corpus."""
+    sources = [(f'examples/{diagram_type}.txt', diagram_type, asset.body.decode('utf-8'))
+               for diagram_type, asset in _example_assets(STATIC_ASSETS).items()]
+    extra_dir = RENDER_WARM_DIR if extra_dir is None else extra_dir
+    if not extra_dir:
+        return sources
+    paths = sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(extra_dir)
+                   for name in names if not name.startswith('.'))
+    for path in paths:
+        relpath = os.path.relpath(path, extra_dir).replace(os.sep, '/')
+        head, _, name = relpath.partition('/')
+        diagram_type = (head if name else head.split('.', 1)[0]).lower()
+        if not _RENDER_NAME_RE.match(diagram_type) or diagram_type in DISABLED_DIAGRAM_TYPES:
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                sources.append((relpath, diagram_type, f.read()))
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Render warmer skipped {path}: {e}")
+    return sources
+
+
+def _warm_one(diagram_type, output_format, source):
+    """(status, cold seconds, warm seconds, cache state of the first render)."""
+    fields = check_render_fields(diagram_type, output_format, {}, source)
+    if isinstance(fields, str):
+        return 400, 0.0, 0.0, None
+    started = time.perf_counter()
+    status, _, _, headers = render_via_gateway(*fields, lane='bulk')
+    cold = time.perf_counter() - started
+    started = time.perf_counter()
+    render_via_gateway(*fields, lane='bulk')
+    return status, cold, time.perf_counter() - started, headers.get(RENDER_CACHE_HEADER)
+
+
+def warm_render_cache(formats=None, extra_dir=None, concurrency=None):
+    """Render every warm source in every format; returns a per-type report.
+
+    Each item is rendered twice: the first call is the cold render (or a hit
+    left by an earlier warm-up, counted as already_cached), the second shows
+    what a visitor now gets from the cache.
+    """
+    formats = formats or RENDER_WARM_FORMATS
+    jobs = [(label, diagram_type, output_format, source)
+            for label, diagram_type, source in render_warm_sources(extra_dir)
+            for output_format in formats]
+    started = time.time()
+    by_type = {}
+    with futures.ThreadPoolExecutor(max_workers=max(concurrency or RENDER_WARM_CONCURRENCY, 1),
+                                    thread_name_prefix='render-warm') as pool:
+        results = pool.map(lambda job: (job, _warm_one(job[1], job[2], job[3])), jobs)
+        for (label, diagram_type, output_format, _), (status, cold, warm, state) in results:
+            entry = by_type.setdefault(diagram_type, {'renders': 0, 'errors': [], 'already_cached': 0,
+                                                      'cold_ms': [], 'warm_ms': []})
+            entry['renders'] += 1
+            if status != 200:
+                entry['errors'].append(f'{label} ({output_format}): HTTP {status}')
+                continue
+            if state == 'HIT':
+                entry['already_cached'] += 1
+            else:
+                entry['cold_ms'].append(cold * 1000)
+            entry['warm_ms'].append(warm * 1000)
+    for entry in by_type.values():
+        for field in ('cold_ms', 'warm_ms'):
+            samples = sorted(entry[field])
+            entry[field] = round(samples[len(samples) // 2], 1) if samples else None
+    errors = sum(len(entry['errors']) for entry in by_type.values())
+    return {'formats': formats, 'renders': len(jobs), 'errors': errors,
+            'seconds': round(time.time() - started, 2), 'types': dict(sorted(by_type.items()))}
+
+
+def _render_warm_run(delay):
+    time.sleep(delay)
+    try:
+        kroki_session().get(f"{KROKI_CORE_URL}/health", timeout=5).raise_for_status()
+    except requests.RequestException as e:
+        logger.warning(f"Render warmer skipped: Kroki core not reachable at {KROKI_CORE_URL} ({e})")
+        _render_warm.update(state='skipped', finished=time.time())
+        return
+    _render_warm.update(state='running', started=time.time())
+    try:
+        report = warm_render_cache()
+    except Exception as e:
+        logger.error(f"Render warmer failed: {e}")
+        _render_warm.update(state='failed', finished=time.time())
+        return
+    _render_warm.update(state='done', finished=time.time(), report=report)
+    logger.info(f"Render warmer: {report['renders']} renders in {report['seconds']}s, {report['errors']} errors")
+
+
+def start_render_warmer(delay=None):
+    """Warm the shared render cache in the background (call after the fork).
+
+    Only the worker that wins the flock on the cache directory runs it; the
+    others would only re-read the entries it writes.
+    """
+    if not RENDER_WARM_ENABLED or _render_cache is None or _render_warm['pid'] == os.getpid():
+        return
+    _render_warm['pid'] = os.getpid()
+    try:
+        lock = open(os.path.join(RENDER_GATEWAY_CACHE_DIR, '.warm.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        _render_warm['state'] = 'other worker'
+        return
+    _render_warm['lock'] = lock  # held for the life of the process
+    _render_warm['state'] = 'scheduled'
+    threading.Thread(target=_render_warm_run, args=(RENDER_WARM_DELAY if delay is None else delay,),
+                     name='render-warm', daemon=True).start()
+
+
+def render_warm_stats():
+    return {k: v for k, v in _render_warm.items() if k != 'lock'}
+
+
 # Static file routes
 def _serve_index():
     """Serve index.html with a fresh AI session cookie.
 
     nginx proxies "/" straight to "/index.html", so both the root route and
-    the static catch-all must issue the cookie.
+    the static catch-all must issue the cookie. The module graph goes out as
+    a Link header, which a CDN or proxy may turn into 103 Early Hints.
     """
-    response = send_file(os.path.join(STATIC_ROOT, 'index.html'))
+    started = time.perf_counter()
+    response = _index_body().response(request)
+    preload = INDEX_PRELOAD
+    if preload is not None:
+        if preload.link_header:
+            response.headers['Link'] = preload.link_header
+        response.headers['Server-Timing'] = preload.server_timing((time.perf_counter() - started) * 1000)
     response.set_cookie(
         SESSION_COOKIE_NAME,
         issue_session_token(),
@@ -893,22 +5070,28 @@ def index():
 @app.route('/favicon.ico')
 def favicon():
     """Serve favicon"""
+    table = STATIC_TABLE
+    cached = table.get('favicon.ico') if table is not None else None
+    if cached is not None:
+        return cached.response(request)
     return send_file(os.path.join(STATIC_ROOT, 'favicon.ico'))
 
-# Server-side files that live next to the static assets but must not be served
-BLOCKED_STATIC_FILES = {'requirements.txt', 'requirements-dev.txt', 'Dockerfile', '.dockerignore'}
-BLOCKED_STATIC_DIRS = {'__pycache__', 'tests'}
-
-
 @app.route('/<path:filename>')
 def static_files(filename):
     """Serve static files"""
-    if (filename in BLOCKED_STATIC_FILES
-            or filename.endswith(('.py', '.pyc'))
-            or filename.split('/')[0] in BLOCKED_STATIC_DIRS):
+    if is_blocked_static(filename):
         return "File not found", 404
     if filename == 'index.html':
         return _serve_index()
+    asset, immutable = STATIC_ASSETS.lookup(filename)
+    bundles = JS_BUNDLES
+    if bundles is not None and filename in bundles.files:
+        immutable = True  # named by content hash at build time
+    table = STATIC_TABLE
+    if asset is None and table is not None:
+        asset = table.get(filename)
+    if asset is not None:
+        return asset.response(request, STATIC_IMMUTABLE_CACHE if immutable else 'no-cache')
     try:
         return send_from_directory(STATIC_ROOT, filename)
     except FileNotFoundError:
@@ -922,8 +5105,13 @@ if __name__ == '__main__':
     logger.info(f"Starting Kroki Demo Site Server on port {PORT}")
     logger.info(f"Static files served from: {STATIC_ROOT}")
     logger.info(f"AI mode: {AI_MODE} (enabled={DEFAULT_AI_CONFIG['enabled']}, has_key={bool(AI_PROXY_API_KEY)})")
-    model_count = sum(len(models) for models in AVAILABLE_MODELS.values())
-    logger.info(f"Available AI models: {model_count} across {len(AVAILABLE_MODELS)} providers")
+    start_model_refresh()
+    # Pick up edits to js/css/html without a restart; a negative
+    # STATIC_CACHE_WATCH_INTERVAL turns the watcher off.
+    start_static_watcher(STATIC_CACHE_WATCH_INTERVAL or 1.0)
+    start_render_warmer()
+    metrics.start()
+    logger.info(f"Available AI models: {len(MODEL_REGISTRY)} across {len(MODEL_REGISTRY.grouped)} providers")
     if AI_MODEL_ALLOWLIST:
         logger.info(f"AI model allowlist active: {AI_MODEL_ALLOWLIST}")
     if AI_DAILY_LIMIT_PER_IP:
@@ -23,6 +23,19 @@ os.environ.pop('AI_MODEL_ALLOWLIST', None)
 os.environ.pop('AI_MODEL_FALLBACKS', None)
 os.environ.pop('AI_DAILY_LIMIT_PER_IP', None)
 os.environ.pop('DISABLED_DIAGRAM_TYPES', None)
+# Boot from ai-models.json, never from a snapshot left behind by a real run
+os.environ['AI_MODELS_SNAPSHOT'] = ''
+# Per-process rate-limit counters, never a shared store left behind by a real run
+os.environ['RATELIMIT_STORAGE_URI'] = 'memory://'
+# Tests that need the usage ledger point it at tmp_path themselves
+os.environ['AI_USAGE_LEDGER'] = ''
+# Render gateway tests build their own cache under tmp_path
+os.environ['RENDER_GATEWAY_CACHE_DIR'] = ''
+os.environ['KROKI_CORE_VERSION'] = 'test-core'
+# Metrics stay in-process; the aggregation test builds its own directory
+os.environ['METRICS_DIR'] = ''
+for name in ('AI_TOKEN_BUDGET_PER_IP', 'AI_TOKEN_BUDGET_PER_SESSION', 'AI_TOKEN_BUDGET_GLOBAL'):
+    os.environ.pop(name, None)
 
 import pytest
 
@@ -47,6 +60,13 @@ def server():
     return server_module
 
 
+@pytest.fixture(autouse=True)
+def reset_circuit_breakers():
+    """Breaker state is module-global; failures in one test must not trip the next."""
+    yield
+    server_module._breakers.clear()
+
+
 class FakeUpstreamResponse:
     """Stand-in for requests.Response covering the json/stream paths used."""
 
@@ -58,6 +78,7 @@ class FakeUpstreamResponse:
         self._lines = lines or [b'data: {"choices":[{"delta":{"content":"hi"}}]}', b'data: [DONE]']
         self.closed = False
         self.text = ''
+        self.headers = {}
 
     def json(self):
         return self._json_body
@@ -80,9 +101,10 @@ def upstream(server, monkeypatch):
 
     rec = Recorder()
 
-    def fake_post(url, **kwargs):
+    def fake_post(session, url, **kwargs):
         rec.calls.append({'url': url, **kwargs})
         return rec.response
 
-    monkeypatch.setattr(server.requests, 'post', fake_post)
+    # The relay goes through the pooled upstream_session(), not requests.post.
+    monkeypatch.setattr(server.requests.Session, 'post', fake_post)
     return rec
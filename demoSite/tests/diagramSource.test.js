@@ -0,0 +1,29 @@
+import { test } from 'node:test';
+import assert from 'node:assert/strict';
+import { canonicalDiagramSource, WHITESPACE_INSENSITIVE_TYPES } from '../js/modules/diagramSource.js';
+
+// Equivalent sources must encode to one GET URL (one nginx cache entry), but
+// only where the renderer really ignores the whitespace being dropped.
+
+test('whitespace-insensitive types drop BOM, CRLF and trailing blanks', () => {
+    const canonical = '@startuml\nA -> B\n@enduml\n';
+    assert.equal(canonicalDiagramSource('\uFEFF@startuml\r\nA -> B  \r\n@enduml', 'plantuml'), canonical);
+    assert.equal(canonicalDiagramSource('\n@startuml\rA -> B\t\n@enduml\n\n', 'plantuml'), canonical);
+    assert.equal(canonicalDiagramSource(canonical, 'plantuml'), canonical);
+});
+
+test('leading indentation is kept', () => {
+    assert.equal(canonicalDiagramSource('mindmap\n  root\n    child  \n', 'mermaid'), 'mindmap\n  root\n    child\n');
+});
+
+test('ascii-art types are left verbatim', () => {
+    for (const t of ['ditaa', 'svgbob', 'goat']) {
+        assert.ok(!WHITESPACE_INSENSITIVE_TYPES.has(t));
+        assert.equal(canonicalDiagramSource('+--+  \r\n|  |\n\n', t), '+--+  \r\n|  |\n\n');
+    }
+});
+
+test('unknown types are left verbatim', () => {
+    assert.equal(canonicalDiagramSource(' a \n', 'wireviz'), ' a \n');
+    assert.equal(canonicalDiagramSource(' a \n', undefined), ' a \n');
+});
@@ -0,0 +1,336 @@
+"""Tests for the async AI relay in asgi.py (SERVER_MODE=asgi)."""
+
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import pytest
+
+import asgi
+
+GOOD_ORIGIN = 'https://localhost:8443'
+MODEL = 'openai/gpt-5-mini'
+
+
+def ai_body(**overrides):
+    body = {
+        'messages': [{'role': 'user', 'content': 'draw a cat'}],
+        'model': MODEL,
+    }
+    body.update(overrides)
+    return body
+
+
+def http_scope(method, path, headers):
+    return {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'scheme': 'http',
+        'http_version': '1.1',
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 50000),
+        'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    }
+
+
+async def call_async(method, path, body=b'', headers=None):
+    """Drive asgi.app once; returns (status, headers dict, body bytes)."""
+    messages = []
+    delivered = False
+
+    async def receive():
+        nonlocal delivered
+        if not delivered:
+            delivered = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await asyncio.Event().wait()  # the client never disconnects
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi.app(http_scope(method, path, headers or {}), receive, send)
+    start = messages[0]
+    resp_headers = {k.decode(): v.decode() for k, v in start['headers']}
+    return start['status'], resp_headers, b''.join(m.get('body', b'') for m in messages[1:])
+
+
+def post_ai(server, body=None, origin=GOOD_ORIGIN, with_session=True):
+    headers = {'Content-Type': 'application/json'}
+    if origin is not None:
+        headers['Origin'] = origin
+    if with_session:
+        headers['Cookie'] = f'{server.SESSION_COOKIE_NAME}={server.issue_session_token()}'
+    raw = json.dumps(body or ai_body()).encode()
+    return asyncio.run(call_async('POST', '/api/ai-assist', raw, headers))
+
+
+@pytest.fixture
+def async_upstream(server, monkeypatch):
+    """Route the async client through httpx.MockTransport; returns a recorder."""
+    monkeypatch.setattr(server.limiter, 'enabled', False)
+
+    class Recorder:
+        def __init__(self):
+            self.calls = []
+            self.handler = lambda request: httpx.Response(
+                200, json={'choices': [{'message': {'content': 'ok'}}]})
+
+    rec = Recorder()
+
+    async def dispatch(request):
+        rec.calls.append({'url': str(request.url), 'json': json.loads(request.content)})
+        result = rec.handler(request)
+        return await result if asyncio.iscoroutine(result) else result
+
+    monkeypatch.setattr(asgi, '_upstream_client', httpx.AsyncClient(transport=httpx.MockTransport(dispatch)))
+    return rec
+
+
+def test_asgi_relay_requires_origin(server, async_upstream):
+    status, _, _ = post_ai(server, origin=None)
+    assert status == 403
+    assert async_upstream.calls == []
+
+
+def test_asgi_relay_requires_session(server, async_upstream):
+    status, _, _ = post_ai(server, with_session=False)
+    assert status == 401
+    assert async_upstream.calls == []
+
+
+def test_asgi_relay_mode_gate(server, async_upstream, monkeypatch):
+    monkeypatch.setattr(server, 'AI_MODE', 'byok')
+    status, _, body = post_ai(server, with_session=False)
+    assert status == 503
+    assert json.loads(body)['mode'] == 'byok'
+
+
+def test_asgi_relay_non_streaming_clamps_payload(server, async_upstream):
+    status, headers, body = post_ai(server, body=ai_body(max_tokens=10 ** 9))
+    assert status == 200
+    assert json.loads(body)['choices'][0]['message']['content'] == 'ok'
+    assert headers['access-control-allow-origin'] == GOOD_ORIGIN
+    assert async_upstream.calls[0]['json']['max_completion_tokens'] <= server.AI_MAX_TOKENS
+
+
+def test_asgi_relay_maps_upstream_quota_errors(server, async_upstream):
+    async_upstream.handler = lambda request: httpx.Response(
+        402, json={'error': {'message': 'Insufficient credits', 'code': 402}})
+    status, _, body = post_ai(server)
+    assert status == 429
+    assert json.loads(body)['code'] == 'free_quota_exhausted'
+
+
+def test_asgi_relay_streams_lines(server, async_upstream):
+    async_upstream.handler = lambda request: httpx.Response(
+        200, content=b'data: {"choices":[{"delta":{"content":"hi"}}]}\n\ndata: [DONE]\n')
+    status, headers, body = post_ai(server, body=ai_body(stream=True))
+    assert status == 200
+    assert headers['content-type'] == 'text/event-stream'
+    assert async_upstream.calls[0]['json']['stream'] is True
+    assert body.decode().splitlines() == ['data: {"choices":[{"delta":{"content":"hi"}}]}', 'data: [DONE]']
+
+
+def test_asgi_relay_mid_stream_failure_sends_error_frame(server, async_upstream):
+    async def broken():
+        yield b'data: {"choices":[{"delta":{"content":"hi"}}]}\n'
+        raise httpx.ReadError('connection reset')
+
+    async_upstream.handler = lambda request: httpx.Response(200, content=broken())
+    status, _, body = post_ai(server, body=ai_body(stream=True))
+    assert status == 200
+    assert body.decode().endswith(server.STREAM_INTERRUPTED_FRAME)
+
+
+def test_asgi_relay_upstream_unreachable_is_503(server, async_upstream):
+    def refuse(request):
+        raise httpx.ConnectError('refused')
+
+    async_upstream.handler = refuse
+    status, _, _ = post_ai(server)
+    assert status == 503
+
+
+def test_asgi_holds_many_idle_streams_in_one_loop(server, async_upstream, monkeypatch):
+    """1000 concurrent streams wait on the model without any thread per stream."""
+    monkeypatch.setattr(server.ai_admission, 'max_concurrent', 0)
+    monkeypatch.setattr(server.ai_admission, 'max_per_model', 0)
+    streams = 1000
+    waiting = 0
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_model(request):
+            nonlocal waiting
+            waiting += 1
+            await release.wait()
+            return httpx.Response(200, content=b'data: [DONE]\n')
+
+        async_upstream.handler = slow_model
+        headers = {
+            'Origin': GOOD_ORIGIN,
+            'Cookie': f'{server.SESSION_COOKIE_NAME}={server.issue_session_token()}',
+        }
+        # Distinct prompts, so single-flight coalescing does not merge them.
+        bodies = [json.dumps(ai_body(stream=True, messages=[{'role': 'user', 'content': f'cat {i}'}])).encode()
+                  for i in range(streams)]
+        tasks = [asyncio.ensure_future(call_async('POST', '/api/ai-assist', raw, headers))
+                 for raw in bodies]
+        while waiting < streams:
+            await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(scenario())
+    assert waiting == streams
+    assert all(status == 200 for status, _, _ in results)
+
+
+
+def test_asgi_coalesces_identical_streams(server, async_upstream):
+    """Identical concurrent streams share one upstream call and all get every line."""
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_model(request):
+            await release.wait()
+            return httpx.Response(200, content=b'data: {"choices":[{"delta":{"content":"hi"}}]}\n\ndata: [DONE]\n')
+
+        async_upstream.handler = slow_model
+        headers = {
+            'Origin': GOOD_ORIGIN,
+            'Cookie': f'{server.SESSION_COOKIE_NAME}={server.issue_session_token()}',
+        }
+        raw = json.dumps(ai_body(stream=True)).encode()
+        tasks = [asyncio.ensure_future(call_async('POST', '/api/ai-assist', raw, headers))
+                 for _ in range(4)]
+        while not async_upstream.calls:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(scenario())
+    assert len(async_upstream.calls) == 1
+    assert sum(h.get('x-ai-coalesced') == 'follower' for _, h, _ in results) == 3
+    assert all(body.decode().splitlines()[-1] == 'data: [DONE]' for _, _, body in results)
+    assert asgi._inflight == {}
+
+def test_asgi_delegates_other_routes_to_flask(server):
+    status, _, body = asyncio.run(call_async('GET', '/api/health'))
+    assert status == 200
+    assert json.loads(body)['status'] == 'healthy'
+
+
+def test_asgi_relay_busy_is_503_with_retry_after(server, async_upstream, monkeypatch):
+    admission = server.AdmissionController(1, 0, 0, 1)
+    monkeypatch.setattr(server, 'ai_admission', admission)
+    held, _ = admission.admit('ip:other', MODEL)
+    status, headers, body = post_ai(server)
+    held.release()
+    assert status == 503
+    assert int(headers['retry-after']) == json.loads(body)['retry_after'] >= 1
+    assert async_upstream.calls == []
+
+
+def test_asgi_relay_reports_serving_model(server, async_upstream):
+    _, headers, _ = post_ai(server)
+    assert headers['x-ai-model'] == MODEL
+
+
+def test_asgi_sends_early_hints_for_index(server):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = dict(http_scope('GET', '/', {}), extensions={'http.response.early_hint': {}})
+    asyncio.run(asgi.app(scope, receive, send))
+    assert messages[0]['type'] == 'http.response.early_hint'
+    assert messages[0]['links'] == [link.encode() for link in server.INDEX_PRELOAD.links]
+    assert messages[1]['status'] == 200
+
+
+def test_asgi_relay_enforces_token_budget_and_records_usage(server, async_upstream, tmp_path, monkeypatch):
+    ledger = server.UsageLedger(str(tmp_path / 'usage.jsonl'), 3600, 1000)
+    monkeypatch.setattr(server, 'usage_ledger', ledger)
+    monkeypatch.setattr(server, '_budget_storage', {})
+    monkeypatch.setattr(server, 'TOKEN_BUDGETS', [server.TokenBudget('ip', '40000/day')])
+    async_upstream.handler = lambda request: httpx.Response(200, json={
+        'choices': [{'message': {'content': 'ok'}}],
+        'usage': {'prompt_tokens': 30000, 'completion_tokens': 0, 'total_tokens': 30000}})
+    assert post_ai(server)[0] == 200
+    status, headers, body = post_ai(server, body=ai_body(messages=[{'role': 'user', 'content': 'a dog'}]))
+    assert status == 429
+    assert json.loads(body)['code'] == 'token_budget'
+    assert 'retry-after' in headers
+    assert len(async_upstream.calls) == 1
+    assert [entry['total_tokens'] for entry in ledger.entries()] == [30000]
+
+
+def test_asgi_relay_runs_repair_loop_off_the_event_loop(server, upstream, monkeypatch):
+    monkeypatch.setattr(server.limiter, 'enabled', False)
+    monkeypatch.setattr(server, 'AI_REPAIR_ENABLED', True)
+    renders = []
+    monkeypatch.setattr(server, 'render_via_gateway', lambda *fields, **kwargs: renders.append(fields) or (
+        200, 'image/svg+xml', b'<svg/>', {}))
+    upstream.response.json()['choices'][0]['message']['content'] = '{"diagramCode":"A -> B","explanation":"ok"}'
+    status, headers, body = post_ai(server, body=ai_body(repair={'diagramType': 'plantuml'}))
+    assert status == 200
+    assert json.loads(body)['repair'] == {'checked': True, 'valid': True, 'attempts': 1}
+    assert headers['x-ai-model'] == MODEL
+    assert renders == [('plantuml', 'svg', {}, 'A -> B')]
+    assert len(upstream.calls) == 1
+
+
+def test_asgi_relay_is_counted_in_metrics(server, async_upstream, monkeypatch):
+    for metric in (server.http_requests, server.ai_upstream_responses, server.ai_relay_bytes):
+        monkeypatch.setattr(metric, '_local', threading.local())
+        monkeypatch.setattr(metric, '_shards', [])
+    assert post_ai(server)[0] == 200
+    assert server.http_requests.snapshot() == [[['/api/ai-assist', 'POST', '200'], 1]]
+    assert server.ai_upstream_responses.snapshot() == [[[MODEL, '200'], 1]]
+    assert server.ai_relay_bytes.snapshot()[0][0] == ['once']
+
+
+def test_asgi_relay_times_stream_phases(server, async_upstream, monkeypatch):
+    monkeypatch.setattr(server, 'stream_timings', server.StreamTimings(10))
+    async_upstream.handler = lambda request: httpx.Response(
+        200, content=b'data: {"choices":[{"delta":{"content":"A"}}]}\n\n'
+                     b'data: {"choices":[{"delta":{"content":"B"}}]}\n\ndata: [DONE]\n')
+    assert post_ai(server, body=ai_body(stream=True))[0] == 200
+    stats = server.stream_timings.stats()[MODEL]
+    assert stats['outcomes'] == {'complete': 1}
+    assert stats['ttft_s']['p50'] <= stats['total_s']['p50']
+    assert stats['tokens_per_s'] is not None  # two deltas, counted without a usage report
+
+
+def test_asgi_relay_runs_blocking_storage_calls_off_the_event_loop(server, async_upstream, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(asgi, 'check_rate_limits', lambda remote_addr: release.wait(5) and None)
+    headers = {
+        'Origin': GOOD_ORIGIN,
+        'Cookie': f'{server.SESSION_COOKIE_NAME}={server.issue_session_token()}',
+    }
+
+    async def scenario():
+        task = asyncio.ensure_future(call_async('POST', '/api/ai-assist', json.dumps(ai_body()).encode(), headers))
+        started = time.monotonic()
+        await asyncio.sleep(0.05)  # the loop keeps running while the limiter storage blocks
+        stalled = time.monotonic() - started
+        release.set()
+        return stalled, await task
+
+    stalled, (status, _, _) = asyncio.run(scenario())
+    assert stalled < 1
+    assert status == 200
@@ -1,6 +1,11 @@
 """Security and validation tests for the AI proxy endpoint and static serving."""
 
 import json
+import os
+import threading
+import time
+
+import pytest
 
 GOOD_ORIGIN = 'https://localhost:8443'
 MODEL = 'openai/gpt-5-mini'
@@ -338,7 +343,7 @@ def test_apply_model_allowlist_glob_filters(server):
 def test_allowlist_enforced_on_relay_request(client, server, upstream, monkeypatch):
     """A non-allowlisted model POST must 400 before reaching upstream."""
     monkeypatch.setattr(server, 'AI_MODE', 'relay')
-    monkeypatch.setattr(server, 'AVAILABLE_MODELS', {'openai': {MODEL: {}}})
+    monkeypatch.setattr(server, 'MODEL_REGISTRY', server.ModelRegistry({'openai': {MODEL: {}}}))
     # allowed model succeeds
     resp = post_ai(client, body=ai_body(model=MODEL))
     assert resp.status_code == 200
@@ -472,3 +477,1453 @@ def test_disabled_diagram_types_normalisation():
             if key == 'server':
                 del sys.modules[key]
         import server  # noqa: F401 — re-import canonical module
+
+
+# --- pooled upstream client ----------------------------------------------------
+
+
+def _keepalive_server():
+    """Start a local HTTP/1.1 keep-alive server; returns (httpd, base_url)."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            body = b'{"data": []}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f'http://127.0.0.1:{httpd.server_address[1]}'
+
+
+def test_upstream_session_reuses_keepalive_connections(server, monkeypatch):
+    monkeypatch.setitem(server._upstream_pool, 'pid', None)  # force a fresh pool
+    httpd, base = _keepalive_server()
+    try:
+        session = server.upstream_session()
+        for _ in range(3):
+            session.get(base + '/models', timeout=5).content
+        stats = server.upstream_pool_stats()
+        assert stats['new_connections'] == 1
+        assert stats['reused'] == 2
+        assert stats['reuse_ratio'] == round(2 / 3, 3)
+    finally:
+        httpd.shutdown()
+
+
+def test_upstream_pool_evicts_idle_connections(server, monkeypatch):
+    monkeypatch.setitem(server._upstream_pool, 'pid', None)
+    monkeypatch.setattr(server, 'AI_POOL_IDLE_TIMEOUT', 0)
+    httpd, base = _keepalive_server()
+    try:
+        session = server.upstream_session()
+        session.get(base + '/models', timeout=5).content
+        session.get(base + '/models', timeout=5).content
+        stats = server.upstream_pool_stats()
+        assert stats['idle_evictions'] == 1
+        assert stats['new_connections'] == 2
+    finally:
+        httpd.shutdown()
+
+
+def test_warmed_connections_are_reused_by_requests(server, monkeypatch):
+    monkeypatch.setitem(server._upstream_pool, 'pid', None)
+    httpd, base = _keepalive_server()
+    monkeypatch.setattr(server, 'AI_PROXY_URL', base)
+    try:
+        session = server.upstream_session()
+        server._warm_upstream_pool(session, 2)
+        session.get(base + '/models', timeout=5).content
+        stats = server.upstream_pool_stats()
+        assert stats['new_connections'] == 2  # both opened by the warm-up
+        assert stats['reused'] == 1
+    finally:
+        httpd.shutdown()
+
+
+def test_upstream_session_rebuilt_after_fork(server, monkeypatch):
+    session = server.upstream_session()
+    assert server.upstream_session() is session
+    monkeypatch.setitem(server._upstream_pool, 'pid', -1)  # as seen from a forked child
+    assert server.upstream_session() is not session
+
+
+def test_stats_endpoint_reports_upstream_pool(client):
+    resp = client.get('/api/stats', headers={'Origin': GOOD_ORIGIN})
+    assert resp.status_code == 200
+    assert 'reuse_ratio' in resp.get_json()['upstream_pool']
+    assert client.get('/api/stats', headers={'Origin': 'https://evil.example'}).status_code == 403
+
+
+def test_stats_endpoint_requires_admin_token_when_set(client, server, monkeypatch):
+    monkeypatch.setattr(server, 'ADMIN_TOKEN', 's3cret')
+    assert client.get('/api/stats').status_code == 401
+    assert client.get('/api/stats', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/api/stats', headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+
+
+# --- completion cache ------------------------------------------------------------
+
+
+def _enable_ai_cache(server, monkeypatch, disk_dir=None):
+    monkeypatch.setattr(server, 'AI_CACHE_ENABLED', True)
+    monkeypatch.setattr(server, '_ai_cache_memory', server.LRUByteCache(1024 * 1024, 60))
+    monkeypatch.setattr(server, '_ai_cache_counters', dict.fromkeys(server.AI_CACHE_COUNTERS, 0))
+    disk = server.DiskCache(str(disk_dir), 1024 * 1024, 60) if disk_dir else None
+    monkeypatch.setattr(server, '_ai_cache_disk', disk)
+
+
+def test_ai_cache_disabled_by_default(client, server, upstream):
+    post_ai(client, body=ai_body(temperature=0))
+    resp = post_ai(client, body=ai_body(temperature=0))
+    assert 'X-AI-Cache' not in resp.headers
+    assert len(upstream.calls) == 2
+
+
+def test_ai_cache_serves_identical_requests(client, server, upstream, monkeypatch):
+    _enable_ai_cache(server, monkeypatch)
+    first = post_ai(client, body=ai_body(temperature=0))
+    # max_tokens above the ceiling clamps to the same payload -> same key
+    second = post_ai(client, body=ai_body(temperature=0, max_tokens=10 ** 9))
+    assert first.headers['X-AI-Cache'] == 'MISS'
+    assert second.headers['X-AI-Cache'] == 'HIT'
+    assert second.get_json() == first.get_json()
+    assert len(upstream.calls) == 1
+    assert server.ai_cache_stats()['hit_ratio'] == 0.5
+
+
+def test_ai_cache_bypassed_above_temperature_threshold(client, server, upstream, monkeypatch):
+    _enable_ai_cache(server, monkeypatch)
+    post_ai(client, body=ai_body(temperature=1.0))
+    resp = post_ai(client, body=ai_body(temperature=1.0))
+    assert resp.headers['X-AI-Cache'] == 'BYPASS'
+    assert len(upstream.calls) == 2
+
+
+def test_ai_cache_ignores_streaming_requests(client, server, upstream, monkeypatch):
+    _enable_ai_cache(server, monkeypatch)
+    post_ai(client, body=ai_body(temperature=0, stream=True)).get_data()
+    post_ai(client, body=ai_body(temperature=0, stream=True)).get_data()
+    assert len(upstream.calls) == 2
+
+
+def test_lru_byte_cache_evicts_least_recently_used(server):
+    cache = server.LRUByteCache(max_bytes=10, ttl=60)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    cache.get('a')  # 'b' is now least recently used
+    cache.put('c', b'12345')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'12345'
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_byte_cache_expires_entries(server, monkeypatch):
+    cache = server.LRUByteCache(max_bytes=100, ttl=60)
+    cache.put('a', b'x')
+    monkeypatch.setattr(server.time, 'time', lambda: 10 ** 12)
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] == 0
+
+
+def test_ai_cache_disk_tier_survives_restart(client, server, upstream, monkeypatch, tmp_path):
+    _enable_ai_cache(server, monkeypatch, disk_dir=tmp_path)
+    post_ai(client, body=ai_body(temperature=0))
+    # A restart empties the memory tier; the disk tier still answers.
+    monkeypatch.setattr(server, '_ai_cache_memory', server.LRUByteCache(1024 * 1024, 60))
+    resp = post_ai(client, body=ai_body(temperature=0))
+    assert resp.headers['X-AI-Cache'] == 'HIT'
+    assert server.ai_cache_stats()['disk_hits'] == 1
+    assert len(upstream.calls) == 1
+
+
+def test_disk_cache_prunes_to_byte_cap(server, tmp_path):
+    cache = server.DiskCache(str(tmp_path), max_bytes=200, ttl=60)
+    for i in range(10):
+        cache.put(f'{i:02d}' + 'k' * 8, b'x' * 50)
+    cache.prune()
+    total = sum(f.stat().st_size for f in tmp_path.rglob('*') if f.is_file())
+    assert total <= 200
+    assert cache.stats()['evictions'] > 0
+
+
+def test_disk_cache_creates_its_directory_on_first_write(server, tmp_path):
+    root = tmp_path / 'render'
+    cache = server.DiskCache(str(root), max_bytes=1024, ttl=60)
+    assert not root.exists()  # importing server must not leave root-owned dirs behind
+    assert cache.get('ab' * 8) is None
+    assert cache.put('ab' * 8, b'x') and cache.get('ab' * 8) == b'x'
+
+
+# --- single-flight coalescing ----------------------------------------------------
+
+
+def _wait_for(predicate, timeout=5):
+    import time
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'condition not reached in time'
+        time.sleep(0.005)
+
+
+def test_concurrent_identical_requests_share_one_upstream_call(app, server, monkeypatch):
+    import threading
+    from conftest import FakeUpstreamResponse
+
+    release = threading.Event()
+    calls = []
+
+    def slow_post(session, url, **kwargs):
+        calls.append(kwargs)
+        release.wait(5)
+        return FakeUpstreamResponse()
+
+    monkeypatch.setattr(server.requests.Session, 'post', slow_post)
+    followers_before = server.coalesce_stats()['followers']
+    results = []
+
+    def send():
+        results.append(post_ai(app.test_client()))
+
+    threads = [threading.Thread(target=send) for _ in range(4)]
+    for t in threads:
+        t.start()
+    _wait_for(lambda: server.coalesce_stats()['followers'] - followers_before == 3)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert len(calls) == 1
+    assert [r.status_code for r in results] == [200] * 4
+    assert len({r.get_data() for r in results}) == 1
+    assert sum(r.headers.get('X-AI-Coalesced') == 'follower' for r in results) == 3
+    assert server.coalesce_stats()['in_flight'] == 0
+
+
+def test_stream_follower_replays_from_start_after_leader_leaves(app, server, monkeypatch):
+    import threading
+    from conftest import FakeUpstreamResponse
+
+    release = threading.Event()
+    calls = []
+
+    class SlowStream(FakeUpstreamResponse):
+        def iter_lines(self):
+            yield b'data: one'
+            release.wait(5)
+            yield b'data: two'
+            yield b'data: [DONE]'
+
+    upstream_resp = SlowStream()
+
+    def fake_post(session, url, **kwargs):
+        calls.append(kwargs)
+        return upstream_resp
+
+    monkeypatch.setattr(server.requests.Session, 'post', fake_post)
+
+    leader = post_ai(app.test_client(), body=ai_body(stream=True))
+    leader_iter = iter(leader.response)
+    assert next(leader_iter) == b'data: one\n'
+
+    follower_body = []
+
+    def follow():
+        resp = post_ai(app.test_client(), body=ai_body(stream=True))
+        follower_body.append((resp.headers.get('X-AI-Coalesced'), resp.get_data(as_text=True)))
+
+    t = threading.Thread(target=follow)
+    t.start()
+    _wait_for(lambda: server._inflight and next(iter(server._inflight.values())).subscribers == 2)
+    leader.close()  # the original requester disconnects mid-stream
+    assert not upstream_resp.closed
+    release.set()
+    t.join(5)
+
+    assert len(calls) == 1
+    assert follower_body == [('follower', 'data: one\ndata: two\ndata: [DONE]\n')]
+    assert upstream_resp.closed
+
+
+def test_abandoned_stream_closes_upstream(client, server, upstream):
+    resp = post_ai(client, body=ai_body(stream=True))
+    next(iter(resp.response))
+    resp.close()
+    assert upstream.response.closed
+    assert server.coalesce_stats()['in_flight'] == 0
+
+
+def test_stream_closed_before_its_first_chunk_still_cleans_up(client, server, upstream, monkeypatch):
+    admission = server.AdmissionController(4, 0, 0, 1)
+    monkeypatch.setattr(server, 'ai_admission', admission)
+    monkeypatch.setattr(server, 'record_usage', lambda *a: 1 / 0)  # bookkeeping failures must not leak either
+    def streams():
+        return sum(value for _, value in server.ai_active_streams.snapshot())
+
+    gauge = streams()
+    resp = post_ai(client, body=ai_body(stream=True))
+    assert admission.active == 1
+    with pytest.raises(ZeroDivisionError):
+        resp.close()  # the client went away before the body started
+    assert upstream.response.closed and admission.active == 0
+    assert streams() == gauge
+    assert server.coalesce_stats()['in_flight'] == 0
+
+
+def test_coalescing_disabled_makes_independent_calls(app, server, monkeypatch):
+    import threading
+    from conftest import FakeUpstreamResponse
+
+    monkeypatch.setattr(server, 'AI_COALESCE_ENABLED', False)
+    release = threading.Event()
+    calls = []
+
+    def slow_post(session, url, **kwargs):
+        calls.append(kwargs)
+        release.wait(5)
+        return FakeUpstreamResponse()
+
+    monkeypatch.setattr(server.requests.Session, 'post', slow_post)
+    threads = [threading.Thread(target=lambda: post_ai(app.test_client())) for _ in range(2)]
+    for t in threads:
+        t.start()
+    _wait_for(lambda: len(calls) == 2)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+
+# --- admission control and fair queuing ----------------------------------------
+
+
+def test_relay_fails_fast_with_retry_after_when_saturated(client, server, upstream, monkeypatch):
+    admission = server.AdmissionController(1, 0, 0, 1)
+    monkeypatch.setattr(server, 'ai_admission', admission)
+    admission.service_times[MODEL] = 12.0
+    held, _ = admission.admit('ip:other', MODEL)
+
+    resp = post_ai(client)
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == '12'
+    assert resp.get_json()['retry_after'] == 12
+    assert 'service is currently unavailable' in resp.get_json()['error']
+    assert upstream.calls == []
+
+    held.release()
+    assert post_ai(client).status_code == 200
+    assert admission.stats()['active'] == 0
+    assert admission.stats()['rejected'] == 1
+
+
+def test_fair_queue_serves_other_clients_before_a_busy_one(server):
+    import threading
+
+    admission = server.AdmissionController(1, 0, 10, 5)
+    held, _ = admission.admit('tabs', MODEL)
+    order = []
+
+    def wait_turn(client):
+        slot, _ = admission.admit(client, MODEL)
+        order.append(client)
+        slot.release()
+
+    threads = []
+    for name in ('tabs', 'tabs', 'other'):
+        threads.append(threading.Thread(target=wait_turn, args=(name,)))
+        threads[-1].start()
+        _wait_for(lambda: admission.stats()['waiting'] == len(threads))
+    held.release()
+    for t in threads:
+        t.join(5)
+
+    assert order == ['other', 'tabs', 'tabs']
+
+
+def test_per_model_limit_leaves_other_models_free(server):
+    admission = server.AdmissionController(0, 1, 0, 0.05)
+    held, _ = admission.admit('a', MODEL)
+    other, _ = admission.admit('a', 'meta-llama/llama-3.3-70b-instruct')
+    assert other is not None
+    slot, retry_after = admission.admit('b', MODEL)
+    assert slot is None and retry_after >= 1
+    held.release()
+    other.release()
+    assert admission.stats()['active_by_model'] == {}
+
+
+def test_queued_request_times_out(server):
+    admission = server.AdmissionController(1, 0, 5, 0.05)
+    held, _ = admission.admit('a', MODEL)
+    slot, retry_after = admission.admit('b', MODEL)
+    assert slot is None and retry_after >= 1
+    stats = admission.stats()
+    assert (stats['timed_out'], stats['waiting']) == (1, 0)
+    held.release()
+
+
+# --- circuit breakers and runtime failover --------------------------------------
+
+FALLBACK_MODEL = 'openai/gpt-4o-mini'
+
+
+def test_failing_model_trips_breaker_and_fails_over(client, server, upstream, monkeypatch):
+    from conftest import FakeUpstreamResponse
+
+    monkeypatch.setattr(server, 'AI_MODEL_FALLBACKS', [FALLBACK_MODEL])
+    upstream.response = FakeUpstreamResponse(status_code=502, json_body={'error': {'message': 'bad gateway'}})
+    for _ in range(server.AI_BREAKER_MIN_REQUESTS):
+        assert post_ai(client).status_code == 502
+    assert server.breaker_stats()[MODEL]['state'] == 'open'
+
+    upstream.response = FakeUpstreamResponse()
+    resp = post_ai(client)
+    assert resp.status_code == 200
+    assert resp.headers['X-AI-Model'] == FALLBACK_MODEL
+    assert upstream.calls[-1]['json']['model'] == FALLBACK_MODEL
+
+
+def test_healthy_model_is_reported_unchanged(client, server, upstream):
+    resp = post_ai(client, body=ai_body(stream=True))
+    assert resp.headers['X-AI-Model'] == MODEL
+    assert server.breaker_stats()[MODEL]['state'] == 'closed'
+
+
+def test_every_candidate_open_fails_fast_with_retry_after(client, server, upstream, monkeypatch):
+    monkeypatch.setattr(server, 'AI_MODEL_FALLBACKS', [])
+    with server._breaker_lock:
+        server._breaker(MODEL)._open(server.time.monotonic(), 'test')
+    resp = post_ai(client)
+    assert resp.status_code == 503
+    assert 1 <= int(resp.headers['Retry-After']) <= server.AI_BREAKER_COOLDOWN
+    assert upstream.calls == []
+
+
+def test_half_open_breaker_admits_one_probe_then_closes(server):
+    breaker = server.CircuitBreaker(MODEL)
+    breaker._open(100.0, 'test')
+    assert not breaker.allow(101.0)
+    probe_time = 100.0 + server.AI_BREAKER_COOLDOWN
+    assert breaker.allow(probe_time) and breaker.allow(probe_time)  # looking claims nothing
+    assert breaker.claim(probe_time)
+    assert breaker.state == 'half_open'
+    assert not breaker.allow(probe_time + 1) and not breaker.claim(probe_time + 1)  # one probe at a time
+    breaker.record(probe_time + 2, True, 1.0)
+    assert breaker.state == 'closed' and breaker.allow(probe_time + 3)
+
+
+def test_failed_probe_reopens_breaker(server):
+    breaker = server.CircuitBreaker(MODEL)
+    breaker._open(0.0, 'test')
+    assert breaker.claim(server.AI_BREAKER_COOLDOWN)
+    breaker.record(server.AI_BREAKER_COOLDOWN + 1, False, 1.0)
+    assert breaker.state == 'open' and breaker.trips == 2
+
+
+def test_half_open_probe_is_claimed_at_admission_not_selection(client, server, upstream, monkeypatch):
+    monkeypatch.setattr(server, 'AI_MODEL_FALLBACKS', [])
+    with server._breaker_lock:
+        server._breaker(MODEL)._open(server.time.monotonic() - server.AI_BREAKER_COOLDOWN, 'test')
+    assert server.select_model(MODEL, server.MODEL_REGISTRY) == (MODEL, None)
+    assert server.breaker_stats()[MODEL]['state'] == 'open'  # a cache hit or follower would stop here
+    admission = server.AdmissionController(1, 0, 0, 1)
+    monkeypatch.setattr(server, 'ai_admission', admission)
+    held, _ = admission.admit('ip:other', MODEL)
+    assert post_ai(client).status_code == 503  # turned away before going upstream
+    assert server.breaker_stats()[MODEL]['state'] == 'open'
+    admission.release(held)
+    resp = post_ai(client)
+    assert resp.status_code == 200 and len(upstream.calls) == 1
+    assert server.breaker_stats()[MODEL]['state'] == 'closed'
+
+
+def test_slow_p95_trips_breaker(server):
+    breaker = server.CircuitBreaker(MODEL)
+    for i in range(server.AI_BREAKER_MIN_REQUESTS):
+        breaker.record(float(i), True, server.AI_BREAKER_SLOW_SECONDS + 1)
+    assert breaker.state == 'open'
+
+
+# --- model catalog snapshot and background refresh ------------------------------
+
+PROXY_CATALOG = {'openai': {MODEL: {'name': MODEL, 'provider': 'openai'}}}
+
+
+def test_model_snapshot_round_trip_reapplies_allowlist(server, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, 'AI_MODELS_SNAPSHOT', str(tmp_path / 'models.json'))
+    catalog = {**PROXY_CATALOG, 'meta-llama': {'meta-llama/llama-3.3-70b-instruct': {}}}
+    server.save_models_snapshot(catalog)
+    assert server.load_models_snapshot() == catalog
+
+    monkeypatch.setattr(server, 'AI_MODEL_ALLOWLIST', ['openai/*'])
+    assert server.load_models_snapshot() == PROXY_CATALOG
+
+
+def test_unreadable_snapshot_is_ignored(server, monkeypatch, tmp_path):
+    snapshot = tmp_path / 'models.json'
+    snapshot.write_text('{not json')
+    monkeypatch.setattr(server, 'AI_MODELS_SNAPSHOT', str(snapshot))
+    assert server.load_models_snapshot() is None
+
+
+def test_refresh_swaps_catalog_and_writes_snapshot(server, monkeypatch, tmp_path):
+    import json
+
+    monkeypatch.setattr(server, 'AI_MODELS_SNAPSHOT', str(tmp_path / 'models.json'))
+    monkeypatch.setattr(server, 'MODEL_REGISTRY', server.MODEL_REGISTRY)
+    monkeypatch.setattr(server, 'fetch_models_from_proxy', lambda: PROXY_CATALOG)
+    previous = server.MODEL_REGISTRY
+
+    assert server.refresh_available_models() is True
+    assert server.MODEL_REGISTRY.grouped == PROXY_CATALOG
+    assert previous is not server.MODEL_REGISTRY  # rebound, not mutated in place
+    assert previous.version != server.MODEL_REGISTRY.version
+    assert json.loads((tmp_path / 'models.json').read_text())['models'] == PROXY_CATALOG
+    assert server.model_catalog_stats()['source'] == 'proxy'
+
+
+def test_failed_refresh_keeps_current_catalog(server, monkeypatch, tmp_path):
+    monkeypatch.setattr(server, 'AI_MODELS_SNAPSHOT', str(tmp_path / 'models.json'))
+    monkeypatch.setattr(server, 'fetch_models_from_proxy', lambda: None)
+    current = server.MODEL_REGISTRY
+    failures = server.model_catalog_stats()['failures']
+
+    assert server.refresh_available_models() is False
+    assert server.MODEL_REGISTRY is current
+    assert server.model_catalog_stats()['failures'] == failures + 1
+    assert not (tmp_path / 'models.json').exists()
+
+
+# --- model registry --------------------------------------------------------------
+
+
+def test_model_registry_indexes_catalog(server):
+    registry = server.ModelRegistry({
+        'openai': {MODEL: {'name': 'GPT-5 Mini'}},
+        'meta-llama': {'meta-llama/llama-3.3-70b-instruct': {}},
+    })
+    assert MODEL in registry and 'openai/unknown' not in registry
+    assert len(registry) == 2
+    assert registry.get(MODEL) == {'name': 'GPT-5 Mini'}
+    assert registry.provider('meta-llama/llama-3.3-70b-instruct') == 'meta-llama'
+    assert registry.ids == (MODEL, 'meta-llama/llama-3.3-70b-instruct')
+    assert registry.etag == f'"{registry.version}"'
+
+
+def test_model_registry_version_tracks_content(server):
+    a = server.ModelRegistry({'openai': {MODEL: {}}})
+    b = server.ModelRegistry({'openai': {MODEL: {}}})
+    c = server.ModelRegistry({'openai': {MODEL: {'context': '128k'}}})
+    assert a.version == b.version != c.version
+
+
+def test_model_registry_copies_its_input(server):
+    grouped = {'openai': {MODEL: {}}}
+    registry = server.ModelRegistry(grouped)
+    grouped['openai']['openai/gpt-4o'] = {}
+    assert 'openai/gpt-4o' not in registry
+
+
+def test_validate_model_uses_registry(client, server, monkeypatch):
+    monkeypatch.setattr(server, 'MODEL_REGISTRY', server.ModelRegistry({'openai': {MODEL: {'name': 'x'}}}))
+    ok = client.post('/api/validate-model', json={'model': MODEL}, headers={'Origin': GOOD_ORIGIN})
+    assert ok.get_json()['model_info'] == {'name': 'x'}
+    missing = client.post('/api/validate-model', json={'model': 'openai/gpt-4o'}, headers={'Origin': GOOD_ORIGIN})
+    assert missing.status_code == 400
+
+
+# --- pre-serialized read-only endpoints ------------------------------------------
+
+READ_ONLY_ENDPOINTS = ['/api/config', '/api/ai-prompts', '/api/available-models', '/api/version']
+
+
+@pytest.mark.parametrize('path', READ_ONLY_ENDPOINTS)
+def test_read_only_endpoint_revalidates_with_304(client, path):
+    first = client.get(path, headers={'Origin': GOOD_ORIGIN})
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+
+    again = client.get(path, headers={'Origin': GOOD_ORIGIN, 'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert again.headers['ETag'] == etag
+
+
+@pytest.mark.parametrize('path', [path for path in READ_ONLY_ENDPOINTS if path != '/api/config'])
+def test_read_only_endpoint_still_validates_origin(client, path):
+    etag = client.get(path, headers={'Origin': GOOD_ORIGIN}).headers['ETag']
+    resp = client.get(path, headers={'Origin': 'https://evil.example', 'If-None-Match': etag})
+    assert resp.status_code == 403
+
+
+def test_read_only_endpoint_serves_precompressed_variants(client, server):
+    import gzip
+
+    plain = client.get('/api/ai-prompts')
+    gz = client.get('/api/ai-prompts', headers={'Accept-Encoding': 'gzip'})
+    assert gz.headers['Content-Encoding'] == 'gzip'
+    assert gz.headers['Vary'].startswith('Accept-Encoding')
+    assert gzip.decompress(gz.get_data()) == plain.get_data()
+    assert gz.headers['ETag'] != plain.headers['ETag']
+
+    if server.brotli is not None:
+        br = client.get('/api/ai-prompts', headers={'Accept-Encoding': 'gzip, br'})
+        assert br.headers['Content-Encoding'] == 'br'
+        assert server.brotli.decompress(br.get_data()) == plain.get_data()
+
+    # Any variant's tag revalidates, whatever encoding is negotiated now.
+    resp = client.get('/api/ai-prompts', headers={'If-None-Match': gz.headers['ETag']})
+    assert resp.status_code == 304
+
+
+def test_read_only_payload_rebuilt_when_inputs_change(client, server, monkeypatch):
+    before = client.get('/api/config')
+    monkeypatch.setattr(server, 'AI_MODE', 'byok')
+    after = client.get('/api/config')
+    assert after.get_json()['ai']['mode'] == 'byok'
+    assert after.headers['ETag'] != before.headers['ETag']
+
+
+def test_small_bodies_are_not_compressed(server):
+    body = server.PrecompressedBody(b'{"ok":true}', 'application/json')
+    assert list(body.variants) == ['identity']
+
+
+# --- precompressed static asset pipeline -----------------------------------------
+
+
+def test_index_links_fingerprinted_assets(client, server):
+    html = client.get('/').get_data(as_text=True)
+    fingerprinted = server.STATIC_ASSETS.url('js/main.js')
+    assert fingerprinted != 'js/main.js'
+    assert f'src="{fingerprinted}"' in html
+    assert 'src="js/main.js"' not in html
+    # The inline importmap (CSP hash-pinned) is left byte-identical.
+    assert '"codemirror": "/js/vendor/codemirror.js"' in html
+
+
+def test_fingerprinted_asset_is_immutable(client, server):
+    resp = client.get('/' + server.STATIC_ASSETS.url('css/main.css'))
+    assert resp.status_code == 200
+    assert resp.headers['Cache-Control'] == server.STATIC_IMMUTABLE_CACHE
+    assert resp.get_data() == client.get('/css/main.css').get_data()
+
+
+def test_plain_asset_revalidates_with_304(client):
+    first = client.get('/js/main.js')
+    assert first.headers['Cache-Control'] == 'no-cache'
+    again = client.get('/js/main.js', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_stale_fingerprint_is_served_but_not_immutable(client):
+    resp = client.get('/js/main.000000000000.js')
+    assert resp.status_code == 200
+    assert resp.headers['Cache-Control'] == 'no-cache'
+
+
+def test_static_asset_negotiates_encoding(client, server):
+    import gzip
+
+    plain = client.get('/js/main.js').get_data()
+    gz = client.get('/js/main.js', headers={'Accept-Encoding': 'gzip'})
+    assert gz.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(gz.get_data()) == plain
+    identity = client.get('/js/main.js', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in identity.headers
+
+
+def test_manifest_prefers_fresh_build_time_sidecars(server, tmp_path):
+    (tmp_path / 'js').mkdir()
+    (tmp_path / 'js' / 'app.js').write_text('console.log("hello");\n' * 100)
+    server.precompress_static_assets(str(tmp_path))
+    sidecar = (tmp_path / 'js' / 'app.js.gz').read_bytes()
+
+    manifest = server.AssetManifest(str(tmp_path))
+    assert list(manifest.assets) == ['js/app.js']  # sidecars are not assets
+    assert manifest.assets['js/app.js'].variants['gzip'] == sidecar
+
+
+# --- whole-tree in-memory static cache ---------------------------------------------
+
+
+@pytest.fixture
+def memory_static(server, monkeypatch):
+    table = server.StaticTable(server.STATIC_ROOT, server.STATIC_ASSETS)
+    monkeypatch.setattr(server, 'STATIC_TABLE', table)
+    return table
+
+
+def test_static_table_skips_server_side_files(memory_static):
+    assert 'favicon.ico' in memory_static.files
+    assert 'ai-models.json' in memory_static.files
+    assert not any(path.endswith('.py') or path.startswith('tests/') for path in memory_static.files)
+    assert 'requirements.txt' not in memory_static.files
+    assert 'Dockerfile' not in memory_static.files
+
+
+def test_memory_mode_serves_without_disk(client, server, memory_static, monkeypatch):
+    def no_disk(*args, **kwargs):
+        raise AssertionError('static request touched the disk')
+
+    monkeypatch.setattr(server, 'send_from_directory', no_disk)
+    monkeypatch.setattr(server, 'send_file', no_disk)
+    monkeypatch.setattr(server.os.path, 'getmtime', no_disk)
+    assert client.get('/favicon.ico').status_code == 200
+    assert client.get('/ai-models.json').get_json()
+    assert server.SESSION_COOKIE_NAME in client.get('/').headers['Set-Cookie']
+    assert client.get('/requirements.txt').status_code == 404
+
+
+def test_memory_mode_revalidates_favicon(client, memory_static):
+    first = client.get('/favicon.ico')
+    again = client.get('/favicon.ico', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_static_reload_swaps_in_changed_files(server, tmp_path, monkeypatch):
+    (tmp_path / 'js').mkdir()
+    (tmp_path / 'js' / 'app.js').write_text('let v = 1;\n')
+    (tmp_path / 'index.html').write_text('<script src="js/app.js"></script>')
+    (tmp_path / 'server.py').write_text('SECRET = 1\n')
+    monkeypatch.setattr(server, 'STATIC_ROOT', str(tmp_path))
+    monkeypatch.setattr(server, 'STATIC_CACHE', 'memory')
+    monkeypatch.setattr(server, 'STATIC_ASSETS', server.AssetManifest(str(tmp_path)))
+    monkeypatch.setattr(server, 'INDEX_PRELOAD', None)  # reload rebinds these too
+    monkeypatch.setattr(server, 'JS_BUNDLES', None)
+    monkeypatch.setattr(server, 'STATIC_TABLE', server.StaticTable(str(tmp_path), server.STATIC_ASSETS))
+    assert sorted(server.STATIC_TABLE.files) == ['index.html', 'js/app.js']
+    before = server.STATIC_TABLE.index.body
+
+    signature = server._static_tree_signature(str(tmp_path))
+    (tmp_path / 'js' / 'app.js').write_text('let v = 2;\n')
+    assert server._static_tree_signature(str(tmp_path)) != signature
+    server.reload_static_assets()
+    assert server.STATIC_TABLE.get('js/app.js').body == b'let v = 2;\n'
+    assert server.STATIC_TABLE.index.body != before  # new fingerprint in index.html
+
+
+# --- index.html preload hints ----------------------------------------------------
+
+
+def test_module_graph_follows_relative_and_mapped_imports(server):
+    preload = server.INDEX_PRELOAD
+    assert 'js/main.js' in preload.entries
+    assert 'js/modules/fileOperations.js' in preload.modules      # ./modules/... from main.js
+    assert 'js/vendor/codemirror-view.js' in preload.modules      # bare name via the importmap
+    assert 'js/vendor/style-mod.js' in preload.modules            # imported only by a vendor bundle
+    assert preload.modules.index('js/modules/fileOperations.js') < preload.modules.index('js/vendor/style-mod.js')
+
+
+def test_index_sends_link_and_server_timing(client, server):
+    resp = client.get('/')
+    assert resp.headers['Link'] == server.INDEX_PRELOAD.link_header
+    assert '</js/vendor/style-mod.js>; rel=preload; as=script; crossorigin' in resp.headers['Link']
+    assert len(resp.headers['Link']) <= server.INDEX_PRELOAD_HEADER_BYTES
+    assert resp.headers['Server-Timing'].startswith('preload-scan;dur=')
+
+
+def test_preload_block_is_injected_after_the_importmap(server, monkeypatch):
+    monkeypatch.setattr(server, 'INDEX_PRELOAD_INJECT', True)
+    with open(server.os.path.join(server.STATIC_ROOT, 'index.html'), encoding='utf-8') as f:
+        html = server.render_index(f.read(), server.STATIC_ASSETS, None, server.INDEX_PRELOAD)
+    block = html.index('<link rel="modulepreload" href="/js/vendor/style-mod.js">')
+    assert html.index('</script>', html.index('type="importmap"')) < block < html.index('</head>')
+
+
+# --- production module bundles ---------------------------------------------------
+
+
+@pytest.fixture
+def bundled_site(server, tmp_path, monkeypatch):
+    """A two-entry site with a built bundle; returns the tmp root."""
+    (tmp_path / 'js' / 'bundles').mkdir(parents=True)
+    (tmp_path / 'js' / 'a.js').write_text('export const a = 1;\n')
+    (tmp_path / 'js' / 'b.js').write_text("import { a } from './a.js';\n")
+    (tmp_path / 'js' / 'bundles' / 'app-1a2b.js').write_text("import './chunk-3c4d.js';\n")
+    (tmp_path / 'js' / 'bundles' / 'chunk-3c4d.js').write_text('export const a = 1;\n')
+    (tmp_path / 'js' / 'bundles' / 'manifest.json').write_text(server.json.dumps({
+        'entry': 'js/bundles/app-1a2b.js',
+        'replaces': ['js/a.js', 'js/b.js'],
+        'files': ['js/bundles/app-1a2b.js', 'js/bundles/chunk-3c4d.js'],
+    }))
+    (tmp_path / 'index.html').write_text(
+        '<head>\n'
+        '    <script type="importmap">{"imports": {}}</script>\n'
+        '    <script type="module" src="js/a.js"></script>\n'
+        '    <script type="module" src="js/b.js"></script>\n'
+        '</head>\n')
+    monkeypatch.setattr(server, 'STATIC_ROOT', str(tmp_path))
+    monkeypatch.setattr(server, 'JS_BUNDLES_ENABLED', True)
+    for name in ('STATIC_ASSETS', 'STATIC_TABLE', 'JS_BUNDLES', 'INDEX_PRELOAD'):
+        monkeypatch.setattr(server, name, getattr(server, name))
+    server._index_page.clear()
+    server.reload_static_assets()
+    yield tmp_path
+    server._index_page.clear()
+
+
+def test_bundle_replaces_entry_scripts(client, server, bundled_site):
+    html = client.get('/').get_data(as_text=True)
+    entry = server.STATIC_ASSETS.url('js/bundles/app-1a2b.js')
+    assert html.count('<script type="module"') == 1
+    assert f'<script type="module" src="{entry}"></script>' in html
+    assert '<script type="importmap">{"imports": {}}</script>' in html  # CSP-hashed, untouched
+    assert server.INDEX_PRELOAD.modules == ['js/bundles/chunk-3c4d.js']
+
+
+def test_bundle_chunks_are_immutable(client, server, bundled_site):
+    resp = client.get('/js/bundles/chunk-3c4d.js')
+    assert resp.headers['Cache-Control'] == server.STATIC_IMMUTABLE_CACHE
+    assert client.get('/js/a.js').headers['Cache-Control'] == 'no-cache'
+
+
+def test_stale_bundle_is_not_used(client, server, bundled_site):
+    html = (bundled_site / 'index.html').read_text()
+    (bundled_site / 'index.html').write_text(html.replace('js/b.js', 'js/c.js'))
+    server._index_page.clear()
+    assert 'js/bundles/' not in client.get('/').get_data(as_text=True)
+
+
+# --- examples catalog --------------------------------------------------------------
+
+
+def test_examples_catalog_matches_static_files(client):
+    resp = client.get('/api/examples', headers={'Origin': GOOD_ORIGIN})
+    examples = resp.get_json()['examples']
+    assert len(examples) >= 30
+    assert examples['plantuml'] == client.get('/examples/plantuml.txt').get_data(as_text=True)
+    again = client.get('/api/examples', headers={'Origin': GOOD_ORIGIN, 'If-None-Match': resp.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_examples_catalog_filters_types(client):
+    examples = client.get('/api/examples?types=mermaid,PlantUML,nope',
+                          headers={'Origin': GOOD_ORIGIN}).get_json()['examples']
+    assert sorted(examples) == ['mermaid', 'plantuml']
+
+
+def test_examples_index_and_disabled_types(client, server, monkeypatch):
+    monkeypatch.setattr(server, 'DISABLED_DIAGRAM_TYPES', ['bpmn'])
+    index = client.get('/api/examples?index=1', headers={'Origin': GOOD_ORIGIN}).get_json()['examples']
+    assert 'bpmn' not in index
+    assert index['d2']['etag'] == server.STATIC_ASSETS.assets['examples/d2.txt'].etag()
+    assert client.get('/api/examples', headers={'Origin': 'https://evil.example'}).status_code == 403
+
+
+# --- shared rate-limit storage -----------------------------------------------------
+
+
+def test_sqlite_storage_is_shared_and_survives_restart(server, tmp_path):
+    from limits import parse
+    from limits.storage import storage_from_string
+    from limits.strategies import FixedWindowRateLimiter
+
+    uri = f'sqlite:///{tmp_path}/limits.db'
+    worker_a, worker_b = storage_from_string(uri), storage_from_string(uri)
+    assert type(worker_a).__name__ == 'SQLiteStorage'  # other tests re-import server
+    limit = parse('3/minute')
+    assert FixedWindowRateLimiter(worker_a).hit(limit, 'ai', '1.2.3.4')
+    assert FixedWindowRateLimiter(worker_b).hit(limit, 'ai', '1.2.3.4')
+    assert FixedWindowRateLimiter(worker_a).hit(limit, 'ai', '1.2.3.4')
+    assert not FixedWindowRateLimiter(worker_b).hit(limit, 'ai', '1.2.3.4')
+    restarted = storage_from_string(uri)
+    assert not FixedWindowRateLimiter(restarted).test(limit, 'ai', '1.2.3.4')
+    assert FixedWindowRateLimiter(restarted).test(limit, 'ai', '5.6.7.8')
+
+
+def _hit_sliding_window(uri, hits, results):
+    from limits import parse
+    from limits.storage import storage_from_string
+    from limits.strategies import SlidingWindowCounterRateLimiter
+
+    limiter = SlidingWindowCounterRateLimiter(storage_from_string(uri))
+    results.put(sum(limiter.hit(parse('100/hour'), 'ai', 'shared-ip') for _ in range(hits)))
+
+
+def test_sqlite_sliding_window_is_exact_across_processes(server, tmp_path):
+    import multiprocessing
+
+    uri = f'sqlite:///{tmp_path}/limits.db'
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_hit_sliding_window, args=(uri, 60, results)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    admitted = sum(results.get(timeout=30) for _ in workers)
+    for worker in workers:
+        worker.join()
+    assert admitted == 100
+
+
+# --- token budgets and usage ledger -------------------------------------------
+
+
+@pytest.fixture
+def usage_ledger(server, tmp_path, monkeypatch):
+    """A fresh ledger file and budget store; budgets are set per test."""
+    ledger = server.UsageLedger(str(tmp_path / 'usage.jsonl'), 3600, 1000)
+    monkeypatch.setattr(server, 'AI_USAGE_LEDGER', ledger.path)
+    monkeypatch.setattr(server, 'usage_ledger', ledger)
+    monkeypatch.setattr(server, '_budget_storage', {})
+    return ledger
+
+
+def test_token_budget_rejects_before_calling_upstream(client, server, upstream, usage_ledger, monkeypatch):
+    monkeypatch.setattr(server, 'TOKEN_BUDGETS', [server.TokenBudget('ip', '1000/day')])
+    resp = post_ai(client)  # estimate includes the 16000-token completion cap
+    assert resp.status_code == 429
+    assert resp.get_json()['code'] == 'token_budget'
+    assert int(resp.headers['Retry-After']) >= 1
+    assert upstream.calls == []
+
+
+def test_reported_usage_is_charged_and_recorded(client, server, upstream, usage_ledger, monkeypatch):
+    monkeypatch.setattr(server, 'TOKEN_BUDGETS', [server.TokenBudget('global', '100000/day')])
+    upstream.response._json_body = {'choices': [{'message': {'content': 'ok'}}],
+                                    'usage': {'prompt_tokens': 40, 'completion_tokens': 2, 'total_tokens': 42}}
+    assert post_ai(client).status_code == 200
+    storage = server.budget_storage()
+    assert server.TOKEN_BUDGETS[0].retry_after(storage, 'all', 100000 - 42) is None
+    assert server.TOKEN_BUDGETS[0].retry_after(storage, 'all', 100000 - 41) >= 1
+    usage_ledger.flush()
+    [entry] = [json.loads(line) for line in open(usage_ledger.day_path(server._utc_day(time.time())))]
+    assert entry['total_tokens'] == 42 and not entry['estimated']
+    assert '127.0.0.1' not in json.dumps(entry)
+
+
+def test_streamed_usage_chunk_is_recorded(client, server, upstream, usage_ledger):
+    from conftest import FakeUpstreamResponse
+    upstream.response = FakeUpstreamResponse(lines=[
+        b'data: {"choices":[{"delta":{"content":"hi"}}]}',
+        b'data: {"choices":[],"usage":{"prompt_tokens":9,"completion_tokens":1,"total_tokens":10}}',
+        b'data: [DONE]',
+    ])
+    resp = post_ai(client, body=ai_body(stream=True))
+    resp.get_data()
+    assert upstream.calls[0]['json']['stream_options'] == {'include_usage': True}
+    [entry] = list(usage_ledger.entries())
+    assert entry['total_tokens'] == 10 and entry['stream']
+
+
+def test_usage_endpoint_aggregates_ledger(client, server, usage_ledger):
+    now = time.time()
+    for model, tokens, ts in (('a', 10, now), ('a', 5, now), ('b', 7, now), ('a', 100, now - 7 * 86400)):
+        usage_ledger.record({'ts': ts, 'model': model, 'client': 'c', 'prompt_tokens': tokens,
+                             'completion_tokens': 0, 'total_tokens': tokens, 'estimated': False})
+    usage_ledger.flush()
+    usage_ledger.record({'ts': now, 'model': 'b', 'client': 'c', 'prompt_tokens': 1,
+                         'completion_tokens': 0, 'total_tokens': 1, 'estimated': True})
+    body = client.get('/api/usage', headers={'Origin': GOOD_ORIGIN}).get_json()
+    assert body['totals']['total_tokens'] == 23
+    assert body['groups']['a']['requests'] == 2
+    assert body['groups']['b'] == {'requests': 2, 'prompt_tokens': 8, 'completion_tokens': 0,
+                                   'total_tokens': 8, 'estimated': 1}
+    by_day = client.get(f'/api/usage?group_by=day&since={now - 8 * 86400}',
+                        headers={'Origin': GOOD_ORIGIN}).get_json()
+    assert len(by_day['groups']) == 2
+    assert client.get('/api/usage?group_by=ip', headers={'Origin': GOOD_ORIGIN}).status_code == 400
+
+
+def test_usage_ledger_rotates_daily_and_enforces_admin_token(client, server, usage_ledger, monkeypatch):
+    now = time.time()
+    usage_ledger.retention_days = 30
+    for ts in (now, now - 2 * 86400, now - 40 * 86400):
+        usage_ledger.record({'ts': ts, 'model': 'a', 'total_tokens': 1})
+    usage_ledger.flush()
+    assert sorted(usage_ledger._day_files()) == [server._utc_day(now - 2 * 86400), server._utc_day(now)]
+    assert [entry['ts'] for entry in usage_ledger.entries(now - 3600)] == [now]
+    monkeypatch.setattr(server, 'ADMIN_TOKEN', 's3cret')
+    assert client.get('/api/usage').status_code == 401
+    assert client.get('/api/usage', headers={'Authorization': 'Bearer s3cret'}).get_json()['totals']['requests'] == 1
+
+
+# --- render gateway -----------------------------------------------------------
+
+
+@pytest.fixture
+def kroki(server, tmp_path, monkeypatch):
+    """Fake Kroki core behind a fresh render cache; returns a recorder."""
+
+    class FakeKroki:
+        def __init__(self):
+            self.calls = []
+            self.status = 200
+            self.body = b'<svg/>'
+
+        def post(self, url, params=None, data=None, **kwargs):
+            self.calls.append({'url': url, 'params': params, 'data': data})
+            resp = server.requests.Response()
+            resp.status_code = self.status
+            resp._content = self.body
+            image_type = 'image/png' if url.endswith('/png') else 'image/svg+xml'
+            resp.headers['Content-Type'] = image_type if self.status == 200 else 'text/plain'
+            return resp
+
+    fake = FakeKroki()
+    monkeypatch.setattr(server, 'kroki_session', lambda: fake)
+    monkeypatch.setattr(server, '_render_cache', server.DiskCache(str(tmp_path / 'render'), 1 << 20, 3600))
+    monkeypatch.setattr(server, '_render_counters', dict.fromkeys(server.RENDER_CACHE_COUNTERS, 0))
+    monkeypatch.setattr(server, 'render_scheduler', server.RenderScheduler(
+        server.RENDER_MAX_CONCURRENT_PER_TYPE, server.RENDER_MAX_CONCURRENT_DEFAULT, 8,
+        {'interactive': 5, 'bulk': 5}))
+    return fake
+
+
+def test_render_gateway_caches_post_renders(client, server, kroki):
+    first = client.post('/api/render/plantuml/svg', data='@startuml\nA -> B\n@enduml\n')
+    # Same diagram from an editor with CRLF endings and trailing spaces.
+    second = client.post('/api/render/plantuml/svg', data='@startuml\r\nA -> B  \r\n@enduml')
+    assert first.status_code == second.status_code == 200
+    assert first.headers['X-Render-Cache'] == 'MISS'
+    assert second.headers['X-Render-Cache'] == 'HIT'
+    assert second.data == b'<svg/>' and second.mimetype == 'image/svg+xml'
+    assert first.headers['ETag'] == second.headers['ETag']
+    assert len(kroki.calls) == 1
+    assert kroki.calls[0]['url'].endswith('/plantuml/svg')
+    assert kroki.calls[0]['data'] == b'@startuml\nA -> B\n@enduml\n'  # normalized for the key only
+
+
+def test_render_gateway_keeps_whitespace_sensitive_sources_apart(client, server, kroki):
+    for data in ('.--.\n|  |\n', '.--.  \n|  |\n\n', '.--.\r\n|  |\r\n'):
+        resp = client.post('/api/render/svgbob/svg', data=data)
+        assert resp.status_code == 200 and resp.headers['X-Render-Cache'] == 'MISS'
+    assert [call['data'] for call in kroki.calls] == [b'.--.\n|  |\n', b'.--.  \n|  |\n\n', b'.--.\r\n|  |\r\n']
+    assert client.post('/api/render/svgbob/svg', data='.--.\n|  |\n').headers['X-Render-Cache'] == 'HIT'
+    assert server.render_cache_key('ditaa', 'png', {}, 'A \n') != server.render_cache_key('ditaa', 'png', {}, 'A\n')
+
+
+def test_render_gateway_skips_the_cache_while_core_version_is_unknown(client, server, kroki, monkeypatch):
+    monkeypatch.setattr(server, 'KROKI_CORE_VERSION', '')
+    monkeypatch.setattr(server, '_kroki_version', {'value': None, 'checked': 0.0})
+    health = []
+
+    def down(url, **kwargs):
+        health.append(url)
+        raise server.requests.ConnectionError('core is down')
+
+    monkeypatch.setattr(kroki, 'get', down, raising=False)
+    for _ in range(2):
+        resp = client.post('/api/render/svgbob/svg', data='  .-.\n  | |  \n')
+        assert resp.status_code == 200 and resp.headers['X-Render-Cache'] == 'BYPASS'
+    assert len(kroki.calls) == 2 and len(health) == 1  # unknown is remembered briefly
+    assert kroki.calls[0]['data'] == b'  .-.\n  | |  \n'
+    assert server.render_cache_stats()['stores'] == 0 and server.render_cache_stats()['core_version'] is None
+
+
+def test_render_gateway_key_covers_options_format_and_core_version(client, server, kroki, monkeypatch):
+    body = {'diagram_source': 'A -> B', 'diagram_type': 'goat', 'output_format': 'svg'}
+    client.post('/api/render/', json=body)
+    client.post('/api/render/', json=dict(body, diagram_options={'svg-color-dark-scheme': '#000000'}))
+    client.post('/api/render/goat/png', data='A -> B')
+    monkeypatch.setattr(server, 'KROKI_CORE_VERSION', 'next-core')
+    client.post('/api/render/goat/svg', data='A -> B')
+    assert len(kroki.calls) == 4
+    assert kroki.calls[1]['params'] == {'svg-color-dark-scheme': '#000000'}
+
+
+def test_render_gateway_negative_cache_is_short(client, server, kroki, monkeypatch):
+    kroki.status, kroki.body = 400, b'Syntax error'
+    assert client.post('/api/render/mermaid/svg', data='graph TD; A--').status_code == 400
+    resp = client.post('/api/render/mermaid/svg', data='graph TD; A--')
+    assert resp.status_code == 400 and resp.headers['X-Render-Cache'] == 'HIT'
+    assert len(kroki.calls) == 1
+    kroki.status = 503  # overloaded renderer: never cached
+    client.post('/api/render/mermaid/svg', data='graph TD; B--')
+    client.post('/api/render/mermaid/svg', data='graph TD; B--')
+    assert len(kroki.calls) == 3
+    stats = server.render_cache_stats()
+    assert stats['negative_hits'] == 1 and stats['upstream_errors'] == 2
+
+
+def test_render_gateway_rejects_bad_requests(client, server, kroki, monkeypatch):
+    monkeypatch.setattr(server, 'DISABLED_DIAGRAM_TYPES', ['bpmn'])
+    assert client.post('/api/render/bpmn/svg', data='<xml/>').status_code == 404
+    assert client.post('/api/render/../svg', data='x').status_code in (400, 404, 405)
+    assert client.post('/api/render/plantuml/svg', data='   ').status_code == 400
+    assert client.post('/api/render/plantuml/svg', data='x', headers={'Origin': 'https://evil.example'}).status_code == 403
+    big = 'x' * (server.KROKI_MAX_BODY_SIZE + 1)
+    assert client.post('/api/render/plantuml/svg', data=big).status_code == 413
+    assert kroki.calls == []
+
+
+# --- render scheduler ---------------------------------------------------------
+
+
+def test_render_scheduler_serves_interactive_lane_first(server):
+    scheduler = server.RenderScheduler({'mermaid': 1}, 0, 8, {'interactive': 5, 'bulk': 5})
+    assert scheduler.acquire('mermaid', 'interactive') == (True, None)
+    assert scheduler.acquire('plantuml', 'bulk') == (True, None)  # other types are unaffected
+    order = []
+
+    def wait(lane):
+        granted, _ = scheduler.acquire('mermaid', lane)
+        order.append(lane)
+        scheduler.release('mermaid', 0.01)
+
+    bulk = threading.Thread(target=wait, args=('bulk',))
+    bulk.start()
+    while scheduler.stats()['waiting']['bulk'] == 0:
+        time.sleep(0.005)
+    interactive = threading.Thread(target=wait, args=('interactive',))
+    interactive.start()
+    while scheduler.stats()['waiting']['interactive'] == 0:
+        time.sleep(0.005)
+    scheduler.release('mermaid', 0.01)
+    bulk.join()
+    interactive.join()
+    assert order == ['interactive', 'bulk']
+    stats = scheduler.stats()
+    assert stats['queued'] == 2 and stats['wait_ms']['bulk']['max'] > 0
+
+
+def test_render_scheduler_rejects_when_lane_is_full(server):
+    scheduler = server.RenderScheduler({'bpmn': 1}, 0, 0, {'interactive': 5, 'bulk': 5})
+    scheduler.acquire('bpmn', 'interactive')
+    status, _, body, headers = scheduler.run('k', 'bpmn', 'bulk', lambda: pytest.fail('must not render'))
+    assert status == 503
+    assert json.loads(body)['code'] == 'render_busy'
+    assert int(headers['Retry-After']) >= 1
+    assert scheduler.stats()['rejected'] == 1
+
+
+def test_identical_concurrent_renders_share_one_kroki_call(client, server, kroki, monkeypatch):
+    release = threading.Event()
+    post = kroki.post
+
+    def slow_post(*args, **kwargs):
+        release.wait(5)
+        return post(*args, **kwargs)
+
+    monkeypatch.setattr(kroki, 'post', slow_post)
+    results = []
+
+    def render():
+        results.append(server.app.test_client().post('/api/render/mermaid/svg', data='graph TD; A-->B'))
+
+    threads = [threading.Thread(target=render) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while server.render_scheduler.counters['coalesced'] < 2:
+        time.sleep(0.005)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(kroki.calls) == 1
+    assert sorted(r.headers['X-Render-Cache'] for r in results) == ['COALESCED', 'COALESCED', 'MISS']
+    assert all(r.data == b'<svg/>' for r in results)
+
+
+# --- batch renders ------------------------------------------------------------
+
+
+def test_batch_render_streams_ndjson_with_per_item_errors(client, server, kroki, monkeypatch):
+    monkeypatch.setattr(server, 'DISABLED_DIAGRAM_TYPES', ['bpmn'])
+    client.post('/api/render/plantuml/svg', data='A -> B')  # warms the render cache
+    resp = client.post('/api/render/batch', json={'items': [
+        {'id': 'cached', 'type': 'plantuml', 'format': 'svg', 'source': 'A -> B'},
+        {'id': 'png', 'type': 'graphviz', 'format': 'png', 'source': 'digraph { a -> b }'},
+        {'id': 'bad', 'type': 'plantuml', 'format': 'svg'},
+        {'id': 'off', 'type': 'bpmn', 'format': 'svg', 'source': '<xml/>'},
+    ]})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'application/x-ndjson'
+    results = {r['id']: r for r in map(json.loads, resp.get_data(as_text=True).splitlines())}
+    assert results['cached']['cache'] == 'HIT' and results['cached']['data'] == '<svg/>'
+    assert results['png']['status'] == 200 and results['png']['encoding'] == 'base64'
+    assert results['bad']['status'] == 400 and results['bad']['error'] == 'Empty diagram source'
+    assert results['off']['status'] == 400 and 'disabled' in results['off']['error']
+    assert len(kroki.calls) == 2
+
+
+def test_batch_render_multipart_and_kroki_errors(client, server, kroki):
+    kroki.status, kroki.body = 400, b'Syntax error in line 1'
+    items = [{'type': 'mermaid', 'format': 'png', 'source': f'graph TD; A{i}--'} for i in range(3)]
+    resp = client.post('/api/render/batch', json=items, headers={'Accept': 'multipart/mixed'})
+    assert resp.mimetype == 'multipart/mixed'
+    boundary = resp.mimetype_params['boundary']
+    parts = resp.get_data().split(f'--{boundary}'.encode())[1:-1]
+    assert len(parts) == 3
+    assert all(b'X-Render-Status: 400' in part and b'Syntax error' in part for part in parts)
+    assert resp.get_data().endswith(f'--{boundary}--\r\n'.encode())
+
+
+def test_batch_render_rejects_malformed_batches(client, server, kroki, monkeypatch):
+    assert client.post('/api/render/batch', json={'items': []}).status_code == 400
+    assert client.post('/api/render/batch', data='not json').status_code == 400
+    monkeypatch.setattr(server, 'RENDER_BATCH_MAX_ITEMS', 2)
+    items = [{'type': 'plantuml', 'format': 'svg', 'source': 'A'}] * 3
+    assert client.post('/api/render/batch', json=items).status_code == 400
+    assert kroki.calls == []
+
+
+def test_batch_render_items_count_against_a_per_ip_quota(client, server, kroki, monkeypatch):
+    monkeypatch.setattr(server, '_render_batch_budget', server.TokenBudget('render-batch', '5/minute'))
+    monkeypatch.setattr(server, '_budget_storage', {})
+    items = [{'type': 'plantuml', 'format': 'svg', 'source': f'A -> B{i}'} for i in range(3)]
+    first = client.post('/api/render/batch', json=items + [{'type': 'plantuml'}])  # invalid items are free
+    assert first.status_code == 200 and len(first.get_data(as_text=True).splitlines()) == 4
+    resp = client.post('/api/render/batch', json=items)  # 3 + 3 items > 5, though only 2 requests
+    assert resp.status_code == 429 and resp.get_json()['code'] == 'batch_quota'
+    assert 1 <= int(resp.headers['Retry-After']) <= 60
+    assert len(kroki.calls) == 3
+    assert client.post('/api/render/batch', json=items[:2]).status_code == 200
+
+
+# --- render cache warmer ------------------------------------------------------
+
+
+def test_render_warmer_covers_examples_and_extra_corpus(server, kroki, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'DISABLED_DIAGRAM_TYPES', ['bpmn'])
+    (tmp_path / 'corpus' / 'plantuml').mkdir(parents=True)
+    (tmp_path / 'corpus' / 'plantuml' / 'sequence.puml').write_text('@startuml\nA -> B\n@enduml\n')
+    (tmp_path / 'corpus' / 'mermaid.flow.mmd').write_text('graph TD; A-->B\n')
+    sources = server.render_warm_sources(str(tmp_path / 'corpus'))
+    labels = {label for label, _, _ in sources}
+    assert {'plantuml/sequence.puml', 'mermaid.flow.mmd', 'examples/plantuml.txt'} <= labels
+    assert 'examples/bpmn.txt' not in labels
+
+    report = server.warm_render_cache(['svg'], str(tmp_path / 'corpus'), 2)
+    assert report['renders'] == len(sources) and report['errors'] == 0
+    plantuml = report['types']['plantuml']
+    assert plantuml['renders'] == 2 and plantuml['cold_ms'] is not None
+    # Every item went to Kroki once; the second (warm) render was a cache hit.
+    assert len(kroki.calls) == len(sources)
+    again = server.warm_render_cache(['svg'], str(tmp_path / 'corpus'), 2)
+    assert again['types']['plantuml']['already_cached'] == 2
+    assert len(kroki.calls) == len(sources)
+
+
+def test_render_warmer_reports_failed_renders(server, kroki):
+    kroki.status = 400
+    report = server.warm_render_cache(['svg'], '', 1)
+    assert report['errors'] == report['renders'] > 0
+    assert report['types']['plantuml']['errors'] == ['examples/plantuml.txt (svg): HTTP 400']
+
+
+def diagram_answer(code):
+    from conftest import FakeUpstreamResponse
+    content = '```json\n' + json.dumps({'diagramCode': code, 'explanation': 'done'}) + '\n```'
+    return FakeUpstreamResponse(json_body={'choices': [{'message': {'content': content}}]})
+
+
+def test_ai_repair_loop_re_prompts_until_the_diagram_renders(client, server, upstream, kroki, monkeypatch):
+    monkeypatch.setattr(server, 'AI_REPAIR_ENABLED', True)
+    replies = [diagram_answer('graph TD; A--'), diagram_answer('graph TD; A-->B')]
+    monkeypatch.setattr(server.requests.Session, 'post',
+                        lambda session, url, **kwargs: upstream.calls.append(kwargs) or replies.pop(0))
+    post = kroki.post
+
+    def render(url, params=None, data=None, **kwargs):
+        kroki.status, kroki.body = (400, b'Parse error on line 1') if data.endswith(b'A--') else (200, b'<svg/>')
+        return post(url, params=params, data=data, **kwargs)
+
+    monkeypatch.setattr(kroki, 'post', render)
+    body = ai_body(repair={'diagramType': 'mermaid', 'userPrompt': 'draw a cat', 'includeRender': True})
+    resp = post_ai(client, body=body)
+    assert resp.status_code == 200
+    repair = resp.get_json()['repair']
+    assert repair == {'checked': True, 'valid': True, 'attempts': 2,
+                      'render': {'content_type': 'image/svg+xml', 'data': '<svg/>'}}
+    retry = upstream.calls[1]['json']['messages'][-1]['content']
+    assert 'Parse error on line 1' in retry and 'graph TD; A--' in retry
+    assert all(call['json'].get('stream') is not True for call in upstream.calls)
+
+
+def test_ai_repair_loop_is_bounded_and_opt_in(client, server, upstream, kroki, monkeypatch):
+    kroki.status, kroki.body = 400, b'Syntax error'
+    upstream.response = diagram_answer('graph TD; A--')
+    body = ai_body(repair={'diagramType': 'mermaid'})
+    assert 'repair' not in post_ai(client, body=body).get_json()  # AI_REPAIR_ENABLED is off
+    monkeypatch.setattr(server, 'AI_REPAIR_ENABLED', True)
+    monkeypatch.setattr(server, 'AI_REPAIR_MAX_ATTEMPTS', 1)
+    upstream.calls.clear()
+    repair = post_ai(client, body=body).get_json()['repair']
+    assert repair == {'checked': True, 'valid': False, 'attempts': 2, 'error': 'Syntax error'}
+    assert len(upstream.calls) == 2
+    # The renderer being down is not a verdict: the browser validates instead.
+    kroki.status = 503
+    upstream.response = diagram_answer('graph TD; B--')
+    upstream.calls.clear()
+    repair = post_ai(client, body=body).get_json()['repair']
+    assert repair['checked'] is False and len(upstream.calls) == 1
+
+
+def test_optimize_svg_keeps_geometry_text_and_foreign_content(server):
+    svg = ('<?xml version="1.0"?><!--SRC=[x]-->\n<svg viewBox="0 0 10.123456 5">\n'
+           '  <g fill="red" style="fill: blue; stroke:black;fill:green">\n'
+           '    <path d="M1.00001-0.00001L2.0004.5 3.14159,2.71828"/>\n'
+           '    <text x="1.55555">  two  <tspan> words </tspan></text>\n'
+           '  </g>\n  <style>  .a  {  fill : red ;  }  </style>\n'
+           '  <foreignObject><div x="1.55555">  a  <!-- keep --></div></foreignObject>\n</svg>\n')
+    assert server.optimize_svg(svg, server.SVG_OPTIMIZE_RULES) == (
+        '<?xml version="1.0"?><svg viewBox="0 0 10.123 5">'
+        '<g style="stroke:black;fill:green"><path d="M1 0L2 .5 3.142,2.718"/>'
+        '<text x="1.556">  two  <tspan> words </tspan></text></g><style>.a{fill : red;}</style>'
+        '<foreignObject><div x="1.55555">  a  <!-- keep --></div></foreignObject></svg>')
+
+
+def test_gateway_caches_optimized_svg_under_its_own_key(client, server, kroki, monkeypatch):
+    kroki.body = b'<svg width="10.000001">\n  <!-- comment -->\n  <rect x="1.25"/>\n</svg>\n'
+    raw = client.post('/api/render/graphviz/svg', data='digraph { a -> b }')
+    assert raw.data == kroki.body
+    monkeypatch.setattr(server, 'SVG_OPTIMIZE_ENABLED', True)
+    monkeypatch.setattr(server, '_svg_counters', dict.fromkeys(server._svg_counters, 0))
+    first = client.post('/api/render/graphviz/svg', data='digraph { a -> b }')
+    second = client.post('/api/render/graphviz/svg', data='digraph { a -> b }')
+    assert first.data == second.data == b'<svg width="10"><rect x="1.25"/></svg>'
+    assert first.headers['ETag'] != raw.headers['ETag']
+    assert second.headers[server.RENDER_CACHE_HEADER] == 'HIT' and len(kroki.calls) == 2
+    stats = server.svg_optimize_stats()
+    assert stats['optimized'] == 1 and stats['bytes_out'] == len(first.data)
+    # Other formats are never rewritten.
+    kroki.body = b'\x89PNG'
+    assert client.post('/api/render/graphviz/png', data='digraph { a -> b }').data == b'\x89PNG'
+
+
+def test_kroki_encoding_round_trips_and_canonicalizes_equivalent_uris(server):
+    import base64
+    import zlib
+    source = '@startuml\nAlice -> Bob: ünïcode\n@enduml\n'
+    encoded = server.encode_kroki_source(source)
+    assert server.decode_kroki_source(encoded) == source
+    assert server.decode_kroki_source(encoded.rstrip('=')) == source
+    raw_deflate = zlib.compressobj(9, zlib.DEFLATED, -15)
+    variant = raw_deflate.compress(source.replace('\n', '  \r\n').encode()) + raw_deflate.flush()
+    canonical = server.canonical_render_uri(f'/plantuml/svg/{encoded}')
+    assert canonical == f'/plantuml/svg/{encoded}'
+    assert server.canonical_render_uri(
+        '/plantuml/svg/' + base64.urlsafe_b64encode(variant).decode().rstrip('=')) == canonical
+    assert server.canonical_render_uri('/api/stats') is None
+    with pytest.raises(ValueError):
+        server.decode_kroki_source(server.encode_kroki_source('x' * 100), max_bytes=50)
+
+
+def test_encode_endpoint_returns_the_canonical_get_url(client, server):
+    resp = client.post('/api/encode/graphviz/svg?theme=dark', data='\ufeffdigraph {\r\n  a -> b  \r\n}',
+                       headers={'Origin': GOOD_ORIGIN})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    encoded = server.encode_kroki_source('digraph {\n  a -> b\n}\n')
+    assert data['path'] == f'/graphviz/svg/{encoded}?theme=dark'
+    assert data['url'].endswith(data['path']) and data['encoded'] == encoded
+    same = client.post('/api/encode', json={'diagram_source': 'digraph {\n  a -> b\n}', 'diagram_type': 'graphviz',
+                                              'output_format': 'svg', 'diagram_options': {'theme': 'dark'}},
+                       headers={'Origin': GOOD_ORIGIN})
+    assert same.get_json()['encoded'] == encoded
+    art = client.post('/api/encode/goat/svg', data='+--+\r\n|  |  \r\n', headers={'Origin': GOOD_ORIGIN})
+    assert art.get_json()['encoded'] == server.encode_kroki_source('+--+\r\n|  |  \r\n')  # drawn with whitespace
+    assert client.post('/api/encode/goat/svg', data='x', headers={'Origin': 'https://evil.example'}).status_code == 403
+    assert client.post('/api/encode/goat/svg', data='  ', headers={'Origin': GOOD_ORIGIN}).status_code == 400
+
+
+def test_metrics_count_routes_upstream_statuses_and_rejections(client, server, upstream, monkeypatch):
+    for metric in server.metrics.metrics.values():  # start from zero
+        monkeypatch.setattr(metric, '_local', threading.local())
+        monkeypatch.setattr(metric, '_shards', [])
+    for body in (ai_body(), ai_body(stream=True)):
+        with post_ai(client, body=body) as resp:  # the server closes the body when it is sent
+            assert resp.status_code == 200
+    server.rejections.inc(('rate_limit',))
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'doccode_http_requests_total{route="/api/ai-assist",method="POST",status="200"} 2' in text
+    assert f'doccode_ai_upstream_responses_total{{model="{MODEL}",status="200"}} 2' in text
+    assert 'doccode_http_request_duration_seconds_bucket{route="/api/ai-assist",le="+Inf"} 2' in text
+    assert 'doccode_ai_relay_bytes_total{mode="stream"}' in text and 'doccode_ai_active_streams 0' in text
+    assert 'doccode_rejections_total{reason="rate_limit"} 1' in text
+    assert '# TYPE doccode_http_requests_in_flight gauge' in text
+    monkeypatch.setattr(server, 'ADMIN_TOKEN', 's3cret')  # METRICS_TOKEN falls back to it
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+
+
+def test_metrics_sum_counters_over_workers_and_gauges_over_live_ones(server, tmp_path, monkeypatch):
+    registry = server.MetricsRegistry(str(tmp_path), 1)
+    requests_total = registry.add('http_requests_total', 'counter', 'x', ('route', 'method', 'status'))
+    streams = registry.add('ai_active_streams', 'gauge', 'x')
+    latency = registry.add('ai_upstream_latency_seconds', 'histogram', 'x', ('model',), buckets=(1, 10))
+    requests_total.inc(('/api/stats', 'GET', '200'), 3)
+    streams.inc(amount=2)
+    latency.observe(0.5, ('m',))
+    sibling = {'doccode_http_requests_total': [[['/api/stats', 'GET', '200'], 4]],
+               'doccode_ai_active_streams': [[[], 5]],
+               'doccode_ai_upstream_latency_seconds': [[['m'], [0, 1, 0, 7.0]]]}
+    live_pid, dead_pid = os.getppid(), 2 ** 22 + 1
+    (tmp_path / f'{live_pid}.json').write_text(json.dumps(sibling))
+    (tmp_path / f'{dead_pid}.json').write_text(json.dumps(sibling))
+    (tmp_path / '123.json.tmp').write_text('{half')
+    text = registry.exposition()
+    assert 'doccode_http_requests_total{route="/api/stats",method="GET",status="200"} 11' in text
+    assert 'doccode_ai_active_streams 7' in text  # the exited worker's gauge is dropped
+    assert 'doccode_ai_upstream_latency_seconds_bucket{model="m",le="1"} 1' in text
+    assert 'doccode_ai_upstream_latency_seconds_bucket{model="m",le="10"} 3' in text
+    assert 'doccode_ai_upstream_latency_seconds_count{model="m"} 3' in text
+    registry.flush()
+    assert json.loads((tmp_path / f'{os.getpid()}.json').read_text())['doccode_ai_active_streams'] == [[[], 2]]
+
+
+def test_gunicorn_master_clears_metric_snapshots_not_the_import(server, tmp_path, monkeypatch):
+    import runpy
+    import sys
+    monkeypatch.setitem(sys.modules, 'server', server)  # the hook imports it by name
+    (tmp_path / '4242.json').write_text('{}')
+    monkeypatch.setattr(server, 'metrics', server.MetricsRegistry(str(tmp_path), 1))
+    conf = runpy.run_path(os.path.join(os.path.dirname(server.__file__), 'gunicorn.conf.py'))
+    assert (tmp_path / '4242.json').exists()  # loading config and app leaves live snapshots alone
+    conf['on_starting'](None)
+    assert not (tmp_path / '4242.json').exists()
+
+
+def test_stream_timer_summarises_phases_per_model(client, server, upstream, monkeypatch, caplog):
+    from conftest import FakeUpstreamResponse
+    monkeypatch.setattr(server, 'stream_timings', server.StreamTimings(10))
+    monkeypatch.setattr(server, 'AI_STREAM_STALL_SECONDS', 0)  # every gap counts as a stall
+    upstream.response = FakeUpstreamResponse(lines=[
+        b'data: {"choices":[{"delta":{"role":"assistant","content":""}}]}',
+        b'data: {"choices":[{"delta":{"content":"A"}}]}',
+        b'data: {"choices":[{"delta":{"content":" -> "}}]}',
+        b'data: {"choices":[{"delta":{"content":"B"}}]}',
+        b'data: {"choices":[],"usage":{"prompt_tokens":9,"completion_tokens":5,"total_tokens":14}}',
+        b'data: [DONE]',
+    ])
+    with caplog.at_level('INFO', logger=server.logger.name):
+        with post_ai(client, body=ai_body(stream=True)) as resp:
+            assert resp.get_data(as_text=True).count('data:') == 6
+    record = next(json.loads(r.getMessage().split(' ', 3)[3]) for r in caplog.records
+                  if r.getMessage().startswith('AI stream timing '))
+    assert record['outcome'] == 'complete' and record['tokens'] == 5 and not record['tokens_estimated']
+    assert record['stalls'] == 2 and record['connect_s'] is None
+    assert record['ttfb_s'] <= record['ttft_s'] <= record['total_s']
+
+    resp = client.get('/api/stream-timings', headers={'Origin': GOOD_ORIGIN})
+    stats = resp.get_json()['models'][MODEL]
+    assert stats['streams'] == 1 and stats['outcomes'] == {'complete': 1}
+    assert stats['stalled_streams'] == 1 and stats['ttft_s']['p50'] == record['ttft_s']
+    assert client.get('/api/stream-timings', headers={'Origin': 'https://evil.example'}).status_code == 403
+    monkeypatch.setattr(server, 'ADMIN_TOKEN', 's3cret')
+    assert client.get('/api/stream-timings').status_code == 401
+    assert client.get('/api/stream-timings', headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+
+
+def test_take_connect_time_reports_new_connections_only(server, monkeypatch):
+    monkeypatch.setitem(server._upstream_pool, 'pid', None)
+    httpd, base = _keepalive_server()
+    try:
+        session = server.upstream_session()
+        server.take_connect_time()
+        session.get(base + '/models', timeout=5).content
+        assert server.take_connect_time() > 0
+        session.get(base + '/models', timeout=5).content
+        assert server.take_connect_time() is None  # the pooled socket was reused
+    finally:
+        httpd.shutdown()
@@ -447,6 +447,9 @@ EOF
             proxy_set_header X-Real-IP \$remote_addr;
             proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
             proxy_set_header X-Forwarded-Proto https;
+            # index.html carries a Link preload header for its module graph
+            # (INDEX_PRELOAD_HEADER_BYTES); the default 4k buffer is too small.
+            proxy_buffer_size 16k;
         }
 
         # Static resources in static directories
@@ -457,12 +460,12 @@ EOF
             proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
             proxy_set_header X-Forwarded-Proto https;
 
-            # Revalidate via ETag instead of hard-caching. These assets are
-            # un-versioned (no content hash in the filename), so a 1-day cache
-            # meant deploys didn't reach returning users. "expires -1" emits
-            # Cache-Control: no-cache -> the browser revalidates and gets a fast
-            # 304 when unchanged, but always picks up a changed asset next load.
-            expires -1;
+            # Caching is decided by the app: fingerprinted URLs
+            # (name.<content-hash>.ext, which index.html links to) are served
+            # "immutable" for a year; plain URLs get Cache-Control: no-cache
+            # plus a content-hash ETag, so revalidation is a fast 304. Both come
+            # precompressed (gzip/brotli). No "expires" here: it would replace
+            # the app's Cache-Control.
         }
 
         # Static files at root level
@@ -473,12 +476,46 @@ EOF
             proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
             proxy_set_header X-Forwarded-Proto https;
 
-            # Revalidate via ETag instead of hard-caching. These assets are
-            # un-versioned (no content hash in the filename), so a 1-day cache
-            # meant deploys didn't reach returning users. "expires -1" emits
-            # Cache-Control: no-cache -> the browser revalidates and gets a fast
-            # 304 when unchanged, but always picks up a changed asset next load.
-            expires -1;
+            # Cache-Control and the content-hash ETag come from the app
+            # (no-cache + 304 revalidation); no "expires" so it is not replaced.
+            # /index.html gets the same Link preload header as "/".
+            proxy_buffer_size 16k;
+        }
+
+        # POST render gateway: demosite caches Kroki POST renders on disk (shared
+        # by its workers) and forwards misses to core. Same body limit, rate
+        # limits and timeouts as the direct render locations below.
+        location /api/render/ {
+${NGINX_RENDER_LIMITS}
+            client_max_body_size ${RENDER_BODY_LIMIT};
+            proxy_pass http://demosite:${DEMOSITE_CONTAINER_PORT};
+            proxy_set_header Host \$host;
+            proxy_set_header X-Real-IP \$remote_addr;
+            proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+            proxy_set_header X-Forwarded-Proto https;
+            proxy_cache off;
+            proxy_connect_timeout ${RENDER_CONNECT_TIMEOUT};
+            proxy_send_timeout ${RENDER_TIMEOUT};
+            proxy_read_timeout ${RENDER_TIMEOUT};
+            proxy_http_version 1.1;
+            proxy_set_header Connection "";
+        }
+
+        # Prometheus metrics are scraped from demosite:${DEMOSITE_CONTAINER_PORT}/metrics
+        # inside the compose network; never expose them on the public port.
+        location = /metrics {
+            return 404;
+        }
+
+        # Operator endpoints (runtime internals) stay on the compose network too.
+        location = /api/stats {
+            return 404;
+        }
+        location = /api/usage {
+            return 404;
+        }
+        location = /api/stream-timings {
+            return 404;
         }
 
         # Demo site API endpoints (must come before Kroki patterns)
@@ -629,8 +666,10 @@ check_ai_models() {
         return
     fi
 
+    # The model list is refreshed in the background, so only the latest
+    # fetch outcome counts.
     local logs
-    logs=$(docker logs "$container_name" 2>&1)
+    logs=$(docker logs "$container_name" 2>&1 | grep -E "Failed to fetch models from LLM proxy|Fetched [0-9]* chat models from proxy" | tail -1)
 
     if echo "$logs" | grep -q "Failed to fetch models from LLM proxy"; then
         echo ""